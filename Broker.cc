@@ -0,0 +1,331 @@
+#include "include/Broker.h"
+#include "NK_C_API.h"
+#include <sstream>
+#include <stdexcept>
+#include <sys/stat.h>
+
+namespace nitrokey {
+namespace broker {
+    using namespace nitrokey::log;
+
+    Broker::Broker(const std::string &socket_path) : m_socket_path(socket_path), m_listen_fd(-1), m_stop(false),
+                                                     m_stats() {
+        sockaddr_un address = {};
+        if (socket_path.size() >= sizeof address.sun_path)
+            throw std::runtime_error("Broker socket path too long");
+        address.sun_family = AF_UNIX;
+        strncpy(address.sun_path, socket_path.c_str(), sizeof address.sun_path - 1);
+
+        // a socket left by a broker which did not exit cleanly refuses connections
+        int running = connect_socket(socket_path);
+        if (running >= 0) {
+            close(running);
+            throw std::runtime_error("Broker already running at " + socket_path);
+        }
+        unlink(socket_path.c_str());
+
+        m_listen_fd = socket(AF_UNIX, SOCK_STREAM, 0);
+        // owner only from the start, access to the socket is access to the devices
+        const mode_t previous_umask = umask(0177);
+        const bool bound = m_listen_fd >= 0 && bind(m_listen_fd, (sockaddr *) &address, sizeof address) == 0;
+        umask(previous_umask);
+        if (!bound || listen(m_listen_fd, SOMAXCONN) != 0) {
+            if (m_listen_fd >= 0) close(m_listen_fd);
+            throw std::runtime_error("Cannot listen on " + socket_path);
+        }
+    }
+
+    Broker::~Broker() {
+        stop();
+        {
+            std::unique_lock<std::mutex> lock(m_mutex);
+            m_clients_cv.wait(lock, [&]() { return m_client_fds.empty(); });
+        }
+        m_workers.clear();
+        close(m_listen_fd);
+        unlink(m_socket_path.c_str());
+    }
+
+    void Broker::run() {
+        while (!m_stop) {
+            int fd = accept(m_listen_fd, nullptr, nullptr);
+            if (fd < 0) {
+                if (errno == EINTR || errno == ECONNABORTED) continue;
+                break;
+            }
+            if (!is_trusted_peer(fd)) {
+                Log::instance()("Broker refused a client of another user", Loglevel::WARNING);
+                close(fd);
+                continue;
+            }
+            std::lock_guard<std::mutex> lock(m_mutex);
+            if (m_stop) {
+                close(fd);
+                break;
+            }
+            m_client_fds.insert(fd);
+            std::thread(&Broker::serve, this, fd).detach();
+        }
+    }
+
+    void Broker::stop() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_stop = true;
+        // wakes up accept() and the clients waiting for requests
+        shutdown(m_listen_fd, SHUT_RDWR);
+        for (int fd : m_client_fds) shutdown(fd, SHUT_RDWR);
+    }
+
+    Broker::Stats Broker::get_stats() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        return m_stats;
+    }
+
+    Broker::Worker &Broker::get_worker(const std::string &model) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        auto &worker = m_workers[model];
+        if (worker == nullptr) worker.reset(new Worker(*this, model));
+        return *worker;
+    }
+
+    static uint64_t client_id(int fd) {
+        // fair share per process, not per connection
+#ifdef SO_PEERCRED
+        ucred credentials;
+        socklen_t size = sizeof credentials;
+        if (getsockopt(fd, SOL_SOCKET, SO_PEERCRED, &credentials, &size) == 0)
+            return (uint64_t) credentials.pid;
+#endif
+        return (1ULL << 32) | (uint64_t) fd;
+    }
+
+    void Broker::serve(int fd) {
+        const uint64_t client = client_id(fd);
+        Worker *worker = nullptr;
+        Message request, response;
+        try {
+            while (!m_stop && read_message(fd, request)) {
+                auto op = (BrokerOp) request.get_u8();
+                {
+                    std::lock_guard<std::mutex> lock(m_mutex);
+                    m_stats.requests++;
+                }
+                if (op == BrokerOp::LOGIN) {
+                    // stays in the request, the worker reads it again
+                    Message model_reader = request;
+                    worker = &get_worker(model_reader.get_string());
+                }
+                // like the default device of the C API
+                if (worker == nullptr) worker = &get_worker("");
+                response = worker->execute(client, op, request);
+                if (op == BrokerOp::LOGOUT) worker = nullptr;
+                request.clear();
+                if (!write_message(fd, response)) break;
+                response.clear();
+            }
+        }
+        catch (std::runtime_error &e) {
+            // malformed request or broker stopping
+            Log::instance()(std::string("Broker client dropped: ") + e.what(), Loglevel::DEBUG);
+        }
+        request.clear();
+        response.clear();
+        close(fd);
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_client_fds.erase(fd);
+        m_clients_cv.notify_all();
+    }
+
+    Broker::Worker::Worker(Broker &broker, const std::string &model)
+            : m_broker(broker), m_model(model), m_connected(false), m_stop(false),
+              m_thread(&Broker::Worker::run, this) {
+    }
+
+    Broker::Worker::~Worker() {
+        {
+            std::lock_guard<std::mutex> lock(m_mutex);
+            m_stop = true;
+        }
+        m_jobs_cv.notify_all();
+        m_done_cv.notify_all();
+        m_thread.join();
+    }
+
+    Message Broker::Worker::execute(uint64_t client, BrokerOp op, Message &arguments) {
+        std::unique_lock<std::mutex> lock(m_mutex);
+        std::shared_ptr<Job> job;
+        std::string key;
+        if (is_coalescable(op)) {
+            key.assign(arguments.data().begin(), arguments.data().end());
+            auto waiting = m_waiting_reads.find(key);
+            if (waiting != m_waiting_reads.end()) {
+                job = waiting->second;
+                std::lock_guard<std::mutex> stats_lock(m_broker.m_mutex);
+                m_broker.m_stats.coalesced++;
+            }
+        }
+        if (job == nullptr) {
+            job = std::make_shared<Job>();
+            job->op = op;
+            job->arguments = arguments;
+            job->key = key;
+            auto &queue = m_queues[client];
+            if (queue.empty()) m_turns.push_back(client);
+            queue.push_back(job);
+            if (!key.empty()) m_waiting_reads[key] = job;
+            m_jobs_cv.notify_one();
+        }
+        m_done_cv.wait(lock, [&]() { return job->done || m_stop; });
+        if (!job->done) throw std::runtime_error("Broker stopped");
+        return job->result;
+    }
+
+    void Broker::Worker::run() {
+        while (true) {
+            std::shared_ptr<Job> job;
+            {
+                std::unique_lock<std::mutex> lock(m_mutex);
+                m_jobs_cv.wait(lock, [&]() { return m_stop || !m_turns.empty(); });
+                if (m_stop) break;
+                const uint64_t client = m_turns.front();
+                m_turns.pop_front();
+                auto &queue = m_queues[client];
+                job = queue.front();
+                queue.pop_front();
+                if (queue.empty())
+                    m_queues.erase(client);
+                else
+                    m_turns.push_back(client);
+                // identical reads from now on get a fresh result
+                if (!job->key.empty()) m_waiting_reads.erase(job->key);
+            }
+
+            Message result = execute_operation(job->op, job->arguments);
+            job->arguments.clear();
+            {
+                std::lock_guard<std::mutex> lock(m_broker.m_mutex);
+                m_broker.m_stats.executed++;
+            }
+            {
+                std::lock_guard<std::mutex> lock(m_mutex);
+                job->result = result;
+                job->done = true;
+            }
+            result.clear();
+            m_done_cv.notify_all();
+        }
+        if (m_connected) NK_logout();
+    }
+
+    bool Broker::Worker::connect() {
+        // Pro and Storage devices are opened by path, so each worker thread has its own
+        // connection (@see NK_connect_by_path); other models, e.g. "sim", share the default one
+        if (!m_model.empty() && m_model != "P" && m_model != "S")
+            return m_connected = NK_login(m_model.c_str()) == 1;
+        const char *devices = NK_list_devices();
+        std::istringstream lines(devices);
+        NK_free((void *) devices);
+        std::string line;
+        while (std::getline(lines, line)) {
+            const auto path_start = line.rfind('\t');
+            if (path_start == std::string::npos) continue;
+            if (m_model.empty() || line.compare(0, m_model.size(), m_model) == 0)
+                return m_connected = NK_connect_by_path(line.substr(path_start + 1).c_str()) == 1;
+        }
+        return m_connected = false;
+    }
+
+    Message Broker::Worker::execute_operation(BrokerOp op, Message &a) {
+        Message result;
+        auto number_result = [&](uint32_t value) {
+            result.put_u8(NK_get_last_command_status());
+            result.put_u32(value);
+            return result;
+        };
+        auto string_result = [&](const char *value) {
+            result.put_u8(NK_get_last_command_status());
+            result.put_string(value);
+            NK_free((void *) value);
+            return result;
+        };
+
+        if (op == BrokerOp::LOGIN) {
+            result.put_u8(0);
+            result.put_u32(m_connected || connect() ? 1 : 0);
+            return result;
+        }
+        if (op == BrokerOp::LOGOUT) {
+            // the device stays connected for the other clients
+            return number_result(0);
+        }
+        if (!m_connected && !connect()) {
+            result.put_u8(status_not_connected);
+            return result;
+        }
+
+        try {
+            switch (op) {
+                case BrokerOp::STATUS:
+                    return string_result(NK_status());
+                case BrokerOp::SERIAL_NUMBER:
+                    return string_result(NK_device_serial_number());
+                case BrokerOp::FIRST_AUTHENTICATE: {
+                    auto pin = a.get_string(), temporary_password = a.get_string();
+                    return number_result(NK_first_authenticate(pin.c_str(), temporary_password.c_str()));
+                }
+                case BrokerOp::USER_AUTHENTICATE: {
+                    auto pin = a.get_string(), temporary_password = a.get_string();
+                    return number_result(NK_user_authenticate(pin.c_str(), temporary_password.c_str()));
+                }
+                case BrokerOp::LOCK_DEVICE:
+                    return number_result(NK_lock_device());
+                case BrokerOp::TOTP_SET_TIME: {
+                    auto time = a.get_u64();
+                    return number_result(NK_totp_set_time(time));
+                }
+                case BrokerOp::GET_HOTP_CODE: {
+                    auto slot = a.get_u8();
+                    auto temporary_password = a.get_string();
+                    return number_result(NK_get_hotp_code_PIN(slot, temporary_password.c_str()));
+                }
+                case BrokerOp::GET_TOTP_CODE: {
+                    auto slot = a.get_u8();
+                    auto challenge = a.get_u64(), last_totp_time = a.get_u64();
+                    auto last_interval = a.get_u8();
+                    auto temporary_password = a.get_string();
+                    return number_result(NK_get_totp_code_PIN(slot, challenge, last_totp_time, last_interval,
+                                                              temporary_password.c_str()));
+                }
+                case BrokerOp::GET_HOTP_SLOT_NAME:
+                    return string_result(NK_get_hotp_slot_name(a.get_u8()));
+                case BrokerOp::GET_TOTP_SLOT_NAME:
+                    return string_result(NK_get_totp_slot_name(a.get_u8()));
+                case BrokerOp::GET_USER_RETRY_COUNT:
+                    return number_result(NK_get_user_retry_count());
+                case BrokerOp::GET_ADMIN_RETRY_COUNT:
+                    return number_result(NK_get_admin_retry_count());
+                case BrokerOp::ENABLE_PASSWORD_SAFE: {
+                    auto pin = a.get_string();
+                    return number_result(NK_enable_password_safe(pin.c_str()));
+                }
+                case BrokerOp::GET_PASSWORD_SAFE_SLOT_NAME:
+                    return string_result(NK_get_password_safe_slot_name(a.get_u8()));
+                case BrokerOp::GET_PASSWORD_SAFE_SLOT_LOGIN:
+                    return string_result(NK_get_password_safe_slot_login(a.get_u8()));
+                case BrokerOp::GET_PASSWORD_SAFE_SLOT_PASSWORD:
+                    return string_result(NK_get_password_safe_slot_password(a.get_u8()));
+                default:
+                    break;
+            }
+        }
+        catch (std::runtime_error &e) {
+            // malformed arguments or lost device, reconnected on the next request
+            Log::instance()(std::string("Broker request failed: ") + e.what(), Loglevel::ERROR);
+            m_connected = false;
+        }
+        result.clear();
+        result.put_u8(status_not_connected);
+        return result;
+    }
+}
+}
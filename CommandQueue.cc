@@ -0,0 +1,46 @@
+#include "include/CommandQueue.h"
+
+namespace nitrokey {
+
+    CommandQueue::CommandQueue() : m_state(std::make_shared<State>()) {
+        m_thread = std::thread(&CommandQueue::run, m_state);
+    }
+
+    CommandQueue::~CommandQueue() {
+        const bool from_worker = std::this_thread::get_id() == m_thread.get_id();
+        std::deque<std::function<void()>> dropped;
+        {
+            std::lock_guard<std::mutex> lock(m_state->mutex);
+            m_state->stop = true;
+            // joining itself is not possible, the jobs might use the destroyed owner
+            if (from_worker) dropped.swap(m_state->jobs);
+        }
+        m_state->cv.notify_one();
+        if (from_worker)
+            m_thread.detach();
+        else
+            m_thread.join();
+    }
+
+    void CommandQueue::push(std::function<void()> job) {
+        {
+            std::lock_guard<std::mutex> lock(m_state->mutex);
+            m_state->jobs.push_back(std::move(job));
+        }
+        m_state->cv.notify_one();
+    }
+
+    void CommandQueue::run(std::shared_ptr<State> state) {
+        for (;;) {
+            std::function<void()> job;
+            {
+                std::unique_lock<std::mutex> lock(state->mutex);
+                state->cv.wait(lock, [&state](){ return state->stop || !state->jobs.empty(); });
+                if (state->jobs.empty()) return; // stopped and drained
+                job = std::move(state->jobs.front());
+                state->jobs.pop_front();
+            }
+            job();
+        }
+    }
+}
@@ -0,0 +1,121 @@
+#include "include/DeviceDiscovery.h"
+#include "include/device_proto.h"
+#include "include/log.h"
+#include <algorithm>
+#ifdef __linux__
+#include <dirent.h>
+#endif
+
+namespace nitrokey {
+    using namespace nitrokey::log;
+
+    namespace {
+        struct KnownDevice {
+            uint16_t vid;
+            uint16_t pid;
+            DeviceModel model;
+            bool update_mode;
+        };
+
+        const KnownDevice known_devices[] = {
+                {0x20a0, 0x4108, DeviceModel::PRO, false},
+                {0x20a0, 0x4109, DeviceModel::STORAGE, false},
+                {STICK20_UPDATE_MODE_VID, STICK20_UPDATE_MODE_PID, DeviceModel::STORAGE, true},
+        };
+
+#ifdef __linux__
+        std::vector<std::string> directory_entries(const std::string &path) {
+            std::vector<std::string> entries;
+            DIR *dir = opendir(path.c_str());
+            if (dir == nullptr) return entries;
+            while (auto *entry = readdir(dir)) {
+                if (entry->d_name[0] != '.') entries.push_back(entry->d_name);
+            }
+            closedir(dir);
+            std::sort(entries.begin(), entries.end());
+            return entries;
+        }
+#endif
+    }
+
+    DeviceDiscovery &DeviceDiscovery::instance() {
+        static DeviceDiscovery discovery;
+        return discovery;
+    }
+
+    DeviceDiscovery::DeviceDiscovery()
+            : m_valid(false), m_refresh_interval(std::chrono::seconds(1)), m_enumeration_count(0) {
+    }
+
+    std::string DeviceDiscovery::hotplug_state() {
+        std::string state;
+#ifdef __linux__
+        // usbfs nodes are named by bus and device number, the latter is assigned anew on each plug in
+        const std::string root = "/dev/bus/usb";
+        for (auto &bus : directory_entries(root)) {
+            state += bus + ':';
+            for (auto &device : directory_entries(root + '/' + bus))
+                state += device + ',';
+            state += ';';
+        }
+#endif
+        return state;
+    }
+
+    std::vector<DeviceInfo> DeviceDiscovery::from_enumeration(const hid_device_info *devices) {
+        std::vector<DeviceInfo> found;
+        for (auto *cur = devices; cur != nullptr; cur = cur->next) {
+            for (auto &known : known_devices) {
+                if (cur->vendor_id != known.vid || cur->product_id != known.pid) continue;
+                std::wstring wserial = (cur->serial_number != nullptr) ? cur->serial_number : L"";
+                found.push_back({std::string(cur->path), std::string(wserial.begin(), wserial.end()),
+                                 known.model, known.update_mode, cur->interface_number});
+                break;
+            }
+        }
+        // Pro first, like the model order of NitrokeyManager::connect
+        std::stable_sort(found.begin(), found.end(), [](const DeviceInfo &a, const DeviceInfo &b) {
+            return a.model == DeviceModel::PRO && b.model != DeviceModel::PRO;
+        });
+        return found;
+    }
+
+    std::vector<DeviceInfo> DeviceDiscovery::get_devices(bool include_update_mode) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        const auto now = std::chrono::steady_clock::now();
+        const std::string state = hotplug_state();
+        const bool outdated = state.empty() ? now - m_enumerated > m_refresh_interval : state != m_hotplug_state;
+        if (!m_valid || outdated) {
+            auto *devices = hid_enumerate(0, 0);
+            m_devices = from_enumeration(devices);
+            hid_free_enumeration(devices);
+            m_hotplug_state = state;
+            m_enumerated = now;
+            m_valid = true;
+            m_enumeration_count++;
+            Log::instance().lazy([&]() {
+                return "Found " + std::to_string(m_devices.size()) + " Nitrokey devices";
+            }, Loglevel::DEBUG_L2);
+        }
+        if (include_update_mode) return m_devices;
+        std::vector<DeviceInfo> devices;
+        std::copy_if(m_devices.begin(), m_devices.end(), std::back_inserter(devices),
+                     [](const DeviceInfo &info) { return !info.update_mode; });
+        return devices;
+    }
+
+    void DeviceDiscovery::invalidate() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_valid = false;
+    }
+
+    void DeviceDiscovery::set_refresh_interval(std::chrono::milliseconds interval) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_refresh_interval = interval;
+    }
+
+    uint64_t DeviceDiscovery::get_enumeration_count() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        return m_enumeration_count;
+    }
+}
@@ -0,0 +1,158 @@
+#include "include/DevicePool.h"
+#include "include/DeviceDiscovery.h"
+#include "include/stick10_commands.h"
+#include <stdexcept>
+#include <vector>
+
+namespace nitrokey {
+    using namespace nitrokey::proto::stick10;
+    using namespace nitrokey::log;
+
+    DevicePool &DevicePool::instance() {
+        static DevicePool pool;
+        return pool;
+    }
+
+    DevicePool::DevicePool() : m_keep_alive_interval(std::chrono::seconds(1)) {
+    }
+
+    std::shared_ptr<Device> DevicePool::make_device(DeviceModel model) {
+        switch (model) {
+            case DeviceModel::PRO:
+                return std::make_shared<Stick10>();
+            case DeviceModel::STORAGE:
+                return std::make_shared<Stick20>();
+        }
+        throw std::runtime_error("Unknown model");
+    }
+
+    std::string DevicePool::key(const DeviceInfo &info) {
+        return info.serial.empty() ? info.path : info.serial;
+    }
+
+    std::vector<DevicePool::Candidate> DevicePool::candidates(
+            std::function<bool(const std::string &, const Entry &)> matches) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        std::vector<Candidate> found;
+        const auto now = std::chrono::steady_clock::now();
+        for (auto &entry : m_devices) {
+            if (!matches(entry.first, entry.second)) continue;
+            found.push_back({entry.second.device, now - entry.second.last_used > m_keep_alive_interval});
+            entry.second.last_used = now;
+        }
+        return found;
+    }
+
+    bool DevicePool::check(Candidate &candidate) {
+        auto &device = candidate.device;
+        // might wait for a command in progress, so called without the pool lock
+        auto lock = device->lock();
+        bool connected = true;
+        if (!device->is_connected()) {
+            connected = device->reconnect();
+        } else if (candidate.idle) {
+            try {
+                GetStatus::CommandTransaction::run(*device);
+            }
+            catch (std::runtime_error &e) {
+                Log::instance()("Pooled device " + device->get_path() + " does not respond, reconnecting",
+                                Loglevel::INFO);
+                connected = device->reconnect();
+            }
+        }
+        candidate.path = device->get_path();
+        return connected;
+    }
+
+    bool DevicePool::usable(Candidate &candidate) {
+        const bool connected = check(candidate);
+        std::lock_guard<std::mutex> lock(m_mutex);
+        for (auto it = m_devices.begin(); it != m_devices.end(); ++it) {
+            if (it->second.device != candidate.device) continue;
+            if (connected)
+                it->second.path = candidate.path;  // changed if reconnected
+            else
+                m_devices.erase(it);
+            break;
+        }
+        return connected;
+    }
+
+    std::shared_ptr<Device> DevicePool::open(const DeviceInfo &info) {
+        auto device = make_device(info.model);
+        if (!device->connect_with_path(info.path)) {
+            // the list might be outdated, e.g. the device was unplugged meanwhile
+            DeviceDiscovery::instance().invalidate();
+            return nullptr;
+        }
+        m_devices[key(info)] = Entry{info.model, info.path, device, std::chrono::steady_clock::now()};
+        return device;
+    }
+
+    std::shared_ptr<Device> DevicePool::get(DeviceModel model) {
+        for (auto &candidate : candidates([model](const std::string &, const Entry &entry) {
+            return entry.model == model;
+        })) {
+            if (usable(candidate)) return candidate.device;
+        }
+        std::lock_guard<std::mutex> lock(m_mutex);
+        for (auto &info : DeviceDiscovery::instance().get_devices()) {
+            if (info.model != model || m_devices.count(key(info)) != 0) continue;
+            auto device = open(info);
+            if (device != nullptr) return device;
+        }
+        return nullptr;
+    }
+
+    std::shared_ptr<Device> DevicePool::get_by_path(const std::string &path) {
+        for (auto &candidate : candidates([&path](const std::string &, const Entry &entry) {
+            return entry.path == path;
+        })) {
+            // the device might be found under another path now
+            if (usable(candidate) && candidate.path == path) return candidate.device;
+        }
+        std::lock_guard<std::mutex> lock(m_mutex);
+        for (auto &info : DeviceDiscovery::instance().get_devices()) {
+            if (info.path == path) return open(info);
+        }
+        return nullptr;
+    }
+
+    std::shared_ptr<Device> DevicePool::get_by_serial(const std::string &serial) {
+        for (auto &candidate : candidates([&serial](const std::string &key, const Entry &) {
+            return key == serial;
+        })) {
+            if (usable(candidate)) return candidate.device;
+        }
+        std::lock_guard<std::mutex> lock(m_mutex);
+        for (auto &info : DeviceDiscovery::instance().get_devices()) {
+            if (info.serial == serial) return open(info);
+        }
+        return nullptr;
+    }
+
+    bool DevicePool::release(const std::shared_ptr<Device> &device) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        for (auto &entry : m_devices) {
+            if (entry.second.device == device) {
+                entry.second.last_used = std::chrono::steady_clock::now();
+                return true;
+            }
+        }
+        return false;
+    }
+
+    void DevicePool::close_all() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        for (auto &entry : m_devices) {
+            auto device_lock = entry.second.device->lock();
+            entry.second.device->disconnect();
+        }
+        m_devices.clear();
+    }
+
+    void DevicePool::set_keep_alive_interval(std::chrono::milliseconds interval) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_keep_alive_interval = interval;
+    }
+}
@@ -1,19 +1,95 @@
+#include <algorithm>
 #include <cstring>
+#include <map>
+#include <mutex>
+#include <sstream>
 #include "NK_C_API.h"
+#include "include/async_log.h"
 #include "include/LibraryException.h"
+#include "include/OTPVerifier.h"
 
 using namespace nitrokey;
 
-static uint8_t NK_last_command_status = 0;
+// each thread sees the status of its own last command
+static thread_local uint8_t NK_last_command_status = 0;
 
+/*
+ * Managers of devices connected with NK_connect_by_path/NK_connect_by_serial,
+ * keyed by USB path. Each thread works with the device it connected last,
+ * or with the default NitrokeyManager::instance() if there was none.
+ */
+static std::mutex NK_sessions_mutex;
+static std::map<std::string, shared_ptr<NitrokeyManager>> NK_sessions;
+static thread_local shared_ptr<NitrokeyManager> NK_thread_manager = nullptr;
+
+static shared_ptr<NitrokeyManager> get_manager(){
+    if (NK_thread_manager != nullptr)
+        return NK_thread_manager;
+    return NitrokeyManager::instance();
+}
+
+// secrets registered for host-side OTP verification, shared by all threads and devices
+static OTPVerifier NK_otp_verifier;
+
+// set with NK_set_async_log
+static std::mutex NK_async_log_mutex;
+static unique_ptr<AsyncLogHandler> NK_async_log_handler;
+
+// built with NK_profile_* calls
+static thread_local DeviceProfile NK_profile;
+
+typedef void (*NK_metrics_callback)(const char *command, uint32_t time_us, uint32_t polls, uint8_t status,
+                                    void *user_data);
+
+class NK_metrics_handler : public metrics::MetricsHandler {
+public:
+    void set(NK_metrics_callback callback, void *user_data) {
+        std::lock_guard<std::mutex> lock(mutex);
+        this->callback = callback;
+        this->user_data = user_data;
+    }
+
+    virtual void record(proto::CommandID cmd, const metrics::CommandSample &sample) override {
+        NK_metrics_callback f;
+        void *data;
+        {
+            // commands of other threads might be running while the callback is changed
+            std::lock_guard<std::mutex> lock(mutex);
+            f = callback;
+            data = user_data;
+        }
+        if (f == nullptr) return;
+        f(proto::commandid_to_string(cmd), (uint32_t) sample.total_time.count(), sample.polls,
+          sample.failed ? 255 : sample.last_command_status, data);
+    }
+
+private:
+    std::mutex mutex;
+    NK_metrics_callback callback = nullptr;
+    void *user_data = nullptr;
+};
+static NK_metrics_handler NK_metrics_callback_handler;
+
+// malloc'ed, like the strdup'ed strings, so all results can be released with NK_free
 template <typename T>
 T* duplicate_vector_and_clear(std::vector<T> &v){
-    auto d = new T[v.size()];
+    auto d = static_cast<T*>(malloc(v.size() * sizeof(T)));
+    if (d == nullptr) throw std::bad_alloc();
     std::copy(v.begin(), v.end(), d);
     std::fill(v.begin(), v.end(), 0);
     return d;
 }
 
+template <typename T>
+static void copy_vector_and_clear(std::vector<T> &v, T *buffer, size_t buffer_size){
+    if (buffer == nullptr || buffer_size < v.size()){
+        std::fill(v.begin(), v.end(), 0);
+        throw TargetBufferSmallerThanSource(v.size(), buffer == nullptr ? 0 : buffer_size);
+    }
+    std::copy(v.begin(), v.end(), buffer);
+    std::fill(v.begin(), v.end(), 0);
+}
+
 template <typename T>
 uint8_t * get_with_array_result(T func){
     NK_last_command_status = 0;
@@ -26,9 +102,16 @@ uint8_t * get_with_array_result(T func){
     catch (LibraryException & libraryException){
         NK_last_command_status = libraryException.exception_id();
     }
+    // e.g. no response within the timing set with NK_set_timing
+    catch (std::runtime_error &e){
+        NK_last_command_status = DeviceCommunicationException(e.what()).exception_id();
+    }
     return nullptr;
 }
 
+// returned on errors instead of a heap string, ignored by NK_free
+static const char NK_empty_string[] = "";
+
 template <typename T>
 const char* get_with_string_result(T func){
     NK_last_command_status = 0;
@@ -41,7 +124,11 @@ const char* get_with_string_result(T func){
     catch (LibraryException & libraryException){
         NK_last_command_status = libraryException.exception_id();
     }
-    return "";
+    // e.g. no response within the timing set with NK_set_timing
+    catch (std::runtime_error &e){
+        NK_last_command_status = DeviceCommunicationException(e.what()).exception_id();
+    }
+    return NK_empty_string;
 }
 
 template <typename T>
@@ -56,6 +143,10 @@ auto get_with_result(T func){
     catch (LibraryException & libraryException){
         NK_last_command_status = libraryException.exception_id();
     }
+    // e.g. no response within the timing set with NK_set_timing
+    catch (std::runtime_error &e){
+        NK_last_command_status = DeviceCommunicationException(e.what()).exception_id();
+    }
     return static_cast<decltype(func())>(0);
 }
 
@@ -72,9 +163,64 @@ uint8_t get_without_result(T func){
     catch (LibraryException & libraryException){
         NK_last_command_status = libraryException.exception_id();
     }
+    // e.g. no response within the timing set with NK_set_timing
+    catch (std::runtime_error &e){
+        NK_last_command_status = DeviceCommunicationException(e.what()).exception_id();
+    }
     return NK_last_command_status;
 }
 
+/*
+ * Results of asynchronous requests submitted without a callback, waiting for NK_poll.
+ */
+struct NK_async_result {
+    bool done;
+    uint32_t result;
+    uint8_t status;
+};
+static std::mutex NK_async_mutex;
+static std::map<int, NK_async_result> NK_async_results;
+static int NK_async_last_id = 0;
+
+typedef void (*NK_completion_callback)(int request_id, uint32_t result, uint8_t status, void *user_data);
+
+template <typename T>
+int submit_with_result(T func, NK_completion_callback callback, void *user_data){
+    auto m = get_manager();
+    int request_id;
+    {
+        std::lock_guard<std::mutex> lock(NK_async_mutex);
+        request_id = ++NK_async_last_id;
+        if (callback == nullptr)
+            NK_async_results[request_id] = {false, 0, 0};
+    }
+    // the job must not own the manager, it would be destroyed on its own worker thread
+    std::weak_ptr<NitrokeyManager> weak_manager = m;
+    m->async([=](){
+        uint32_t result = 0;
+        try {
+            result = get_with_result([&](){
+                auto manager = weak_manager.lock();
+                // the manager is being destroyed, e.g. after NK_logout
+                if (manager == nullptr) throw DeviceNotConnectedException();
+                return func(manager);
+            });
+        }
+        catch (std::exception &e){
+            Log::instance()(std::string("Asynchronous request failed: ") + e.what(), Loglevel::ERROR);
+        }
+        // status of the command run by this worker thread
+        uint8_t status = NK_get_last_command_status();
+        if (callback != nullptr){
+            callback(request_id, result, status, user_data);
+            return;
+        }
+        std::lock_guard<std::mutex> lock(NK_async_mutex);
+        NK_async_results[request_id] = {true, result, status};
+    });
+    return request_id;
+}
+
 extern "C"
 {
 extern uint8_t NK_get_last_command_status(){
@@ -84,6 +230,7 @@ extern uint8_t NK_get_last_command_status(){
 }
 
 extern int NK_login(const char *device_model) {
+    NK_thread_manager = nullptr;
     auto m = NitrokeyManager::instance();
     try {
         NK_last_command_status = 0;
@@ -100,15 +247,112 @@ extern int NK_login(const char *device_model) {
     return 0;
 }
 
-extern int NK_logout() {
+extern int NK_set_simulation(uint32_t latency_ms, uint32_t busy_responses) {
+    auto m = get_manager();
+    return m->set_simulation_options({std::chrono::milliseconds(latency_ms), busy_responses}) ? 1 : 0;
+}
+
+extern int NK_login_replay(const char *trace_path, double time_scale) {
+    NK_thread_manager = nullptr;
     auto m = NitrokeyManager::instance();
+    try {
+        NK_last_command_status = 0;
+        return m->connect_replay(trace_path, time_scale);
+    }
+    catch (std::runtime_error &e){
+        cerr << e.what() << endl;
+        return 0;
+    }
+}
+
+extern int NK_start_recording(const char *trace_path) {
+    auto m = get_manager();
+    try {
+        m->start_recording(trace_path);
+        return 1;
+    }
+    catch (std::runtime_error &e){
+        cerr << e.what() << endl;
+        return 0;
+    }
+}
+
+extern void NK_stop_recording() {
+    auto m = get_manager();
+    m->stop_recording();
+}
+
+static TimingProfile make_timing(TimingProfile timing, uint32_t send_receive_delay_ms, uint32_t retry_count,
+                                 uint32_t retry_timeout_ms, uint32_t deadline_ms){
+    timing.send_receive_delay = std::chrono::milliseconds(send_receive_delay_ms);
+    timing.retry_count = (int) std::min<uint32_t>(retry_count, INT32_MAX);
+    timing.retry_timeout = std::chrono::milliseconds(retry_timeout_ms);
+    timing.deadline = std::chrono::milliseconds(deadline_ms);
+    return timing;
+}
+
+extern int NK_set_timing(uint32_t send_receive_delay_ms, uint32_t retry_count, uint32_t retry_timeout_ms,
+                         uint32_t deadline_ms) {
+    auto m = get_manager();
+    return get_without_result([&](){
+        m->set_timing(make_timing(m->get_timing(), send_receive_delay_ms, retry_count, retry_timeout_ms, deadline_ms));
+    });
+}
+
+extern int NK_get_timing(uint32_t *send_receive_delay_ms, uint32_t *retry_count, uint32_t *retry_timeout_ms,
+                         uint32_t *deadline_ms) {
+    auto m = get_manager();
+    return get_without_result([&](){
+        const auto timing = m->get_timing();
+        if (send_receive_delay_ms != nullptr) *send_receive_delay_ms = (uint32_t) timing.send_receive_delay.count();
+        if (retry_count != nullptr) *retry_count = (uint32_t) timing.retry_count;
+        if (retry_timeout_ms != nullptr) *retry_timeout_ms = (uint32_t) timing.retry_timeout.count();
+        if (deadline_ms != nullptr) *deadline_ms = (uint32_t) timing.deadline.count();
+    });
+}
+
+extern int NK_set_command_timing(uint8_t command_id, uint32_t send_receive_delay_ms, uint32_t retry_count,
+                                 uint32_t retry_timeout_ms, uint32_t deadline_ms) {
+    auto m = get_manager();
+    return get_without_result([&](){
+        const auto command = (CommandID) command_id;
+        m->set_command_timing(command, make_timing(m->get_timing(command), send_receive_delay_ms, retry_count,
+                                                   retry_timeout_ms, deadline_ms));
+    });
+}
+
+extern int NK_clear_command_timing() {
+    auto m = get_manager();
+    return get_without_result([&](){
+        m->clear_command_timing();
+    });
+}
+
+extern int NK_logout() {
+    auto m = get_manager();
+    if (NK_thread_manager != nullptr){
+        std::lock_guard<std::mutex> lock(NK_sessions_mutex);
+        for (auto it = NK_sessions.begin(); it != NK_sessions.end(); ++it){
+            if (it->second == m){
+                NK_sessions.erase(it);
+                break;
+            }
+        }
+        NK_thread_manager = nullptr;
+    }
     return get_without_result( [&](){
         m->disconnect();
     });
 }
 
+extern int NK_close_devices() {
+    return get_without_result( [&](){
+        DevicePool::instance().close_all();
+    });
+}
+
 extern int NK_first_authenticate(const char* admin_password, const char* admin_temporary_password){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result( [&](){
         return m->first_authenticate(admin_password, admin_temporary_password);
     });
@@ -116,27 +360,27 @@ extern int NK_first_authenticate(const char* admin_password, const char* admin_t
 
 
 extern int NK_user_authenticate(const char* user_password, const char* user_temporary_password){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result( [&](){
         m->user_authenticate(user_password, user_temporary_password);
     });
 }
 
 extern int NK_factory_reset(const char* admin_password){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result( [&](){
         m->factory_reset(admin_password);
     });
 }
 extern int NK_build_aes_key(const char* admin_password){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result( [&](){
         m->build_aes_key(admin_password);
     });
 }
 
 extern int NK_unlock_user_password(const char *admin_password, const char *new_user_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result( [&](){
         m->unlock_user_password(admin_password, new_user_password);
     });
@@ -145,7 +389,7 @@ extern int NK_unlock_user_password(const char *admin_password, const char *new_u
 extern int NK_write_config(uint8_t numlock, uint8_t capslock, uint8_t scrolllock, bool enable_user_password,
                            bool delete_user_password,
                            const char *admin_temporary_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result( [&](){
         return m->write_config(numlock, capslock, scrolllock, enable_user_password, delete_user_password, admin_temporary_password);
     });
@@ -153,7 +397,7 @@ extern int NK_write_config(uint8_t numlock, uint8_t capslock, uint8_t scrolllock
 
 
 extern uint8_t* NK_read_config(){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_array_result( [&](){
         auto v = m->read_config();
         return duplicate_vector_and_clear(v);
@@ -165,8 +409,47 @@ void clear_string(std::string &s){
     std::fill(s.begin(), s.end(), ' ');
 }
 
+static void copy_string_and_clear(std::string &s, char *buffer, size_t buffer_size){
+    if (buffer == nullptr || buffer_size < s.size() + 1){
+        clear_string(s);
+        throw TargetBufferSmallerThanSource(s.size() + 1, buffer == nullptr ? 0 : buffer_size);
+    }
+    std::copy(s.begin(), s.end(), buffer);
+    buffer[s.size()] = 0;
+    clear_string(s);
+}
+
+extern void NK_free(void *result){
+    if (result != NK_empty_string)
+        free(result);
+}
+
+extern int NK_read_config_into(uint8_t *config, size_t config_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        auto v = m->read_config();
+        copy_vector_and_clear(v, config, config_size);
+    });
+}
+
+extern int NK_status_into(char *buffer, size_t buffer_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        string s = m->get_status();
+        copy_string_and_clear(s, buffer, buffer_size);
+    });
+}
+
+extern int NK_device_serial_number_into(char *buffer, size_t buffer_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        string s = m->get_serial_number();
+        copy_string_and_clear(s, buffer, buffer_size);
+    });
+}
+
 extern const char * NK_status() {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_string_result([&](){
         string && s = m->get_status();
         char * rs = strdup(s.c_str());
@@ -176,7 +459,7 @@ extern const char * NK_status() {
 }
 
 extern const char * NK_device_serial_number(){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_string_result([&](){
         string && s = m->get_serial_number();
         char * rs = strdup(s.c_str());
@@ -190,7 +473,7 @@ extern uint32_t NK_get_hotp_code(uint8_t slot_number) {
 }
 
 extern uint32_t NK_get_hotp_code_PIN(uint8_t slot_number, const char* user_temporary_password){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_result([&](){
         return m->get_HOTP_code(slot_number, user_temporary_password);
     });
@@ -203,21 +486,21 @@ extern uint32_t NK_get_totp_code(uint8_t slot_number, uint64_t challenge, uint64
 
 extern uint32_t NK_get_totp_code_PIN(uint8_t slot_number, uint64_t challenge, uint64_t last_totp_time,
                                  uint8_t last_interval, const char* user_temporary_password){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_result([&](){
         return m->get_TOTP_code(slot_number, challenge, last_totp_time, last_interval, user_temporary_password);
     });
 }
 
 extern int NK_erase_hotp_slot(uint8_t slot_number, const char *temporary_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&]{
         m->erase_hotp_slot(slot_number, temporary_password);
     });
 }
 
 extern int NK_erase_totp_slot(uint8_t slot_number, const char *temporary_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&]{
         m->erase_totp_slot(slot_number, temporary_password);
     });
@@ -226,7 +509,7 @@ extern int NK_erase_totp_slot(uint8_t slot_number, const char *temporary_passwor
 extern int NK_write_hotp_slot(uint8_t slot_number, const char *slot_name, const char *secret, uint8_t hotp_counter,
                               bool use_8_digits, bool use_enter, bool use_tokenID, const char *token_ID,
                               const char *temporary_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&]{
         m->write_HOTP_slot(slot_number, slot_name, secret, hotp_counter, use_8_digits, use_enter, use_tokenID, token_ID,
                            temporary_password);
@@ -236,7 +519,7 @@ extern int NK_write_hotp_slot(uint8_t slot_number, const char *slot_name, const
 extern int NK_write_totp_slot(uint8_t slot_number, const char *slot_name, const char *secret, uint16_t time_window,
                               bool use_8_digits, bool use_enter, bool use_tokenID, const char *token_ID,
                               const char *temporary_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&]{
         m->write_TOTP_slot(slot_number, slot_name, secret, time_window, use_8_digits, use_enter, use_tokenID, token_ID,
                            temporary_password);
@@ -244,61 +527,244 @@ extern int NK_write_totp_slot(uint8_t slot_number, const char *slot_name, const
 }
 
 extern const char* NK_get_totp_slot_name(uint8_t slot_number){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_string_result([&]() {
         const auto slot_name = m->get_totp_slot_name(slot_number);
         return slot_name;
     });
 }
 extern const char* NK_get_hotp_slot_name(uint8_t slot_number){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_string_result([&]() {
         const auto slot_name = m->get_hotp_slot_name(slot_number);
         return slot_name;
     });
 }
 
+extern int NK_get_totp_slot_name_into(uint8_t slot_number, char *buffer, size_t buffer_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        m->get_totp_slot_name(slot_number, buffer, buffer_size);
+    });
+}
+
+extern int NK_get_hotp_slot_name_into(uint8_t slot_number, char *buffer, size_t buffer_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        m->get_hotp_slot_name(slot_number, buffer, buffer_size);
+    });
+}
+
+extern int NK_get_all_slot_names(char *buffer, size_t buffer_size, uint8_t *statuses){
+    auto m = get_manager();
+    return get_without_result([&](){
+        const size_t name_size = 16; // 15 characters and terminating null
+        const size_t slot_count = HOTP_SLOT_COUNT + TOTP_SLOT_COUNT;
+        if (buffer_size < slot_count * name_size)
+            throw TargetBufferSmallerThanSource(slot_count * name_size, buffer_size);
+        vector<uint8_t> slot_statuses;
+        auto names = m->get_all_slot_names(slot_statuses);
+        std::fill(buffer, buffer + slot_count * name_size, 0);
+        for (size_t i = 0; i < slot_count; i++){
+            strncpy(buffer + i * name_size, names[i].c_str(), name_size - 1);
+            if (statuses != nullptr) statuses[i] = slot_statuses[i];
+        }
+    });
+}
+
+extern int NK_get_totp_codes(const uint8_t *slot_numbers, size_t count, uint64_t challenge,
+                             uint64_t last_totp_time, uint8_t last_interval,
+                             const char *user_temporary_password, uint32_t *codes, uint8_t *statuses){
+    auto m = get_manager();
+    return get_without_result([&](){
+        vector<uint8_t> slots(slot_numbers, slot_numbers + count);
+        vector<uint8_t> slot_statuses;
+        auto c = m->get_TOTP_codes(slots, challenge, last_totp_time, last_interval, user_temporary_password,
+                                   slot_statuses);
+        std::copy(c.begin(), c.end(), codes);
+        if (statuses != nullptr)
+            std::copy(slot_statuses.begin(), slot_statuses.end(), statuses);
+    });
+}
+
+extern uint32_t NK_get_current_totp_code(uint8_t slot_number, uint16_t time_window,
+                                         const char *user_temporary_password){
+    auto m = get_manager();
+    return get_with_result([&](){
+        return m->get_TOTP_service().get_code(slot_number, time_window, user_temporary_password);
+    });
+}
+
+extern void NK_get_current_totp_code_statistics(uint64_t *hits, uint64_t *device_reads){
+    auto m = get_manager();
+    auto statistics = m->get_TOTP_service().get_statistics();
+    if (hits != nullptr) *hits = statistics.hits;
+    if (device_reads != nullptr) *device_reads = statistics.device_reads;
+}
+
+extern int NK_otp_add_secret(const char *secret, uint8_t algorithm, bool use_8_digits){
+    return get_with_result([&](){
+        return NK_otp_verifier.add_secret(secret, static_cast<OTPAlgorithm>(algorithm), use_8_digits);
+    });
+}
+
+extern int NK_otp_remove_secret(int secret_id){
+    return NK_otp_verifier.remove_secret(secret_id) ? 1 : 0;
+}
+
+extern int NK_otp_verify_hotp(int secret_id, uint32_t code, uint64_t counter, uint32_t look_ahead,
+                              uint64_t *matched_counter){
+    return get_with_result([&](){
+        auto matched = NK_otp_verifier.verify_HOTP(secret_id, code, counter, look_ahead);
+        if (matched == OTPVerifier::no_match)
+            return 0;
+        if (matched_counter != nullptr) *matched_counter = static_cast<uint64_t>(matched);
+        return 1;
+    });
+}
+
+extern int NK_otp_verify_totp(int secret_id, uint32_t code, uint64_t time, uint16_t time_step, uint8_t window,
+                              uint64_t *matched_step){
+    return get_with_result([&](){
+        auto matched = NK_otp_verifier.verify_TOTP(secret_id, code, time, time_step, window);
+        if (matched == OTPVerifier::no_match)
+            return 0;
+        if (matched_step != nullptr) *matched_step = static_cast<uint64_t>(matched);
+        return 1;
+    });
+}
+
+extern size_t NK_otp_verify_totp_codes(const int *secret_ids, const uint32_t *codes, size_t count, uint64_t time,
+                                       uint16_t time_step, uint8_t window, int64_t *matched_steps){
+    return get_with_result([&](){
+        vector<OTPVerifier::TOTPRequest> requests(count);
+        for (size_t i = 0; i < count; i++) {
+            requests[i] = {secret_ids[i], codes[i]};
+        }
+        auto matched = NK_otp_verifier.verify_TOTP(requests, time, time_step, window);
+        if (matched_steps != nullptr)
+            std::copy(matched.begin(), matched.end(), matched_steps);
+        return static_cast<size_t>(std::count_if(matched.begin(), matched.end(),
+                                                 [](int64_t m){ return m != OTPVerifier::no_match; }));
+    });
+}
+
 extern void NK_set_debug(bool state){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     m->set_debug(state);
 }
 
+extern int NK_set_async_log(const char *path){
+    unique_ptr<LogSink> sink;
+    if (path == nullptr || strlen(path) == 0){
+        sink.reset(new StreamLogSink(std::clog));
+    } else {
+        auto file_sink = new JsonLinesLogSink(path);
+        sink.reset(file_sink);
+        if (!file_sink->is_open())
+            return 0;
+    }
+    std::lock_guard<std::mutex> lock(NK_async_log_mutex);
+    auto previous = std::move(NK_async_log_handler);
+    NK_async_log_handler.reset(new AsyncLogHandler(std::move(sink)));
+    // no thread prints with the previous handler once it is replaced, so it is destroyed only afterwards
+    Log::instance().set_handler(NK_async_log_handler.get());
+    return 1;
+}
+
+extern void NK_set_sync_log(){
+    std::lock_guard<std::mutex> lock(NK_async_log_mutex);
+    Log::instance().set_handler(&stdlog_handler);
+    NK_async_log_handler.reset();
+}
+
+extern void NK_set_cache(bool enabled){
+    auto m = get_manager();
+    m->set_cache_enabled(enabled);
+}
+
+extern void NK_get_cache_statistics(uint64_t *hits, uint64_t *misses){
+    auto m = get_manager();
+    uint64_t h, mi;
+    m->get_cache_statistics(h, mi);
+    if (hits != nullptr) *hits = h;
+    if (misses != nullptr) *misses = mi;
+}
+
+extern void NK_reset_cache_statistics(){
+    auto m = get_manager();
+    m->reset_cache_statistics();
+}
+
+extern void NK_set_metrics(bool enabled){
+    metrics::Metrics::instance().set_enabled(enabled);
+}
+
+extern const char * NK_get_metrics(){
+    return get_with_string_result([&](){
+        std::stringstream ss;
+        for (auto & entry : metrics::Metrics::instance().snapshot()){
+            auto & m = entry.second;
+            ss << proto::commandid_to_string(entry.first) << '\t' << m.commands << '\t' << m.failures
+               << '\t' << m.command_errors << '\t' << m.polls << '\t' << m.busy_responses
+               << '\t' << m.crc_mismatches << '\t' << m.recv_retries << '\t' << m.send_time.count()
+               << '\t' << m.first_poll_delay.count() << '\t' << m.total_time.count()
+               << '\t' << m.max_time.count() << '\t';
+            for (size_t i = 0; i < m.latency_histogram.size(); i++){
+                ss << (i == 0 ? "" : ",") << m.latency_histogram[i];
+            }
+            ss << '\n';
+        }
+        return strdup(ss.str().c_str());
+    });
+}
+
+extern void NK_reset_metrics(){
+    metrics::Metrics::instance().reset();
+}
+
+extern void NK_set_metrics_callback(NK_metrics_callback callback, void *user_data){
+    // the handler is static, so it stays valid for commands still using it
+    NK_metrics_callback_handler.set(callback, user_data);
+    metrics::Metrics::instance().set_handler(callback != nullptr ? &NK_metrics_callback_handler : nullptr);
+}
+
 extern int NK_totp_set_time(uint64_t time){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->set_time(time);
     });
 }
 
 extern int NK_totp_get_time(){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->get_time(); // FIXME check how that should work
     });
 }
 
 extern int NK_change_admin_PIN(char *current_PIN, char *new_PIN){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->change_admin_PIN(current_PIN, new_PIN);
     });
 }
 
 extern int NK_change_user_PIN(char *current_PIN, char *new_PIN){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->change_user_PIN(current_PIN, new_PIN);
     });
 }
 
 extern int NK_enable_password_safe(const char *user_pin){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->enable_password_safe(user_pin);
     });
 }
 extern uint8_t * NK_get_password_safe_slot_status(){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_array_result( [&](){
         auto slot_status = m->get_password_safe_slot_status();
         return duplicate_vector_and_clear(slot_status);
@@ -306,74 +772,279 @@ extern uint8_t * NK_get_password_safe_slot_status(){
 
 }
 
+extern int NK_get_password_safe_slot_status_into(uint8_t *status, size_t status_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        auto slot_status = m->get_password_safe_slot_status();
+        copy_vector_and_clear(slot_status, status, status_size);
+    });
+}
+
 extern uint8_t NK_get_user_retry_count(){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_result([&](){
         return m->get_user_retry_count();
     });
 }
 
 extern uint8_t NK_get_admin_retry_count(){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_result([&](){
         return m->get_admin_retry_count();
     });
 }
 
 extern int NK_lock_device(){
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->lock_device();
     });
 }
 
 extern const char *NK_get_password_safe_slot_name(uint8_t slot_number) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_string_result([&](){
         return m->get_password_safe_slot_name(slot_number);
     });
 }
 
 extern const char *NK_get_password_safe_slot_login(uint8_t slot_number) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_string_result([&](){
         return m->get_password_safe_slot_login(slot_number);
     });
 }
 extern const char *NK_get_password_safe_slot_password(uint8_t slot_number) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_string_result([&](){
         return m->get_password_safe_slot_password(slot_number);
     });
 }
+extern int NK_get_password_safe_slot_name_into(uint8_t slot_number, char *buffer, size_t buffer_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        m->get_password_safe_slot_name(slot_number, buffer, buffer_size);
+    });
+}
+
+extern int NK_get_password_safe_slot_login_into(uint8_t slot_number, char *buffer, size_t buffer_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        m->get_password_safe_slot_login(slot_number, buffer, buffer_size);
+    });
+}
+
+extern int NK_get_password_safe_slot_password_into(uint8_t slot_number, char *buffer, size_t buffer_size){
+    auto m = get_manager();
+    return get_without_result([&](){
+        m->get_password_safe_slot_password(slot_number, buffer, buffer_size);
+    });
+}
+
 extern int NK_write_password_safe_slot(uint8_t slot_number, const char *slot_name, const char *slot_login,
                                        const char *slot_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->write_password_safe_slot(slot_number, slot_name, slot_login, slot_password);
     });
 }
 
+static_assert(sizeof(NitrokeyManager::PasswordSafeSlot) == 66, "documented in NK_get_password_safe_slots");
+
+extern int NK_get_password_safe_slots(char *buffer, size_t buffer_size, uint8_t *slot_status) {
+    auto m = get_manager();
+    return get_without_result([&](){
+        const size_t size = PWS_SLOT_COUNT * sizeof(NitrokeyManager::PasswordSafeSlot);
+        if (buffer == nullptr || buffer_size < size){
+            throw TargetBufferSmallerThanSource(size, buffer == nullptr ? 0 : buffer_size);
+        }
+        auto status = m->get_password_safe_slots(reinterpret_cast<NitrokeyManager::PasswordSafeSlot *>(buffer));
+        if (slot_status != nullptr)
+            std::copy(status.begin(), status.end(), slot_status);
+    });
+}
+
+extern int NK_write_password_safe_slots(const char *buffer, size_t buffer_size, const uint8_t *slot_status) {
+    auto m = get_manager();
+    return get_without_result([&](){
+        const size_t size = PWS_SLOT_COUNT * sizeof(NitrokeyManager::PasswordSafeSlot);
+        if (buffer == nullptr || buffer_size < size){
+            throw TargetBufferSmallerThanSource(size, buffer == nullptr ? 0 : buffer_size);
+        }
+        if (slot_status == nullptr){
+            throw TargetBufferSmallerThanSource(PWS_SLOT_COUNT, 0);
+        }
+        m->write_password_safe_slots(reinterpret_cast<const NitrokeyManager::PasswordSafeSlot *>(buffer),
+                                     vector<uint8_t>(slot_status, slot_status + PWS_SLOT_COUNT));
+    });
+}
+
 extern int NK_erase_password_safe_slot(uint8_t slot_number) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_without_result([&](){
         m->erase_password_safe_slot(slot_number);
     });
 }
 
 extern int NK_is_AES_supported(const char *user_password) {
-    auto m = NitrokeyManager::instance();
+    auto m = get_manager();
     return get_with_result([&](){
        return (uint8_t) m->is_AES_supported(user_password);
     });
 }
 
 extern int NK_login_auto() {
+    NK_thread_manager = nullptr;
     auto m = NitrokeyManager::instance();
     return get_with_result([&](){
         return (uint8_t) m->connect();
     });
 }
 
+extern int NK_submit_get_hotp_code(uint8_t slot_number, const char *user_temporary_password,
+                                   NK_completion_callback callback, void *user_data){
+    string password = user_temporary_password != nullptr ? user_temporary_password : "";
+    return submit_with_result([=](shared_ptr<NitrokeyManager> m){
+        return m->get_HOTP_code(slot_number, password.c_str());
+    }, callback, user_data);
+}
+
+extern int NK_submit_get_totp_code(uint8_t slot_number, uint64_t challenge, uint64_t last_totp_time,
+                                   uint8_t last_interval, const char *user_temporary_password,
+                                   NK_completion_callback callback, void *user_data){
+    string password = user_temporary_password != nullptr ? user_temporary_password : "";
+    return submit_with_result([=](shared_ptr<NitrokeyManager> m){
+        return m->get_TOTP_code(slot_number, challenge, last_totp_time, last_interval, password.c_str());
+    }, callback, user_data);
+}
+
+extern int NK_poll(int request_id, uint32_t *result, uint8_t *status){
+    std::lock_guard<std::mutex> lock(NK_async_mutex);
+    auto it = NK_async_results.find(request_id);
+    if (it == NK_async_results.end())
+        return -1;
+    if (!it->second.done)
+        return 0;
+    if (result != nullptr) *result = it->second.result;
+    if (status != nullptr) *status = it->second.status;
+    NK_async_results.erase(it);
+    return 1;
+}
+
+extern const char * NK_list_devices(){
+    return get_with_string_result([&](){
+        std::stringstream ss;
+        for (auto & info : NitrokeyManager::list_devices()){
+            char model = info.model == DeviceModel::PRO ? 'P' : 'S';
+            ss << model << '\t' << info.serial << '\t' << info.path << '\n';
+        }
+        return strdup(ss.str().c_str());
+    });
+}
+
+extern const char * NK_list_all_devices(){
+    return get_with_string_result([&](){
+        std::stringstream ss;
+        for (auto & info : NitrokeyManager::list_devices(true)){
+            char model = info.update_mode ? 'U' : info.model == DeviceModel::PRO ? 'P' : 'S';
+            ss << model << '\t' << info.serial << '\t' << info.path << '\t' << info.interface_number << '\n';
+        }
+        return strdup(ss.str().c_str());
+    });
 }
 
+extern int NK_connect_by_path(const char *path){
+    NK_last_command_status = 0;
+    std::lock_guard<std::mutex> lock(NK_sessions_mutex);
+    auto it = NK_sessions.find(path);
+    if (it != NK_sessions.end()){
+        NK_thread_manager = it->second;
+        return 1;
+    }
+    auto m = make_shared<NitrokeyManager>();
+    if (!m->connect_with_path(path))
+        return 0;
+    NK_sessions[path] = m;
+    NK_thread_manager = m;
+    return 1;
+}
+
+extern int NK_connect_by_serial(const char *serial){
+    for (auto & info : NitrokeyManager::list_devices()){
+        if (info.serial == serial){
+            return NK_connect_by_path(info.path.c_str());
+        }
+    }
+    NK_last_command_status = 0;
+    return 0;
+}
+
+extern void NK_profile_clear(){
+    NK_profile.clear();
+}
+
+extern void NK_profile_set_config(uint8_t numlock, uint8_t capslock, uint8_t scrolllock, bool enable_user_password,
+                                  bool delete_user_password){
+    NK_profile.set_config = true;
+    NK_profile.config = {numlock, capslock, scrolllock, enable_user_password, delete_user_password};
+}
+
+// strings are constructed in the profile items, no temporary copies of the secrets are left
+static const char *string_or_empty(const char *s){
+    return s != nullptr ? s : "";
+}
+
+extern int NK_profile_add_hotp_slot(uint8_t slot_number, const char *slot_name, const char *secret,
+                                    uint8_t hotp_counter, bool use_8_digits, bool use_enter, bool use_tokenID,
+                                    const char *token_ID, bool skip_if_unchanged){
+    return get_without_result([&](){
+        if (slot_number >= HOTP_SLOT_COUNT) throw InvalidSlotException(slot_number);
+        NK_profile.hotp_slots.push_back({slot_number, string_or_empty(slot_name), string_or_empty(secret),
+                                         use_8_digits, use_enter, use_tokenID, string_or_empty(token_ID),
+                                         hotp_counter, 0, skip_if_unchanged});
+    });
+}
+
+extern int NK_profile_add_totp_slot(uint8_t slot_number, const char *slot_name, const char *secret,
+                                    uint16_t time_window, bool use_8_digits, bool use_enter, bool use_tokenID,
+                                    const char *token_ID, bool skip_if_unchanged){
+    return get_without_result([&](){
+        if (slot_number >= TOTP_SLOT_COUNT) throw InvalidSlotException(slot_number);
+        NK_profile.totp_slots.push_back({slot_number, string_or_empty(slot_name), string_or_empty(secret),
+                                         use_8_digits, use_enter, use_tokenID, string_or_empty(token_ID),
+                                         0, time_window, skip_if_unchanged});
+    });
+}
+
+extern int NK_profile_add_password_safe_slot(uint8_t slot_number, const char *slot_name, const char *slot_login,
+                                             const char *slot_password){
+    return get_without_result([&](){
+        if (slot_number >= PWS_SLOT_COUNT) throw InvalidSlotException(slot_number);
+        NK_profile.password_safe_slots.push_back({slot_number, string_or_empty(slot_name),
+                                                  string_or_empty(slot_login), string_or_empty(slot_password)});
+    });
+}
+
+extern int NK_profile_apply(const char *admin_pin, const char *user_pin, const char *admin_temporary_password,
+                            uint8_t *statuses, uint8_t *written, size_t size){
+    auto m = get_manager();
+    uint8_t first_error = 0;
+    const uint8_t status = get_without_result([&](){
+        const size_t items = NK_profile.size();
+        if (statuses == nullptr || written == nullptr || size < items)
+            throw TargetBufferSmallerThanSource(items, statuses == nullptr || written == nullptr ? 0 : size);
+        auto results = m->apply_profile(NK_profile, admin_pin, user_pin, admin_temporary_password);
+        NK_profile.clear();
+        for (size_t i = 0; i < results.size(); i++){
+            statuses[i] = results[i].status;
+            written[i] = (uint8_t) results[i].written;
+            if (first_error == 0) first_error = results[i].status;
+        }
+    });
+    if (status != 0)
+        return status;
+    NK_last_command_status = first_error;
+    return first_error;
+}
+
+}
@@ -15,12 +15,147 @@ extern "C"
 extern void NK_set_debug(bool state);
 
 /**
- * Connect to device of given model. Currently library can be connected only to one device at once.
- * @param device_model char 'S': Nitrokey Storage, 'P': Nitrokey Pro
+ * Write log messages from a background thread, so logging does not delay the commands. Messages are buffered
+ * and written in batches; when the buffer is full, new messages are dropped and their number is reported.
+ * @param path file to append the messages to as JSON lines, or NULL or empty string for text on stderr
+ * @return 1 if enabled, 0 if the file cannot be opened
+ */
+extern int NK_set_async_log(const char *path);
+
+/**
+ * Write the buffered messages and go back to writing log messages on stderr from the calling thread.
+ */
+extern void NK_set_sync_log();
+
+/**
+ * Enable or disable caching of rarely changing data read from the device used by the current thread:
+ * OTP slot names, password safe slot status, configuration and serial number. The cache is cleared by
+ * commands changing this data (writing and erasing slots, writing config, locking the device,
+ * factory reset, AES key generation) and by connecting or disconnecting. Disabled by default.
+ * @param enabled true to enable the cache
+ */
+extern void NK_set_cache(bool enabled);
+
+/**
+ * Get cache usage counters for the device used by the current thread.
+ * @param hits pointer for number of queries served from the cache
+ * @param misses pointer for number of queries sent to the device while the cache was enabled
+ */
+extern void NK_get_cache_statistics(uint64_t *hits, uint64_t *misses);
+
+/**
+ * Reset cache usage counters for the device used by the current thread.
+ */
+extern void NK_reset_cache_statistics();
+
+/**
+ * Enable or disable collecting per-command metrics of all devices. Enabled by default.
+ */
+extern void NK_set_metrics(bool enabled);
+
+/**
+ * Snapshot of the metrics collected since the last reset, for all devices.
+ * @return string with one line per command run: command name, number of transactions, communication
+ * failures, responses with error status, polls, busy responses, CRC mismatches (responses to another
+ * command), retried HID reads, total send time, total wait before the first poll, total time and maximal
+ * time (all times in microseconds), and comma separated latency histogram, where bucket i counts
+ * transactions taking less than 2^i ms and the last bucket all slower ones; separated with tab characters
+ */
+extern const char * NK_get_metrics();
+
+/**
+ * Clear the collected metrics.
+ */
+extern void NK_reset_metrics();
+
+/**
+ * Set function called after each transaction, e.g. to export metrics as they are collected.
+ * Called from the thread running the command while it holds the device, so it must not block nor call
+ * the library. It might still be called once by commands in progress after it was replaced or disabled.
+ * @param callback called with the command name, time from sending to response in microseconds,
+ * number of polls, last command status or 255 on communication failure, and user_data; NULL to disable
+ * @param user_data pointer passed back to the callback
+ */
+extern void NK_set_metrics_callback(void (*callback)(const char *command, uint32_t time_us, uint32_t polls,
+                                                     uint8_t status, void *user_data), void *user_data);
+
+/**
+ * Connect to device of given model. The connection is shared by all threads which did not connect
+ * to a particular device with NK_connect_by_path or NK_connect_by_serial.
+ * @param device_model char 'S': Nitrokey Storage, 'P': Nitrokey Pro, or string "sim" (same as "sim-pro")
+ * or "sim-storage" for an in-process simulated device, which needs no hardware
  * @return 1 if connected, 0 if wrong model or cannot connect
  */
 extern int NK_login(const char *device_model);
 
+/**
+ * Set timing of the simulated device connected with NK_login("sim").
+ * @param latency_ms time after which the response to each command is ready
+ * @param busy_responses number of polls answered with busy status for each command, in addition to latency
+ * @return 1 if set, 0 if the connected device is not simulated
+ */
+extern int NK_set_simulation(uint32_t latency_ms, uint32_t busy_responses);
+
+/**
+ * Connect to a device answering with the responses recorded with NK_start_recording. Commands have to be
+ * sent in the recorded order. The connection is shared like with NK_login.
+ * @param trace_path trace file
+ * @param time_scale multiplies the recorded response times, e.g. 1.0 for the original timing,
+ * 0 to answer immediately
+ * @return 1 if connected, 0 if the file is not a trace
+ */
+extern int NK_login_replay(const char *trace_path, double time_scale);
+
+/**
+ * Record all HID reports exchanged with the device used by the current thread, with timestamps,
+ * into a trace file. Recording continues at the end of an existing trace.
+ * Reports contain PINs and secrets as sent to the device, keep the file private.
+ * @param trace_path trace file
+ * @return 1 if recording, 0 if the file can't be used
+ */
+extern int NK_start_recording(const char *trace_path);
+
+/**
+ * Stop recording started with NK_start_recording and close the trace file.
+ */
+extern void NK_stop_recording();
+
+/**
+ * Set response polling of the device used by the current thread, for all commands without their own timing.
+ * A command fails when there is no response after retry_count polls or after the deadline, whichever
+ * comes first, with library error 207 (device communication error).
+ * Defaults: Pro 100 ms, 100 polls, 100 ms, 10 s; Storage 1000 ms, 40 polls, 500 ms, 20 s.
+ * @param send_receive_delay_ms upper bound of the wait before the first poll
+ * @param retry_count maximal number of polls
+ * @param retry_timeout_ms upper bound of the wait between following polls
+ * @param deadline_ms maximal time from sending the command to its response, 0 for none
+ * @return command processing error code
+ */
+extern int NK_set_timing(uint32_t send_receive_delay_ms, uint32_t retry_count, uint32_t retry_timeout_ms,
+                         uint32_t deadline_ms);
+
+/**
+ * Get response polling of the device used by the current thread, as set with NK_set_timing or the model's defaults.
+ * Pointers may be NULL.
+ * @return command processing error code
+ */
+extern int NK_get_timing(uint32_t *send_receive_delay_ms, uint32_t *retry_count, uint32_t *retry_timeout_ms,
+                         uint32_t *deadline_ms);
+
+/**
+ * Set response polling of a single command, @see NK_set_timing
+ * @param command_id command code, as in the device protocol (e.g. 0 for status)
+ * @return command processing error code
+ */
+extern int NK_set_command_timing(uint8_t command_id, uint32_t send_receive_delay_ms, uint32_t retry_count,
+                                 uint32_t retry_timeout_ms, uint32_t deadline_ms);
+
+/**
+ * Remove timing set with NK_set_command_timing.
+ * @return command processing error code
+ */
+extern int NK_clear_command_timing();
+
 /**
  * Connect to first available device, starting checking from Pro 1st to Storage 2nd.
  * @return 1 if connected, 0 if wrong model or cannot connect
@@ -28,11 +163,52 @@ extern int NK_login(const char *device_model);
 extern int NK_login_auto();
 
 /**
- * Disconnect from the device.
+ * List all connected Nitrokey devices.
+ * @return string with one line per device: model ('P' or 'S', like in NK_login), USB serial number
+ * and USB path, separated with tab characters
+ */
+extern const char * NK_list_devices();
+
+/**
+ * List all connected Nitrokey devices including Storage devices in firmware update mode,
+ * which cannot be connected.
+ * @return string with one line per device: model ('P', 'S', or 'U' for Storage in update mode), USB serial
+ * number, USB path and USB interface number (-1 if not known), separated with tab characters
+ */
+extern const char * NK_list_all_devices();
+
+/**
+ * Connect to the device under given USB path (@see NK_list_devices). All following commands called
+ * from the current thread are sent to this device, other threads might use other devices at the same time.
+ * Calling it again for already connected path switches the current thread to that device without reconnecting.
+ * @param path USB path of the device
+ * @return 1 if connected, 0 if device was not found or cannot connect
+ */
+extern int NK_connect_by_path(const char *path);
+
+/**
+ * Connect to the device with given USB serial number (@see NK_list_devices).
+ * Works like NK_connect_by_path.
+ * @param serial USB serial number of the device
+ * @return 1 if connected, 0 if device was not found or cannot connect
+ */
+extern int NK_connect_by_serial(const char *serial);
+
+/**
+ * Disconnect from the device used by the current thread.
+ * Nitrokey Pro and Storage devices stay open, so logging in again does not reopen them
+ * (@see NK_close_devices).
  * @return command processing error code
  */
 extern int NK_logout();
 
+/**
+ * Close all devices kept open after NK_logout, e.g. before unloading the library.
+ * Threads still connected to a device have to log in again.
+ * @return command processing error code
+ */
+extern int NK_close_devices();
+
 /**
  * Return the debug status string. Debug purposes.
  * @return command processing error code
@@ -45,10 +221,34 @@ extern const char * NK_status();
  */
 extern const char * NK_device_serial_number();
 
+/**
+ * Release a string or array returned by the library (NK_status, NK_get_*_slot_name, NK_read_config etc.).
+ * The *_into variants of these functions write into caller's buffers and need no releasing.
+ * @param result pointer returned by the library, can be NULL
+ */
+extern void NK_free(void *result);
+
+/**
+ * Write the debug status string into the buffer. Like NK_status, without allocation.
+ * @param buffer buffer for the null-terminated string
+ * @param buffer_size size of the buffer
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_status_into(char *buffer, size_t buffer_size);
+
+/**
+ * Write the device's serial number string in hex into the buffer. Like NK_device_serial_number,
+ * without allocation.
+ * @param buffer buffer for the null-terminated string
+ * @param buffer_size size of the buffer
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_device_serial_number_into(char *buffer, size_t buffer_size);
+
 /**
  * Get last command processing status. Useful for commands which returns the results of their own and could not return
- * an error code.
- * @return previous command processing error code
+ * an error code. The status is kept separately for each thread.
+ * @return previous command processing error code of the calling thread
  */
 extern uint8_t NK_get_last_command_status();
 
@@ -122,6 +322,14 @@ extern int NK_write_config(uint8_t numlock, uint8_t capslock, uint8_t scrolllock
  */
 extern uint8_t* NK_read_config();
 
+/**
+ * Read the device configuration into the buffer. Like NK_read_config, without allocation.
+ * @param config uint8_t[5] for the configuration, ordered as in NK_read_config
+ * @param config_size size of the buffer
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_read_config_into(uint8_t *config, size_t config_size);
+
 //OTP
 
 /**
@@ -138,6 +346,35 @@ extern const char * NK_get_totp_slot_name(uint8_t slot_number);
  */
 extern const char * NK_get_hotp_slot_name(uint8_t slot_number);
 
+/**
+ * Write the name of given TOTP slot into the buffer. Like NK_get_totp_slot_name, without allocation.
+ * @param slot_number TOTP slot number, slot_number<15
+ * @param buffer buffer for the null-terminated name, 16 bytes are always enough
+ * @param buffer_size size of the buffer
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_get_totp_slot_name_into(uint8_t slot_number, char *buffer, size_t buffer_size);
+
+/**
+ * Write the name of given HOTP slot into the buffer. Like NK_get_hotp_slot_name, without allocation.
+ * @param slot_number HOTP slot number, slot_number<3
+ * @param buffer buffer for the null-terminated name, 16 bytes are always enough
+ * @param buffer_size size of the buffer
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_get_hotp_slot_name_into(uint8_t slot_number, char *buffer, size_t buffer_size);
+
+/**
+ * Get names of all OTP slots with one call. Each name takes 16 bytes of the buffer (15 characters and
+ * terminating null), HOTP slots go first, then TOTP slots (3 + 15 names in total).
+ * Names of slots which could not be read are empty.
+ * @param buffer buffer for the names, at least 18*16 bytes long
+ * @param buffer_size size of the buffer
+ * @param statuses uint8_t[18] for command processing error code of each slot, or NULL
+ * @return 0 if all names were read or partially read, library error code otherwise
+ */
+extern int NK_get_all_slot_names(char *buffer, size_t buffer_size, uint8_t *statuses);
+
 /**
  * Erase HOTP slot data from the device
  * @param slot_number HOTP slot number, slot_number<3
@@ -227,6 +464,135 @@ extern uint32_t NK_get_totp_code(uint8_t slot_number, uint64_t challenge, uint64
 extern uint32_t NK_get_totp_code_PIN(uint8_t slot_number, uint64_t challenge,
                                      uint64_t last_totp_time, uint8_t last_interval, const char* user_temporary_password);
 
+/**
+ * Get TOTP codes from many slots with one call.
+ * @param slot_numbers TOTP slot numbers, each <15
+ * @param count number of slots
+ * @param challenge TOTP challenge
+ * @param last_totp_time last time
+ * @param last_interval last interval
+ * @param user_temporary_password char[25](Pro) user temporary password if PIN protected OTP codes are enabled,
+ * otherwise should be set to empty string - ''
+ * @param codes uint32_t[count] for the codes, 0 for slots which could not be read
+ * @param statuses uint8_t[count] for command processing error code of each slot, or NULL
+ * @return 0 if codes were read or partially read, library error code otherwise
+ */
+extern int NK_get_totp_codes(const uint8_t *slot_numbers, size_t count, uint64_t challenge,
+                             uint64_t last_totp_time, uint8_t last_interval,
+                             const char *user_temporary_password, uint32_t *codes, uint8_t *statuses);
+
+/**
+ * Get TOTP code for the current time. Each code is read from the device once per slot and time step,
+ * so polling the code often costs one device read per time step. The device time is set to the host time
+ * when it is not known to match it, NK_totp_set_time is not needed.
+ * @param slot_number TOTP slot number, slot_number<15
+ * @param time_window time step of the slot, as written with NK_write_totp_slot
+ * @param user_temporary_password char[25](Pro) user temporary password if PIN protected OTP codes are enabled,
+ * otherwise should be set to empty string - ''. Codes read with a password are returned only for the same password.
+ * @return TOTP code
+ */
+extern uint32_t NK_get_current_totp_code(uint8_t slot_number, uint16_t time_window, const char *user_temporary_password);
+
+/**
+ * Get NK_get_current_totp_code counters for the device used by the current thread.
+ * @param hits pointer for number of codes returned without reading the device
+ * @param device_reads pointer for number of codes read from the device
+ */
+extern void NK_get_current_totp_code_statistics(uint64_t *hits, uint64_t *device_reads);
+
+/**
+ * Register OTP secret for host-side verification with NK_otp_verify_*. Does not use the device.
+ * @param secret hex encoded secret, as for NK_write_hotp_slot
+ * @param algorithm HMAC hash function: 0 - SHA1, 1 - SHA256, 2 - SHA512
+ * @param use_8_digits 8 digit codes if true, 6 otherwise
+ * @return secret id (>0), 0 on error
+ */
+extern int NK_otp_add_secret(const char *secret, uint8_t algorithm, bool use_8_digits);
+
+/**
+ * Remove OTP secret registered with NK_otp_add_secret
+ * @param secret_id secret id
+ * @return 1 if removed, 0 if there was no such secret
+ */
+extern int NK_otp_remove_secret(int secret_id);
+
+/**
+ * Verify HOTP code against counters counter..counter+look_ahead
+ * @param secret_id secret id from NK_otp_add_secret
+ * @param code code to verify
+ * @param counter first counter to check
+ * @param look_ahead number of further counters to check
+ * @param matched_counter set to the matching counter if code is valid, can be NULL
+ * @return 1 if code is valid, 0 otherwise
+ */
+extern int NK_otp_verify_hotp(int secret_id, uint32_t code, uint64_t counter, uint32_t look_ahead,
+                              uint64_t *matched_counter);
+
+/**
+ * Verify TOTP code against time steps within window from the current one
+ * @param secret_id secret id from NK_otp_add_secret
+ * @param code code to verify
+ * @param time Unix time of verification
+ * @param time_step TOTP time step in seconds, usually 30
+ * @param window number of earlier and later time steps accepted
+ * @param matched_step set to the matching time step if code is valid, can be NULL
+ * @return 1 if code is valid, 0 otherwise
+ */
+extern int NK_otp_verify_totp(int secret_id, uint32_t code, uint64_t time, uint16_t time_step, uint8_t window,
+                              uint64_t *matched_step);
+
+/**
+ * Verify many TOTP codes with one call
+ * @param secret_ids int[count] secret ids from NK_otp_add_secret
+ * @param codes uint32_t[count] codes to verify
+ * @param count number of codes
+ * @param time Unix time of verification
+ * @param time_step TOTP time step in seconds, usually 30
+ * @param window number of earlier and later time steps accepted
+ * @param matched_steps int64_t[count] for the matching time step of each code, or -1 for invalid codes
+ * and unknown secrets; can be NULL
+ * @return number of valid codes
+ */
+extern size_t NK_otp_verify_totp_codes(const int *secret_ids, const uint32_t *codes, size_t count, uint64_t time,
+                                       uint16_t time_step, uint8_t window, int64_t *matched_steps);
+
+/**
+ * Request HOTP code from the device without waiting for the result. Requests are queued per device
+ * and run on its worker thread, one after another.
+ * @param slot_number HOTP slot number, slot_number<3
+ * @param user_temporary_password char[25](Pro) user temporary password if PIN protected OTP codes are enabled,
+ * otherwise should be set to empty string - ''
+ * @param callback function called from the worker thread with the request id, HOTP code, command processing
+ * error code and user_data when the request is done, or NULL to collect the result with NK_poll. Results
+ * are kept until NK_poll returns them, so it has to be called for every request submitted without a callback.
+ * Requests still waiting when the device is disconnected fail with 206 (device not connected).
+ * @param user_data pointer passed back to the callback
+ * @return request id
+ */
+extern int NK_submit_get_hotp_code(uint8_t slot_number, const char *user_temporary_password,
+                                   void (*callback)(int request_id, uint32_t result, uint8_t status, void *user_data),
+                                   void *user_data);
+
+/**
+ * Request TOTP code from the device without waiting for the result.
+ * @see NK_get_totp_code_PIN for the parameters and NK_submit_get_hotp_code for callback and user_data
+ * @return request id
+ */
+extern int NK_submit_get_totp_code(uint8_t slot_number, uint64_t challenge, uint64_t last_totp_time,
+                                   uint8_t last_interval, const char *user_temporary_password,
+                                   void (*callback)(int request_id, uint32_t result, uint8_t status, void *user_data),
+                                   void *user_data);
+
+/**
+ * Check whether the request submitted without a callback is done. A finished request is forgotten
+ * after its result is returned.
+ * @param request_id id returned by NK_submit_* function
+ * @param result pointer for the request result (e.g. OTP code)
+ * @param status pointer for the command processing error code
+ * @return 1 if done and result/status are set, 0 if still pending, -1 for unknown request id
+ */
+extern int NK_poll(int request_id, uint32_t *result, uint8_t *status);
+
 /**
  * Set time on the device (for TOTP requests)
  * @param time seconds in unix epoch (from 01.01.1970)
@@ -279,6 +645,14 @@ extern int NK_enable_password_safe(const char *user_pin);
  */
 extern uint8_t * NK_get_password_safe_slot_status();
 
+/**
+ * Get password safe slots' status into the buffer. Like NK_get_password_safe_slot_status, without allocation.
+ * @param status uint8_t[16] for the slot statuses
+ * @param status_size size of the buffer
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_get_password_safe_slot_status_into(uint8_t *status, size_t status_size);
+
 /**
  * Get password safe slot name
  * @param slot_number password safe slot number, slot_number<16
@@ -300,6 +674,20 @@ extern const char *NK_get_password_safe_slot_login(uint8_t slot_number);
  */
 extern const char *NK_get_password_safe_slot_password(uint8_t slot_number);
 
+/**
+ * Variants of the three functions above writing the null-terminated value into the caller's buffer.
+ * The value is copied straight from the device response, which is cleared afterwards, so the only copy left
+ * is in the buffer, under the caller's control.
+ * @param slot_number password safe slot number, slot_number<16
+ * @param buffer buffer for the value: 12 bytes are always enough for the name, 33 for the login
+ * and 21 for the password
+ * @param buffer_size size of the buffer
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_get_password_safe_slot_name_into(uint8_t slot_number, char *buffer, size_t buffer_size);
+extern int NK_get_password_safe_slot_login_into(uint8_t slot_number, char *buffer, size_t buffer_size);
+extern int NK_get_password_safe_slot_password_into(uint8_t slot_number, char *buffer, size_t buffer_size);
+
 /**
  * Write password safe data to the slot
  * @param slot_number password safe slot number, slot_number<16
@@ -311,6 +699,32 @@ extern const char *NK_get_password_safe_slot_password(uint8_t slot_number);
 extern int NK_write_password_safe_slot(uint8_t slot_number, const char *slot_name,
                                        const char *slot_login, const char *slot_password);
 
+/**
+ * Read all programmed password safe slots at once. Empty slots are skipped using the slot status, and the device
+ * is locked for the whole read. Each slot takes 66 bytes of the buffer: null-terminated name (12 bytes),
+ * login (33 bytes) and password (21 bytes). Values are copied straight from the device responses, which are
+ * cleared afterwards. Fields of empty slots are zeroed, and the whole buffer is zeroed if reading fails.
+ * The caller should clear the buffer when done with it.
+ * @param buffer buffer for 16 slots, 1056 bytes
+ * @param buffer_size size of the buffer
+ * @param slot_status uint8_t[16] for the slot statuses (1 programmed, 0 empty), or NULL
+ * @return 0 on success, command processing error code or library error code otherwise
+ */
+extern int NK_get_password_safe_slots(char *buffer, size_t buffer_size, uint8_t *slot_status);
+
+/**
+ * Write many password safe slots at once, from a buffer in the layout of NK_get_password_safe_slots.
+ * The writes are sent one after another with the device locked.
+ * @param buffer 16 slots with null-terminated fields; a field of a written slot without the terminating null
+ * fails with TOO_LONG_STRING and nothing is written
+ * @param buffer_size size of the buffer
+ * @param slot_status uint8_t[16], slots with non-zero value are written, e.g. as read with NK_get_password_safe_slots;
+ * required, NULL is rejected with TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE and nothing is written
+ * @return 0 on success, command processing error code or library error code otherwise;
+ * slots after the first failed one are not written
+ */
+extern int NK_write_password_safe_slots(const char *buffer, size_t buffer_size, const uint8_t *slot_status);
+
 /**
  * Erase the password safe slot from the device
  * @param slot_number password safe slot number, slot_number<16
@@ -324,6 +738,61 @@ extern int NK_erase_password_safe_slot(uint8_t slot_number);
  */
 extern int NK_is_AES_supported(const char *user_password);
 
+/**
+ * Device profile of the current thread, applied with NK_profile_apply.
+ * Remove all items from the profile, OTP secrets and passwords are overwritten in memory.
+ */
+extern void NK_profile_clear();
+
+/**
+ * Set general configuration in the profile, @see NK_write_config
+ */
+extern void NK_profile_set_config(uint8_t numlock, uint8_t capslock, uint8_t scrolllock, bool enable_user_password,
+                                  bool delete_user_password);
+
+/**
+ * Add HOTP slot to the profile, @see NK_write_hotp_slot
+ * @param skip_if_unchanged secrets can't be read back, so slots are always written by default;
+ * when set, the slot is skipped if its name, flags and token ID already match
+ * @return 0 on success, library error code for invalid slot number
+ */
+extern int NK_profile_add_hotp_slot(uint8_t slot_number, const char *slot_name, const char *secret,
+                                    uint8_t hotp_counter, bool use_8_digits, bool use_enter, bool use_tokenID,
+                                    const char *token_ID, bool skip_if_unchanged);
+
+/**
+ * Add TOTP slot to the profile, @see NK_write_totp_slot and NK_profile_add_hotp_slot
+ * @return 0 on success, library error code for invalid slot number
+ */
+extern int NK_profile_add_totp_slot(uint8_t slot_number, const char *slot_name, const char *secret,
+                                    uint16_t time_window, bool use_8_digits, bool use_enter, bool use_tokenID,
+                                    const char *token_ID, bool skip_if_unchanged);
+
+/**
+ * Add password safe slot to the profile, @see NK_write_password_safe_slot
+ * @return 0 on success, library error code for invalid slot number
+ */
+extern int NK_profile_add_password_safe_slot(uint8_t slot_number, const char *slot_name, const char *slot_login,
+                                             const char *slot_password);
+
+/**
+ * Apply the profile to the connected device. Items already matching the device state are skipped,
+ * the admin PIN is checked once and only if something has to be written.
+ * Items are reported in the order: configuration (if set), HOTP, TOTP and password safe slots.
+ * The profile is cleared afterwards (@see NK_profile_clear), also if items failed, so the secrets do not stay
+ * in memory; to apply it to another device, add the items again.
+ * @param admin_pin needed if configuration or OTP slots have to be written
+ * @param user_pin needed if the profile has password safe slots
+ * @param admin_temporary_password char[25]
+ * @param statuses uint8_t[number of items] for command processing or library error code of each item
+ * @param written uint8_t[number of items], set to 1 for items written to the device, 0 for unchanged
+ * and failed ones
+ * @param size number of elements of statuses and written
+ * @return 0 if all items were applied, error code of the first failed item otherwise
+ */
+extern int NK_profile_apply(const char *admin_pin, const char *user_pin, const char *admin_temporary_password,
+                            uint8_t *statuses, uint8_t *written, size_t size);
+
 }
 
 
@@ -3,6 +3,7 @@
 #include "include/NitrokeyManager.h"
 #include "include/LibraryException.h"
 #include <algorithm>
+#include <mutex>
 
 namespace nitrokey{
 
@@ -29,55 +30,139 @@ namespace nitrokey{
 
     // package type to auth, auth type [Authorize,UserAuthorize]
     template <typename S, typename A, typename T>
-    void authorize_packet(T &package, const char *admin_temporary_password, shared_ptr<Device> device){
+    void authorize_packet(T &package, const char *admin_temporary_password, TransactionSequence &sequence){
         auto auth = get_payload<A>();
         strcpyT(auth.temporary_password, admin_temporary_password);
         auth.crc_to_authorize = S::CommandTransaction::getCRC(package);
-        A::CommandTransaction::run(*device, auth);
+        sequence.add<A>(auth);
+        bzero(&auth, sizeof(auth));
     }
 
     shared_ptr <NitrokeyManager> NitrokeyManager::_instance = nullptr;
 
-    NitrokeyManager::NitrokeyManager() {
-        set_debug(true);
+    NitrokeyManager::NitrokeyManager() : connected(false), device(nullptr),
+                                         cache_enabled(false), cache_generation(0), cache_hits(0), cache_misses(0),
+                                         device_time_known(false), device_time(0) {
     }
     NitrokeyManager::~NitrokeyManager() {
+        // run the queued jobs while all members are alive
+        command_queue.reset();
     }
 
     bool NitrokeyManager::connect() {
+        invalidate_cache();
         device = nullptr;
-        vector< shared_ptr<Device> > devices = { make_shared<Stick10>(), make_shared<Stick20>() };
-        for( auto & d : devices ){
-            if (d->connect()){
-                device = std::shared_ptr<Device>(d);
+        for (auto model : {DeviceModel::PRO, DeviceModel::STORAGE}){
+            device = DevicePool::instance().get(model);
+            if (device != nullptr){
+                return true;
             }
         }
+        return false;
+    }
+
+    vector<DeviceInfo> NitrokeyManager::list_devices(bool include_update_mode) {
+        return DeviceDiscovery::instance().get_devices(include_update_mode);
+    }
+
+    bool NitrokeyManager::connect_with_path(const string &path) {
+        invalidate_cache();
+        device = DevicePool::instance().get_by_path(path);
         return device != nullptr;
     }
 
+    bool NitrokeyManager::connect_with_serial(const string &serial) {
+        invalidate_cache();
+        device = DevicePool::instance().get_by_serial(serial);
+        return device != nullptr;
+    }
 
     bool NitrokeyManager::connect(const char *device_model) {
+        invalidate_cache();
+        const SimulatedDevice::Options default_options = {0ms, 0};
+        if (strcmp(device_model, "sim") == 0 || strcmp(device_model, "sim-pro") == 0)
+            return connect_simulated(DeviceModel::PRO, default_options);
+        if (strcmp(device_model, "sim-storage") == 0)
+            return connect_simulated(DeviceModel::STORAGE, default_options);
         switch (device_model[0]){
             case 'P':
-                device = make_shared<Stick10>();
+                device = DevicePool::instance().get(DeviceModel::PRO);
                 break;
             case 'S':
-                device = make_shared<Stick20>();
+                device = DevicePool::instance().get(DeviceModel::STORAGE);
                 break;
             default:
                 throw std::runtime_error("Unknown model");
         }
+        return device != nullptr;
+    }
+
+    bool NitrokeyManager::connect_simulated(DeviceModel model, SimulatedDevice::Options options) {
+        invalidate_cache();
+        device = make_shared<SimulatedDevice>(model, options);
+        return device->connect();
+    }
+
+    bool NitrokeyManager::set_simulation_options(SimulatedDevice::Options options) {
+        auto simulated = dynamic_pointer_cast<SimulatedDevice>(device);
+        if (simulated == nullptr)
+            return false;
+        auto lock = simulated->lock();
+        simulated->set_options(options);
+        return true;
+    }
+
+    bool NitrokeyManager::connect_replay(const string &trace_path, double time_scale) {
+        invalidate_cache();
+        device = make_shared<ReplayDevice>(trace_path, time_scale);
         return device->connect();
     }
 
+    void NitrokeyManager::start_recording(const string &trace_path) {
+        device->set_trace(make_shared<TraceWriter>(trace_path, device->get_device_model()));
+    }
+
+    void NitrokeyManager::stop_recording() {
+        device->set_trace(nullptr);
+    }
+
+    TimingProfile NitrokeyManager::get_timing() {
+        auto lock = device->lock();
+        return device->get_timing();
+    }
+
+    TimingProfile NitrokeyManager::get_timing(CommandID command) {
+        auto lock = device->lock();
+        return device->get_timing(command);
+    }
+
+    void NitrokeyManager::set_timing(const TimingProfile &timing) {
+        device->set_timing(timing);
+    }
+
+    void NitrokeyManager::set_command_timing(CommandID command, const TimingProfile &timing) {
+        device->set_command_timing(command, timing);
+    }
+
+    void NitrokeyManager::clear_command_timing() {
+        device->clear_command_timing();
+    }
+
     shared_ptr<NitrokeyManager> NitrokeyManager::instance() {
+        static std::mutex instance_mutex;
+        std::lock_guard<std::mutex> lock(instance_mutex);
         if (_instance == nullptr){
-            _instance = shared_ptr<NitrokeyManager>(new NitrokeyManager());
+            _instance = make_shared<NitrokeyManager>();
+            _instance->set_debug(true);
         }
         return _instance;
     }
 
     bool NitrokeyManager::disconnect() {
+        invalidate_cache();
+        // pooled devices stay open for the next connection
+        if (DevicePool::instance().release(device))
+            return true;
         return device->disconnect();
     }
 
@@ -90,8 +175,77 @@ namespace nitrokey{
     }
 
     string NitrokeyManager::get_serial_number() {
-        auto response = GetStatus::CommandTransaction::run(*device);
-        return response.data().get_card_serial_hex();
+        return read_status().get_card_serial_hex();
+    }
+
+    template <typename T, typename F>
+    T NitrokeyManager::cached(CachedValue<T> &entry, F read_from_device) {
+        uint64_t generation;
+        {
+            std::lock_guard<std::mutex> lock(cache_mutex);
+            if (cache_enabled && entry.valid){
+                cache_hits++;
+                return entry.value;
+            }
+            if (cache_enabled) cache_misses++;
+            generation = cache_generation;
+        }
+        T value = read_from_device();
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        // do not store the value if cache was invalidated in the meantime
+        if (cache_enabled && generation == cache_generation){
+            entry.value = value;
+            entry.valid = true;
+        }
+        return value;
+    }
+
+    void NitrokeyManager::invalidate_cache() {
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        cache_generation++;
+        cached_status.valid = false;
+        cached_password_safe_slot_status.valid = false;
+        // entries are only marked invalid, since they might be in use by read_slot_name
+        for (auto &entry : cached_slot_names) entry.second.valid = false;
+        device_time_known = false;
+    }
+
+    NitrokeyManager::CacheInvalidation::CacheInvalidation(NitrokeyManager &manager)
+            : manager(manager), lock(manager.device->lock()) {
+    }
+
+    NitrokeyManager::CacheInvalidation::~CacheInvalidation() {
+        manager.invalidate_cache();
+    }
+
+    void NitrokeyManager::set_cache_enabled(bool enabled) {
+        invalidate_cache();
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        cache_enabled = enabled;
+    }
+
+    void NitrokeyManager::get_cache_statistics(uint64_t &hits, uint64_t &misses) {
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        hits = cache_hits;
+        misses = cache_misses;
+    }
+
+    void NitrokeyManager::reset_cache_statistics() {
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        cache_hits = 0;
+        cache_misses = 0;
+    }
+
+    uint64_t NitrokeyManager::get_cache_generation() {
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        return cache_generation;
+    }
+
+    GetStatus::ResponsePayload NitrokeyManager::read_status() {
+        return cached(cached_status, [&](){
+            auto response = GetStatus::CommandTransaction::run(*device);
+            return response.data();
+        });
     }
 
     string NitrokeyManager::get_status() {
@@ -104,17 +258,18 @@ namespace nitrokey{
         auto gh = get_payload<GetHOTP>();
         gh.slot_number = get_internal_slot_number_for_hotp(slot_number);
 
+        TransactionSequence sequence(*device); // authorization and command must not be interleaved
         if(user_temporary_password != nullptr && strlen(user_temporary_password)!=0){ //FIXME use string instead of strlen
-            authorize_packet<GetHOTP, UserAuthorize>(gh, user_temporary_password, device);
+            authorize_packet<GetHOTP, UserAuthorize>(gh, user_temporary_password, sequence);
         }
 
-        auto resp = GetHOTP::CommandTransaction::run(*device, gh);
+        auto resp = sequence.run<GetHOTP>(gh);
         return resp.data().code;
     }
 
 
-    bool NitrokeyManager::is_valid_hotp_slot_number(uint8_t slot_number) const { return slot_number < 3; }
-    bool NitrokeyManager::is_valid_totp_slot_number(uint8_t slot_number) const { return slot_number < 0x10-1; } //15
+    bool NitrokeyManager::is_valid_hotp_slot_number(uint8_t slot_number) const { return slot_number < HOTP_SLOT_COUNT; }
+    bool NitrokeyManager::is_valid_totp_slot_number(uint8_t slot_number) const { return slot_number < TOTP_SLOT_COUNT; }
     uint8_t NitrokeyManager::get_internal_slot_number_for_totp(uint8_t slot_number) const { return (uint8_t) (0x20 + slot_number); }
     uint8_t NitrokeyManager::get_internal_slot_number_for_hotp(uint8_t slot_number) const { return (uint8_t) (0x10 + slot_number); }
 
@@ -129,20 +284,65 @@ namespace nitrokey{
         gt.last_interval = last_interval;
         gt.last_totp_time = last_totp_time;
 
+        TransactionSequence sequence(*device); // authorization and command must not be interleaved
         if(user_temporary_password != nullptr && strlen(user_temporary_password)!=0){ //FIXME use string instead of strlen
-            authorize_packet<GetTOTP, UserAuthorize>(gt, user_temporary_password, device);
+            authorize_packet<GetTOTP, UserAuthorize>(gt, user_temporary_password, sequence);
         }
-        auto resp = GetTOTP::CommandTransaction::run(*device, gt);
+        auto resp = sequence.run<GetTOTP>(gt);
         return resp.data().code;
     }
 
+    uint32_t NitrokeyManager::get_TOTP_code_at(uint8_t slot_number, uint64_t time,
+                                               const char *user_temporary_password) {
+        if(!is_valid_totp_slot_number(slot_number)) throw InvalidSlotException(slot_number);
+        auto lock = device->lock(); // the code is computed from the device time
+        if (!device_time_matches(time)) set_time(time);
+        return get_TOTP_code(slot_number, 0, 0, 0, user_temporary_password);
+    }
+
+    TOTPService &NitrokeyManager::get_TOTP_service() {
+        std::lock_guard<std::mutex> lock(totp_service_mutex);
+        if (totp_service == nullptr){
+            totp_service = unique_ptr<TOTPService>(new TOTPService(*this));
+        }
+        return *totp_service;
+    }
+
+    CommandQueue &NitrokeyManager::get_command_queue() {
+        std::lock_guard<std::mutex> lock(command_queue_mutex);
+        if (command_queue == nullptr){
+            command_queue = unique_ptr<CommandQueue>(new CommandQueue());
+        }
+        return *command_queue;
+    }
+
+    std::future<uint32_t> NitrokeyManager::get_HOTP_code_async(uint8_t slot_number,
+                                                               const char *user_temporary_password) {
+        // the caller's buffer might not live until the job is run
+        string password = user_temporary_password != nullptr ? user_temporary_password : "";
+        return async([this, slot_number, password](){
+            return get_HOTP_code(slot_number, password.c_str());
+        });
+    }
+
+    std::future<uint32_t> NitrokeyManager::get_TOTP_code_async(uint8_t slot_number, uint64_t challenge,
+                                                               uint64_t last_totp_time, uint8_t last_interval,
+                                                               const char *user_temporary_password) {
+        string password = user_temporary_password != nullptr ? user_temporary_password : "";
+        return async([this, slot_number, challenge, last_totp_time, last_interval, password](){
+            return get_TOTP_code(slot_number, challenge, last_totp_time, last_interval, password.c_str());
+        });
+    }
+
     bool NitrokeyManager::erase_slot(uint8_t slot_number, const char *temporary_password) {
+        CacheInvalidation invalidation(*this);
         auto p = get_payload<EraseSlot>();
         p.slot_number = slot_number;
 
-        authorize_packet<EraseSlot, Authorize>(p, temporary_password, device);
+        TransactionSequence sequence(*device); // authorization and command must not be interleaved
+        authorize_packet<EraseSlot, Authorize>(p, temporary_password, sequence);
 
-        auto resp = EraseSlot::CommandTransaction::run(*device,p);
+        sequence.run<EraseSlot>(p);
         return true;
     }
 
@@ -171,6 +371,7 @@ namespace nitrokey{
     bool NitrokeyManager::write_HOTP_slot(uint8_t slot_number, const char *slot_name, const char *secret, uint8_t hotp_counter,
                                               bool use_8_digits, bool use_enter, bool use_tokenID, const char *token_ID,
                                               const char *temporary_password) {
+        CacheInvalidation invalidation(*this);
         if (!is_valid_hotp_slot_number(slot_number)) throw InvalidSlotException(slot_number);
 
         slot_number = get_internal_slot_number_for_hotp(slot_number);
@@ -185,15 +386,17 @@ namespace nitrokey{
         payload.use_enter = use_enter;
         payload.use_tokenID = use_tokenID;
 
-        authorize_packet<WriteToHOTPSlot, Authorize>(payload, temporary_password, device);
+        TransactionSequence sequence(*device); // authorization and command must not be interleaved
+        authorize_packet<WriteToHOTPSlot, Authorize>(payload, temporary_password, sequence);
 
-        auto resp = WriteToHOTPSlot::CommandTransaction::run(*device, payload);
+        sequence.run<WriteToHOTPSlot>(payload);
         return true;
     }
 
     bool NitrokeyManager::write_TOTP_slot(uint8_t slot_number, const char *slot_name, const char *secret, uint16_t time_window,
                                               bool use_8_digits, bool use_enter, bool use_tokenID, const char *token_ID,
                                               const char *temporary_password) {
+        CacheInvalidation invalidation(*this);
         auto payload = get_payload<WriteToTOTPSlot>();
         if (!is_valid_totp_slot_number(slot_number)) throw InvalidSlotException(slot_number);
 
@@ -208,9 +411,10 @@ namespace nitrokey{
         payload.use_enter = use_enter;
         payload.use_tokenID = use_tokenID;
 
-        authorize_packet<WriteToTOTPSlot, Authorize>(payload, temporary_password, device);
+        TransactionSequence sequence(*device); // authorization and command must not be interleaved
+        authorize_packet<WriteToTOTPSlot, Authorize>(payload, temporary_password, sequence);
 
-        auto resp = WriteToTOTPSlot::CommandTransaction::run(*device, payload);
+        sequence.run<WriteToTOTPSlot>(payload);
         return true;
     }
 
@@ -225,11 +429,93 @@ namespace nitrokey{
         return get_slot_name(slot_number);
     }
 
+    template <typename T>
+    static void copy_to_buffer(const T *source, size_t source_size, char *buffer, size_t buffer_size){
+        // fields are not null-terminated when the value fills them completely
+        const size_t length = strnlen((const char *) source, source_size);
+        if (buffer == nullptr || buffer_size < length + 1){
+            throw TargetBufferSmallerThanSource(length + 1, buffer == nullptr ? 0 : buffer_size);
+        }
+        memcpy(buffer, source, length);
+        buffer[length] = 0;
+    }
+
+    void NitrokeyManager::get_totp_slot_name(uint8_t slot_number, char *buffer, size_t buffer_size) {
+        if (!is_valid_totp_slot_number(slot_number)) throw InvalidSlotException(slot_number);
+        const auto name = read_slot_name(get_internal_slot_number_for_totp(slot_number));
+        copy_to_buffer(name.c_str(), name.size(), buffer, buffer_size);
+    }
+
+    void NitrokeyManager::get_hotp_slot_name(uint8_t slot_number, char *buffer, size_t buffer_size) {
+        if (!is_valid_hotp_slot_number(slot_number)) throw InvalidSlotException(slot_number);
+        const auto name = read_slot_name(get_internal_slot_number_for_hotp(slot_number));
+        copy_to_buffer(name.c_str(), name.size(), buffer, buffer_size);
+    }
+
     const char * NitrokeyManager::get_slot_name(uint8_t slot_number)  {
-        auto payload = get_payload<GetSlotName>();
-        payload.slot_number = slot_number;
-        auto resp = GetSlotName::CommandTransaction::run(*device, payload);
-        return strdup((const char *) resp.data().slot_name);
+        return strdup(read_slot_name(slot_number).c_str());
+    }
+
+    string NitrokeyManager::read_slot_name(uint8_t slot_number) {
+        CachedValue<string> *entry;
+        {
+            std::lock_guard<std::mutex> lock(cache_mutex);
+            entry = &cached_slot_names[slot_number];
+        }
+        return cached(*entry, [&](){
+            auto payload = get_payload<GetSlotName>();
+            payload.slot_number = slot_number;
+            auto resp = GetSlotName::CommandTransaction::run(*device, payload);
+            const auto &name = resp.data().slot_name;
+            // slot name is not null-terminated when it fills the whole field
+            return string((const char *) name, strnlen((const char *) name, sizeof name));
+        });
+    }
+
+    template <typename T>
+    static uint8_t get_command_status(T func){
+        try {
+            func();
+        }
+        catch (CommandFailedException & commandFailedException){
+            return commandFailedException.last_command_status;
+        }
+        catch (LibraryException & libraryException){
+            return libraryException.exception_id();
+        }
+        return 0;
+    }
+
+    vector<string> NitrokeyManager::get_all_slot_names(vector<uint8_t> &statuses) {
+        vector<string> names(HOTP_SLOT_COUNT + TOTP_SLOT_COUNT);
+        statuses.assign(names.size(), 0);
+        // one lock for the whole batch instead of one per command
+        auto lock = device->lock();
+        for (uint8_t i = 0; i < names.size(); i++) {
+            const uint8_t internal_slot_number = i < HOTP_SLOT_COUNT ?
+                                                 get_internal_slot_number_for_hotp(i) :
+                                                 get_internal_slot_number_for_totp(i - HOTP_SLOT_COUNT);
+            statuses[i] = get_command_status([&](){
+                names[i] = read_slot_name(internal_slot_number);
+            });
+        }
+        return names;
+    }
+
+    vector<uint32_t> NitrokeyManager::get_TOTP_codes(const vector<uint8_t> &slot_numbers, uint64_t challenge,
+                                                     uint64_t last_totp_time, uint8_t last_interval,
+                                                     const char *user_temporary_password,
+                                                     vector<uint8_t> &statuses) {
+        vector<uint32_t> codes(slot_numbers.size(), 0);
+        statuses.assign(slot_numbers.size(), 0);
+        auto lock = device->lock();
+        for (size_t i = 0; i < slot_numbers.size(); i++) {
+            statuses[i] = get_command_status([&](){
+                codes[i] = get_TOTP_code(slot_numbers[i], challenge, last_totp_time, last_interval,
+                                         user_temporary_password);
+            });
+        }
+        return codes;
     }
 
     bool NitrokeyManager::first_authenticate(const char *pin, const char *temporary_password) {
@@ -245,9 +531,25 @@ namespace nitrokey{
         p.reset = 1;
         p.time = time;
         SetTime::CommandTransaction::run(*device, p);
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        device_time_known = true;
+        device_time = time;
+        device_time_set_at = std::chrono::steady_clock::now();
         return false;
     }
 
+    bool NitrokeyManager::device_time_matches(uint64_t time) {
+        // the device clock runs on its own, the time set on it is trusted for a while
+        // and only within a second, then it is set again
+        const auto max_age = std::chrono::minutes(10);
+        std::lock_guard<std::mutex> lock(cache_mutex);
+        if (!device_time_known) return false;
+        const auto age = std::chrono::steady_clock::now() - device_time_set_at;
+        if (age > max_age) return false;
+        const uint64_t estimate = device_time + (uint64_t) std::chrono::duration_cast<std::chrono::seconds>(age).count();
+        return (estimate > time ? estimate - time : time - estimate) <= 1;
+    }
+
     bool NitrokeyManager::get_time() {
         auto p = get_payload<SetTime>();
         p.reset = 0;
@@ -277,15 +579,17 @@ namespace nitrokey{
             //in Storage change admin/user pin is divided to two commands with 20 chars field len
             case DeviceModel::STORAGE:
             {
+                TransactionSequence sequence(*device); // both parts must be sent one after another
                 auto p = get_payload<ChangeAdminUserPin20Current>();
                 strcpyT(p.old_pin, current_PIN);
                 p.set_kind(StoKind);
-                ChangeAdminUserPin20Current::CommandTransaction::run(*device, p);
+                sequence.add<ChangeAdminUserPin20Current>(p);
 
                 auto p2 = get_payload<ChangeAdminUserPin20New>();
                 strcpyT(p2.new_pin, new_PIN);
                 p2.set_kind(StoKind);
-                ChangeAdminUserPin20New::CommandTransaction::run(*device, p2);
+                sequence.add<ChangeAdminUserPin20New>(p2);
+                sequence.run();
             }
                 break;
         }
@@ -293,22 +597,26 @@ namespace nitrokey{
     }
 
     void NitrokeyManager::enable_password_safe(const char *user_pin) {
+        TransactionSequence sequence(*device);
         //The following command will cancel enabling PWS if it is not supported
         auto a = get_payload<IsAESSupported>();
         strcpyT(a.user_password, user_pin);
-        IsAESSupported::CommandTransaction::run(*device, a);
+        sequence.add<IsAESSupported>(a);
 
         auto p = get_payload<EnablePasswordSafe>();
         strcpyT(p.user_password, user_pin);
-        EnablePasswordSafe::CommandTransaction::run(*device, p);
+        sequence.add<EnablePasswordSafe>(p);
+        sequence.run();
     }
 
     vector <uint8_t> NitrokeyManager::get_password_safe_slot_status() {
-        auto responsePayload = GetPasswordSafeSlotStatus::CommandTransaction::run(*device);
-        vector<uint8_t> v = vector<uint8_t>(responsePayload.data().password_safe_status,
-                                            responsePayload.data().password_safe_status
-                                            + sizeof(responsePayload.data().password_safe_status));
-        return v;
+        return cached(cached_password_safe_slot_status, [&](){
+            auto responsePayload = GetPasswordSafeSlotStatus::CommandTransaction::run(*device);
+            vector<uint8_t> v = vector<uint8_t>(responsePayload.data().password_safe_status,
+                                                responsePayload.data().password_safe_status
+                                                + sizeof(responsePayload.data().password_safe_status));
+            return v;
+        });
     }
 
     uint8_t NitrokeyManager::get_user_retry_count() {
@@ -321,6 +629,7 @@ namespace nitrokey{
     }
 
     void NitrokeyManager::lock_device() {
+        CacheInvalidation invalidation(*this);
         LockDevice::CommandTransaction::run(*device);
     }
 
@@ -350,22 +659,111 @@ namespace nitrokey{
         return strdup((const char *) response.data().slot_password);
     }
 
+    void NitrokeyManager::get_password_safe_slot_name(uint8_t slot_number, char *buffer, size_t buffer_size) {
+        if (!is_valid_password_safe_slot_number(slot_number)) throw InvalidSlotException(slot_number);
+        auto p = get_payload<GetPasswordSafeSlotName>();
+        p.slot_number = slot_number;
+        auto response = GetPasswordSafeSlotName::CommandTransaction::run(*device, p);
+        const auto &field = response.data().slot_name;
+        copy_to_buffer(field, sizeof field, buffer, buffer_size);
+    }
+
+    void NitrokeyManager::get_password_safe_slot_login(uint8_t slot_number, char *buffer, size_t buffer_size) {
+        if (!is_valid_password_safe_slot_number(slot_number)) throw InvalidSlotException(slot_number);
+        auto p = get_payload<GetPasswordSafeSlotLogin>();
+        p.slot_number = slot_number;
+        auto response = GetPasswordSafeSlotLogin::CommandTransaction::run(*device, p);
+        const auto &field = response.data().slot_login;
+        copy_to_buffer(field, sizeof field, buffer, buffer_size);
+    }
+
+    void NitrokeyManager::get_password_safe_slot_password(uint8_t slot_number, char *buffer, size_t buffer_size) {
+        if (!is_valid_password_safe_slot_number(slot_number)) throw InvalidSlotException(slot_number);
+        auto p = get_payload<GetPasswordSafeSlotPassword>();
+        p.slot_number = slot_number;
+        auto response = GetPasswordSafeSlotPassword::CommandTransaction::run(*device, p);
+        const auto &field = response.data().slot_password;
+        copy_to_buffer(field, sizeof field, buffer, buffer_size);
+    }
+
     void NitrokeyManager::write_password_safe_slot(uint8_t slot_number, const char *slot_name, const char *slot_login,
                                                        const char *slot_password) {
+        CacheInvalidation invalidation(*this);
         if (!is_valid_password_safe_slot_number(slot_number)) throw InvalidSlotException(slot_number);
+        TransactionSequence sequence(*device); // both parts of the slot data must be sent one after another
         auto p = get_payload<SetPasswordSafeSlotData>();
         p.slot_number = slot_number;
         strcpyT(p.slot_name, slot_name);
         strcpyT(p.slot_password, slot_password);
-        SetPasswordSafeSlotData::CommandTransaction::run(*device, p);
+        sequence.add<SetPasswordSafeSlotData>(p);
 
         auto p2 = get_payload<SetPasswordSafeSlotData2>();
         p2.slot_number = slot_number;
         strcpyT(p2.slot_login_name, slot_login);
-        SetPasswordSafeSlotData2::CommandTransaction::run(*device, p2);
+        sequence.add<SetPasswordSafeSlotData2>(p2);
+        sequence.run();
+    }
+
+    template <size_t N>
+    static void check_terminated(const char (&field)[N]) {
+        // fields of a caller's buffer are not read past their end
+        if (memchr(field, 0, N) == nullptr) throw TooLongStringException(N, N - 1);
+    }
+
+    vector<uint8_t> NitrokeyManager::get_password_safe_slots(PasswordSafeSlot *slots) {
+        auto lock = device->lock(); // no other commands between the reads
+        try {
+            misc::secure_clear(slots, PWS_SLOT_COUNT * sizeof(PasswordSafeSlot));
+            auto slot_status = get_password_safe_slot_status();
+            for (uint8_t slot_number = 0; slot_number < PWS_SLOT_COUNT; slot_number++) {
+                if (slot_status[slot_number] == 0) continue;
+                auto &slot = slots[slot_number];
+                get_password_safe_slot_name(slot_number, slot.name, sizeof slot.name);
+                get_password_safe_slot_login(slot_number, slot.login, sizeof slot.login);
+                get_password_safe_slot_password(slot_number, slot.password, sizeof slot.password);
+            }
+            return slot_status;
+        }
+        catch (...) {
+            // no partial results
+            misc::secure_clear(slots, PWS_SLOT_COUNT * sizeof(PasswordSafeSlot));
+            throw;
+        }
+    }
+
+    void NitrokeyManager::write_password_safe_slots(const PasswordSafeSlot *slots,
+                                                    const vector<uint8_t> &slot_status) {
+        const size_t slot_count = std::min<size_t>(PWS_SLOT_COUNT, slot_status.size());
+        // nothing is written if any of the slots is invalid
+        for (size_t slot_number = 0; slot_number < slot_count; slot_number++) {
+            if (slot_status[slot_number] == 0) continue;
+            check_terminated(slots[slot_number].name);
+            check_terminated(slots[slot_number].login);
+            check_terminated(slots[slot_number].password);
+        }
+        CacheInvalidation invalidation(*this);
+        TransactionSequence sequence(*device); // packets are cleared by the sequence when it is done
+        for (uint8_t slot_number = 0; slot_number < slot_count; slot_number++) {
+            if (slot_status[slot_number] == 0) continue;
+            auto &slot = slots[slot_number];
+            auto p = get_payload<SetPasswordSafeSlotData>();
+            p.slot_number = slot_number;
+            strcpyT(p.slot_name, slot.name);
+            strcpyT(p.slot_password, slot.password);
+            sequence.add<SetPasswordSafeSlotData>(p);
+            misc::secure_clear(&p, sizeof p);
+
+            auto p2 = get_payload<SetPasswordSafeSlotData2>();
+            p2.slot_number = slot_number;
+            strcpyT(p2.slot_login_name, slot.login);
+            sequence.add<SetPasswordSafeSlotData2>(p2);
+            misc::secure_clear(&p2, sizeof p2);
+        }
+        sequence.run();
     }
 
     void NitrokeyManager::erase_password_safe_slot(uint8_t slot_number) {
+        CacheInvalidation invalidation(*this);
         if (!is_valid_password_safe_slot_number(slot_number)) throw InvalidSlotException(slot_number);
         auto p = get_payload<ErasePasswordSafeSlot>();
         p.slot_number = slot_number;
@@ -380,12 +778,14 @@ namespace nitrokey{
     }
 
     void NitrokeyManager::build_aes_key(const char *admin_password) {
+        CacheInvalidation invalidation(*this);
         auto p = get_payload<BuildAESKey>();
         strcpyT(p.admin_password, admin_password);
         BuildAESKey::CommandTransaction::run(*device, p);
     }
 
     void NitrokeyManager::factory_reset(const char *admin_password) {
+        CacheInvalidation invalidation(*this);
         auto p = get_payload<FactoryReset>();
         strcpyT(p.admin_password, admin_password);
         FactoryReset::CommandTransaction::run(*device, p);
@@ -401,6 +801,7 @@ namespace nitrokey{
 
     void NitrokeyManager::write_config(uint8_t numlock, uint8_t capslock, uint8_t scrolllock, bool enable_user_password,
                                        bool delete_user_password, const char *admin_temporary_password) {
+        CacheInvalidation invalidation(*this);
         auto p = get_payload<WriteGeneralConfig>();
         p.numlock = (uint8_t) numlock;
         p.capslock = (uint8_t) capslock;
@@ -408,15 +809,16 @@ namespace nitrokey{
         p.enable_user_password = (uint8_t) enable_user_password;
         p.delete_user_password = (uint8_t) delete_user_password;
 
-        authorize_packet<WriteGeneralConfig, Authorize>(p, admin_temporary_password, device);
+        TransactionSequence sequence(*device); // authorization and command must not be interleaved
+        authorize_packet<WriteGeneralConfig, Authorize>(p, admin_temporary_password, sequence);
 
-        WriteGeneralConfig::CommandTransaction::run(*device, p);
+        sequence.run<WriteGeneralConfig>(p);
     }
 
     vector<uint8_t> NitrokeyManager::read_config() {
-        auto responsePayload = GetStatus::CommandTransaction::run(*device);
-        vector<uint8_t> v = vector<uint8_t>(responsePayload.data().general_config,
-                                            responsePayload.data().general_config+sizeof(responsePayload.data().general_config));
+        auto status = read_status();
+        vector<uint8_t> v = vector<uint8_t>(status.general_config,
+                                            status.general_config+sizeof(status.general_config));
         return v;
     }
 
@@ -427,4 +829,139 @@ namespace nitrokey{
         return true;
     }
 
+    bool NitrokeyManager::otp_slot_matches(uint8_t internal_slot_number, const OTPSlotProfile &slot) {
+        auto p = get_payload<ReadSlot>();
+        p.slot_number = internal_slot_number;
+        try {
+            auto response = ReadSlot::CommandTransaction::run(*device, p);
+            auto &data = response.data();
+            auto field = [](const uint8_t *f, size_t size){ return string((const char *) f, strnlen((const char *) f, size)); };
+            const uint8_t config = (uint8_t) ((slot.use_8_digits ? 1 : 0) | (slot.use_enter ? 2 : 0) | (slot.use_tokenID ? 4 : 0));
+            // HOTP counter is not compared, it advances with use
+            return field(data.slot_name, sizeof data.slot_name) == slot.name && data.config == config
+                   && field(data.token_id, sizeof data.token_id) == slot.token_ID;
+        }
+        catch (CommandFailedException &e){
+            // e.g. slot not programmed, write it
+            return false;
+        }
+    }
+
+    vector<ProfileItemResult> NitrokeyManager::apply_profile(const DeviceProfile &profile, const char *admin_pin,
+                                                             const char *user_pin,
+                                                             const char *admin_temporary_password) {
+        vector<ProfileItemResult> results(profile.size(), ProfileItemResult{false, 0});
+        auto lock = device->lock();
+
+        // compare with the device state first, authenticate only if something has to be written
+        vector<size_t> admin_items;
+        size_t item = 0;
+        if (profile.set_config){
+            results[item].status = get_command_status([&](){
+                const auto &c = profile.config;
+                const vector<uint8_t> config = {c.numlock, c.capslock, c.scrolllock,
+                                                (uint8_t) c.enable_user_password, (uint8_t) c.delete_user_password};
+                if (read_config() != config) admin_items.push_back(item);
+            });
+            item++;
+        }
+        for (auto slots : {&profile.hotp_slots, &profile.totp_slots}){
+            const bool hotp = slots == &profile.hotp_slots;
+            for (auto &slot : *slots){
+                results[item].status = get_command_status([&](){
+                    if (hotp && !is_valid_hotp_slot_number(slot.slot_number)) throw InvalidSlotException(slot.slot_number);
+                    if (!hotp && !is_valid_totp_slot_number(slot.slot_number)) throw InvalidSlotException(slot.slot_number);
+                    const uint8_t internal_slot_number = hotp ? get_internal_slot_number_for_hotp(slot.slot_number)
+                                                              : get_internal_slot_number_for_totp(slot.slot_number);
+                    if (!slot.skip_if_unchanged || !otp_slot_matches(internal_slot_number, slot))
+                        admin_items.push_back(item);
+                });
+                item++;
+            }
+        }
+
+        if (!admin_items.empty()){
+            const uint8_t status = get_command_status([&](){ first_authenticate(admin_pin, admin_temporary_password); });
+            for (auto i : admin_items){
+                results[i].status = status;
+            }
+            if (status == 0){
+                item = 0;
+                auto next_admin_item = admin_items.begin();
+                auto pending = [&](){
+                    const bool is_pending = next_admin_item != admin_items.end() && *next_admin_item == item;
+                    if (is_pending) next_admin_item++;
+                    return is_pending;
+                };
+                if (profile.set_config){
+                    if (pending()){
+                        const auto &c = profile.config;
+                        results[item].status = get_command_status([&](){
+                            write_config(c.numlock, c.capslock, c.scrolllock, c.enable_user_password,
+                                         c.delete_user_password, admin_temporary_password);
+                        });
+                    }
+                    item++;
+                }
+                for (auto &slot : profile.hotp_slots){
+                    if (pending()){
+                        results[item].status = get_command_status([&](){
+                            write_HOTP_slot(slot.slot_number, slot.name.c_str(), slot.secret.c_str(),
+                                            slot.hotp_counter, slot.use_8_digits, slot.use_enter, slot.use_tokenID,
+                                            slot.token_ID.c_str(), admin_temporary_password);
+                        });
+                    }
+                    item++;
+                }
+                for (auto &slot : profile.totp_slots){
+                    if (pending()){
+                        results[item].status = get_command_status([&](){
+                            write_TOTP_slot(slot.slot_number, slot.name.c_str(), slot.secret.c_str(),
+                                            slot.time_window, slot.use_8_digits, slot.use_enter, slot.use_tokenID,
+                                            slot.token_ID.c_str(), admin_temporary_password);
+                        });
+                    }
+                    item++;
+                }
+                for (auto i : admin_items){
+                    results[i].written = results[i].status == 0;
+                }
+            }
+        }
+
+        item = profile.size() - profile.password_safe_slots.size();
+        if (profile.password_safe_slots.empty())
+            return results;
+        // the password safe has to be unlocked to compare the slots as well
+        const uint8_t status = get_command_status([&](){ enable_password_safe(user_pin); });
+        vector<uint8_t> slot_status;
+        if (status == 0){
+            get_command_status([&](){ slot_status = get_password_safe_slot_status(); });
+        }
+        for (auto &slot : profile.password_safe_slots){
+            auto &result = results[item++];
+            if (status != 0){
+                result.status = status;
+                continue;
+            }
+            result.status = get_command_status([&](){
+                if (!is_valid_password_safe_slot_number(slot.slot_number)) throw InvalidSlotException(slot.slot_number);
+                if (slot.slot_number < slot_status.size() && slot_status[slot.slot_number] != 0){
+                    char name[PWS_SLOTNAME_LENGTH + 1], login[PWS_LOGINNAME_LENGTH + 1],
+                            password[PWS_PASSWORD_LENGTH + 1];
+                    get_password_safe_slot_name(slot.slot_number, name, sizeof name);
+                    get_password_safe_slot_login(slot.slot_number, login, sizeof login);
+                    get_password_safe_slot_password(slot.slot_number, password, sizeof password);
+                    const bool unchanged = slot.name == name && slot.login == login && slot.password == password;
+                    bzero(password, sizeof password);
+                    if (unchanged) return;
+                }
+                write_password_safe_slot(slot.slot_number, slot.name.c_str(), slot.login.c_str(),
+                                         slot.password.c_str());
+                result.written = true;
+            });
+        }
+        return results;
+    }
+
 }
@@ -0,0 +1,180 @@
+#include <algorithm>
+#include "OTPVerifier.h"
+#include "hash.h"
+#include "misc.h"
+#include "LibraryException.h"
+
+namespace nitrokey {
+
+    namespace {
+        class CodeGenerator {
+        public:
+            virtual ~CodeGenerator() {}
+            // RFC 4226 HOTP value before reduction to the number of digits
+            virtual uint32_t truncated_hmac(uint64_t counter) const = 0;
+        };
+
+        template <typename Hash>
+        class HMACCodeGenerator : public CodeGenerator {
+        public:
+            HMACCodeGenerator(const std::vector<uint8_t> &key) : m_hmac(key.data(), key.size()) {}
+
+            ~HMACCodeGenerator() {
+                //key pads were absorbed into the hash states, clear them
+                misc::secure_clear(&m_hmac, sizeof(m_hmac));
+            }
+
+            virtual uint32_t truncated_hmac(uint64_t counter) const override {
+                uint8_t message[8];
+                for (int i = 7; i >= 0; i--) {
+                    message[i] = static_cast<uint8_t>(counter & 0xFF);
+                    counter >>= 8;
+                }
+                uint8_t mac[Hash::digest_size];
+                m_hmac.compute(message, sizeof message, mac);
+                const uint8_t offset = mac[Hash::digest_size - 1] & 0x0F;
+                return ((uint32_t) (mac[offset] & 0x7F) << 24) | ((uint32_t) mac[offset + 1] << 16)
+                       | ((uint32_t) mac[offset + 2] << 8) | (uint32_t) mac[offset + 3];
+            }
+
+        private:
+            hash::HMAC<Hash> m_hmac;
+        };
+
+        std::unique_ptr<CodeGenerator> make_generator(OTPAlgorithm algorithm, const std::vector<uint8_t> &key) {
+            switch (algorithm) {
+                case OTPAlgorithm::SHA1:
+                    return std::unique_ptr<CodeGenerator>(new HMACCodeGenerator<hash::SHA1>(key));
+                case OTPAlgorithm::SHA256:
+                    return std::unique_ptr<CodeGenerator>(new HMACCodeGenerator<hash::SHA256>(key));
+                case OTPAlgorithm::SHA512:
+                    return std::unique_ptr<CodeGenerator>(new HMACCodeGenerator<hash::SHA512>(key));
+            }
+            throw InvalidOTPAlgorithmException(static_cast<uint8_t>(algorithm));
+        }
+
+        uint64_t time_step_counter(uint64_t time, uint16_t time_step) {
+            return time / std::max<uint16_t>(time_step, 1);
+        }
+    }
+
+    struct OTPVerifier::Secret {
+        std::unique_ptr<CodeGenerator> generator;
+        uint32_t modulus;
+        //codes of the last checked window and the counter following it
+        std::map<uint64_t, uint32_t> codes;
+    };
+
+    const int64_t OTPVerifier::no_match;
+
+    OTPVerifier::OTPVerifier() : m_last_secret_id(0) {}
+
+    OTPVerifier::~OTPVerifier() {}
+
+    int OTPVerifier::add_secret(const char *secret, OTPAlgorithm algorithm, bool use_8_digits) {
+        auto key = misc::hex_string_to_byte(secret);
+        std::unique_ptr<Secret> s(new Secret);
+        try {
+            s->generator = make_generator(algorithm, key);
+        }
+        catch (...) {
+            std::fill(key.begin(), key.end(), 0);
+            throw;
+        }
+        std::fill(key.begin(), key.end(), 0);
+        s->modulus = use_8_digits ? 100000000 : 1000000;
+
+        std::lock_guard<std::mutex> lock(m_mutex);
+        const int secret_id = ++m_last_secret_id;
+        m_secrets[secret_id] = std::move(s);
+        return secret_id;
+    }
+
+    bool OTPVerifier::remove_secret(int secret_id) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        return m_secrets.erase(secret_id) > 0;
+    }
+
+    OTPVerifier::Secret &OTPVerifier::get_secret(int secret_id) {
+        auto it = m_secrets.find(secret_id);
+        if (it == m_secrets.end())
+            throw UnknownOTPSecretException(secret_id);
+        return *it->second;
+    }
+
+    uint32_t OTPVerifier::get_code(Secret &secret, uint64_t counter) {
+        auto it = secret.codes.find(counter);
+        if (it != secret.codes.end())
+            return it->second;
+        const uint32_t code = secret.generator->truncated_hmac(counter) % secret.modulus;
+        secret.codes.emplace(counter, code);
+        return code;
+    }
+
+    int64_t OTPVerifier::find_code(Secret &secret, uint32_t code, uint64_t first_counter, uint64_t last_counter) {
+        //windows only move forward in normal use, codes before the window are not needed anymore
+        secret.codes.erase(secret.codes.begin(), secret.codes.lower_bound(first_counter));
+
+        int64_t matched = no_match;
+        for (uint64_t counter = first_counter; ; counter++) {
+            if (matched == no_match && get_code(secret, counter) == code)
+                matched = static_cast<int64_t>(counter);
+            if (counter == last_counter) break;
+        }
+        //precompute the code entering the window next
+        if (last_counter != UINT64_MAX)
+            get_code(secret, last_counter + 1);
+        return matched;
+    }
+
+    uint32_t OTPVerifier::get_HOTP_code(int secret_id, uint64_t counter) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        auto &secret = get_secret(secret_id);
+        return secret.generator->truncated_hmac(counter) % secret.modulus;
+    }
+
+    uint32_t OTPVerifier::get_TOTP_code(int secret_id, uint64_t time, uint16_t time_step) {
+        return get_HOTP_code(secret_id, time_step_counter(time, time_step));
+    }
+
+    int64_t OTPVerifier::verify_HOTP(int secret_id, uint32_t code, uint64_t counter, uint32_t look_ahead) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        const uint64_t last_counter = counter > UINT64_MAX - look_ahead ? UINT64_MAX : counter + look_ahead;
+        return find_code(get_secret(secret_id), code, counter, last_counter);
+    }
+
+    namespace {
+        void get_window(uint64_t time, uint16_t time_step, uint8_t window, uint64_t &first, uint64_t &last) {
+            const uint64_t current = time_step_counter(time, time_step);
+            first = current > window ? current - window : 0;
+            last = current + window;
+        }
+    }
+
+    int64_t OTPVerifier::verify_TOTP(int secret_id, uint32_t code, uint64_t time, uint16_t time_step,
+                                     uint8_t window) {
+        uint64_t first_counter, last_counter;
+        get_window(time, time_step, window, first_counter, last_counter);
+        std::lock_guard<std::mutex> lock(m_mutex);
+        return find_code(get_secret(secret_id), code, first_counter, last_counter);
+    }
+
+    std::vector<int64_t> OTPVerifier::verify_TOTP(const std::vector<TOTPRequest> &requests, uint64_t time,
+                                                  uint16_t time_step, uint8_t window) {
+        uint64_t first_counter, last_counter;
+        get_window(time, time_step, window, first_counter, last_counter);
+
+        std::vector<int64_t> matched;
+        matched.reserve(requests.size());
+        std::lock_guard<std::mutex> lock(m_mutex);
+        for (auto &request : requests) {
+            auto it = m_secrets.find(request.secret_id);
+            if (it == m_secrets.end()) {
+                matched.push_back(no_match);
+                continue;
+            }
+            matched.push_back(find_code(*it->second, request.code, first_counter, last_counter));
+        }
+        return matched;
+    }
+}
@@ -0,0 +1,91 @@
+#include "include/TOTPService.h"
+#include "include/NitrokeyManager.h"
+#include "include/hash.h"
+
+namespace nitrokey {
+
+    namespace {
+        // memoized codes are looked up by the password's hash, so the password itself is not kept
+        std::string password_hash(const std::string &password) {
+            if (password.empty()) return "";
+            hash::SHA256 sha;
+            sha.update(reinterpret_cast<const uint8_t *>(password.data()), password.size());
+            uint8_t digest[hash::SHA256::digest_size];
+            sha.finish(digest);
+            return std::string(reinterpret_cast<const char *>(digest), sizeof digest);
+        }
+    }
+
+    uint64_t TOTPService::system_time() {
+        return (uint64_t) std::chrono::duration_cast<std::chrono::seconds>(
+                std::chrono::system_clock::now().time_since_epoch()).count();
+    }
+
+    TOTPService::TOTPService(NitrokeyManager &manager, Clock clock)
+            : m_manager(manager), m_clock(clock), m_generation(0), m_statistics() {
+    }
+
+    uint32_t TOTPService::get_code(uint8_t slot_number, uint16_t time_window, const char *user_temporary_password) {
+        if (time_window == 0) time_window = 30;
+        const std::string password = user_temporary_password != nullptr ? user_temporary_password : "";
+        const std::string key_password = password_hash(password);
+        uint64_t now, generation;
+        {
+            std::lock_guard<std::mutex> lock(m_mutex);
+            now = m_clock();
+            generation = m_manager.get_cache_generation();
+            if (generation != m_generation) {
+                m_codes.clear();
+                m_generation = generation;
+            }
+            const uint64_t step = now / time_window;
+            auto code = m_codes.find(CodeKey(slot_number, time_window, step, key_password));
+            if (code != m_codes.end()) {
+                m_statistics.hits++;
+                return code->second;
+            }
+        }
+
+        const uint32_t code = m_manager.get_TOTP_code_at(slot_number, now, password.c_str());
+
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_statistics.device_reads++;
+        // do not store the code if a slot was changed in the meantime
+        if (generation == m_generation && generation == m_manager.get_cache_generation()) {
+            drop_outdated_codes(now);
+            m_codes[CodeKey(slot_number, time_window, now / time_window, key_password)] = code;
+        }
+        return code;
+    }
+
+    void TOTPService::drop_outdated_codes(uint64_t now) {
+        for (auto it = m_codes.begin(); it != m_codes.end();) {
+            const uint16_t time_window = std::get<1>(it->first);
+            if (std::get<2>(it->first) < now / time_window)
+                it = m_codes.erase(it);
+            else
+                ++it;
+        }
+    }
+
+    void TOTPService::set_clock(Clock clock) {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_clock = clock;
+        m_codes.clear();
+    }
+
+    TOTPService::Statistics TOTPService::get_statistics() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        return m_statistics;
+    }
+
+    void TOTPService::reset_statistics() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_statistics = Statistics();
+    }
+
+    void TOTPService::clear() {
+        std::lock_guard<std::mutex> lock(m_mutex);
+        m_codes.clear();
+    }
+}
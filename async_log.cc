@@ -0,0 +1,201 @@
+#include <ctime>
+#include <iomanip>
+#include <sstream>
+#include "async_log.h"
+
+namespace nitrokey {
+namespace log {
+
+using namespace std::chrono;
+
+void StreamLogSink::write(const LogRecord &record) {
+  std::time_t t = system_clock::to_time_t(record.time);
+  std::tm tm;
+  localtime_r(&t, &tm);
+  m_stream << "[" << LogHandler::loglevel_to_str(record.level) << "] ["
+           << std::put_time(&tm, "%c %Z") << "]\t" << record.message << '\n';
+}
+
+void StreamLogSink::flush() { m_stream.flush(); }
+
+JsonLinesLogSink::JsonLinesLogSink(const std::string &path)
+    : m_file(path, std::ios::out | std::ios::app) {}
+
+static void write_json_string(std::ostream &out, const std::string &s) {
+  out << '"';
+  for (char c : s) {
+    switch (c) {
+      case '"':
+        out << "\\\"";
+        break;
+      case '\\':
+        out << "\\\\";
+        break;
+      case '\n':
+        out << "\\n";
+        break;
+      case '\t':
+        out << "\\t";
+        break;
+      default:
+        if ((unsigned char)c < 0x20)
+          out << "\\u" << std::hex << std::setw(4) << std::setfill('0')
+              << (int)c << std::dec;
+        else
+          out << c;
+    }
+  }
+  out << '"';
+}
+
+void JsonLinesLogSink::write(const LogRecord &record) {
+  std::time_t t = system_clock::to_time_t(record.time);
+  std::tm tm;
+  gmtime_r(&t, &tm);
+  auto us = duration_cast<microseconds>(record.time.time_since_epoch()) %
+            seconds(1);
+  m_file << "{\"time\": \"" << std::put_time(&tm, "%Y-%m-%dT%H:%M:%S") << '.'
+         << std::setw(6) << std::setfill('0') << us.count() << "Z\", \"level\": ";
+  write_json_string(m_file, LogHandler::loglevel_to_str(record.level));
+  m_file << ", \"message\": ";
+  write_json_string(m_file, record.message);
+  m_file << "}\n";
+}
+
+void JsonLinesLogSink::flush() { m_file.flush(); }
+
+/*
+ *	Each cell's sequence tells whose turn it is: equal to the position
+ *	when free for the producer at that position, position + 1 when filled
+ *	and waiting for the consumer.
+ */
+LogRecordQueue::LogRecordQueue(size_t capacity)
+    : m_enqueue_position(0), m_dequeue_position(0) {
+  size_t size = 2;
+  while (size < capacity) size *= 2;
+  m_cells.reset(new Cell[size]);
+  m_mask = size - 1;
+  for (size_t i = 0; i < size; i++)
+    m_cells[i].sequence.store(i, std::memory_order_relaxed);
+}
+
+bool LogRecordQueue::push(LogRecord &record) {
+  size_t position = m_enqueue_position.load(std::memory_order_relaxed);
+  Cell *cell;
+  while (true) {
+    cell = &m_cells[position & m_mask];
+    size_t sequence = cell->sequence.load(std::memory_order_acquire);
+    auto diff = (intptr_t)sequence - (intptr_t)position;
+    if (diff == 0) {
+      if (m_enqueue_position.compare_exchange_weak(position, position + 1,
+                                                   std::memory_order_relaxed))
+        break;
+    } else if (diff < 0) {
+      return false;
+    } else {
+      position = m_enqueue_position.load(std::memory_order_relaxed);
+    }
+  }
+  cell->record = std::move(record);
+  cell->sequence.store(position + 1, std::memory_order_release);
+  return true;
+}
+
+bool LogRecordQueue::pop(LogRecord &record) {
+  size_t position = m_dequeue_position.load(std::memory_order_relaxed);
+  Cell *cell;
+  while (true) {
+    cell = &m_cells[position & m_mask];
+    size_t sequence = cell->sequence.load(std::memory_order_acquire);
+    auto diff = (intptr_t)sequence - (intptr_t)(position + 1);
+    if (diff == 0) {
+      if (m_dequeue_position.compare_exchange_weak(position, position + 1,
+                                                   std::memory_order_relaxed))
+        break;
+    } else if (diff < 0) {
+      return false;
+    } else {
+      position = m_dequeue_position.load(std::memory_order_relaxed);
+    }
+  }
+  record = std::move(cell->record);
+  cell->sequence.store(position + m_mask + 1, std::memory_order_release);
+  return true;
+}
+
+AsyncLogHandler::AsyncLogHandler(std::unique_ptr<LogSink> sink, size_t capacity)
+    : m_sink(std::move(sink)),
+      m_queue(capacity),
+      m_pushed(0),
+      m_dropped(0),
+      m_writer_waiting(false),
+      m_written(0),
+      m_stopping(false),
+      m_writer(&AsyncLogHandler::run, this) {}
+
+AsyncLogHandler::~AsyncLogHandler() {
+  if (Log::instance().handler() == this)
+    Log::instance().set_handler(&stdlog_handler);
+  {
+    std::lock_guard<std::mutex> lock(m_mutex);
+    m_stopping = true;
+  }
+  m_wakeup.notify_one();
+  m_writer.join();
+}
+
+void AsyncLogHandler::print(const std::string &str, Loglevel lvl) {
+  LogRecord record{system_clock::now(), lvl, str};
+  if (!m_queue.push(record)) {
+    m_dropped++;
+    return;
+  }
+  m_pushed++;
+  // the writer wakes up on its own after a while, so a missed notification
+  // only delays the message
+  if (m_writer_waiting.load(std::memory_order_relaxed)) m_wakeup.notify_one();
+}
+
+void AsyncLogHandler::flush() {
+  uint64_t target = m_pushed;
+  std::unique_lock<std::mutex> lock(m_mutex);
+  m_wakeup.notify_one();
+  m_written_cv.wait(lock, [&]() { return m_written >= target || m_stopping; });
+}
+
+void AsyncLogHandler::run() {
+  LogRecord record;
+  uint64_t written = 0;
+  uint64_t reported_dropped = 0;
+  bool stopping = false;
+  while (true) {
+    bool any = false;
+    while (m_queue.pop(record)) {
+      m_sink->write(record);
+      written++;
+      any = true;
+    }
+    uint64_t dropped = m_dropped;
+    if (dropped != reported_dropped) {
+      m_sink->write({system_clock::now(), Loglevel::WARNING,
+                     std::to_string(dropped - reported_dropped) +
+                         " log messages dropped, buffer full"});
+      reported_dropped = dropped;
+      any = true;
+    }
+    if (any) m_sink->flush();
+
+    std::unique_lock<std::mutex> lock(m_mutex);
+    m_written = written;
+    m_written_cv.notify_all();
+    // one more pass after the stop request for messages logged meanwhile
+    if (stopping) break;
+    stopping = m_stopping;
+    if (stopping) continue;
+    m_writer_waiting = true;
+    m_wakeup.wait_for(lock, milliseconds(50));
+    m_writer_waiting = false;
+  }
+}
+}
+}
@@ -0,0 +1,198 @@
+/*
+ * Client library with the functions of NK_C_API.h available through the broker (@see Broker.h),
+ * a drop-in replacement of libnitrokey for applications using only these functions.
+ * Connects to the socket from the NITROKEY_BROKER_SOCKET environment variable,
+ * or to the default one, if the broker runs as the same user or root. Like in libnitrokey, each thread has its own last command status.
+ * Commands fail with the status 255 (broker::status_not_connected) if the broker can't be reached.
+ */
+#include <cstdlib>
+#include "broker_protocol.h"
+#include "../NK_C_API.h"
+
+using namespace nitrokey::broker;
+
+static thread_local int NK_broker_fd = -1;
+static thread_local uint8_t NK_last_command_status = 0;
+
+/*
+ * Send the request and return the response after its status byte,
+ * with only the status set on failure.
+ */
+static Message call(Message &request) {
+    Message response;
+    if (NK_broker_fd < 0) {
+        const char *path = getenv("NITROKEY_BROKER_SOCKET");
+        NK_broker_fd = connect_socket(path != nullptr ? path : default_socket_path());
+    }
+    if (NK_broker_fd < 0 || !write_message(NK_broker_fd, request) || !read_message(NK_broker_fd, response)) {
+        if (NK_broker_fd >= 0) close(NK_broker_fd);
+        // connect again on the next call, the broker might have been restarted
+        NK_broker_fd = -1;
+        response.clear();
+        response.put_u8(status_not_connected);
+    }
+    request.clear();
+    NK_last_command_status = response.get_u8();
+    return response;
+}
+
+static Message request(BrokerOp op) {
+    Message m;
+    m.put_u8((uint8_t) op);
+    return m;
+}
+
+static uint32_t get_number(Message &&response) {
+    if (NK_last_command_status == status_not_connected) return 0;
+    return response.get_u32();
+}
+
+static const char *get_string(Message &&response) {
+    // malloc'ed, to be released with NK_free
+    std::string s;
+    if (NK_last_command_status != status_not_connected) s = response.get_string();
+    response.clear();
+    const char *result = strdup(s.c_str());
+    std::fill(s.begin(), s.end(), 0);
+    return result;
+}
+
+static const char *get_string(BrokerOp op, uint8_t slot_number) {
+    auto m = request(op);
+    m.put_u8(slot_number);
+    return get_string(call(m));
+}
+
+static int get_error_code() {
+    return NK_last_command_status;
+}
+
+extern int NK_login(const char *device_model) {
+    auto m = request(BrokerOp::LOGIN);
+    m.put_string(device_model);
+    return get_number(call(m));
+}
+
+extern int NK_login_auto() {
+    return NK_login("");
+}
+
+extern int NK_logout() {
+    auto m = request(BrokerOp::LOGOUT);
+    call(m);
+    return get_error_code();
+}
+
+extern uint8_t NK_get_last_command_status() {
+    auto status = NK_last_command_status;
+    NK_last_command_status = 0;
+    return status;
+}
+
+extern void NK_free(void *result) {
+    free(result);
+}
+
+extern const char *NK_status() {
+    auto m = request(BrokerOp::STATUS);
+    return get_string(call(m));
+}
+
+extern const char *NK_device_serial_number() {
+    auto m = request(BrokerOp::SERIAL_NUMBER);
+    return get_string(call(m));
+}
+
+extern int NK_first_authenticate(const char *admin_password, const char *admin_temporary_password) {
+    auto m = request(BrokerOp::FIRST_AUTHENTICATE);
+    m.put_string(admin_password);
+    m.put_string(admin_temporary_password);
+    call(m);
+    return get_error_code();
+}
+
+extern int NK_user_authenticate(const char *user_password, const char *user_temporary_password) {
+    auto m = request(BrokerOp::USER_AUTHENTICATE);
+    m.put_string(user_password);
+    m.put_string(user_temporary_password);
+    call(m);
+    return get_error_code();
+}
+
+extern int NK_lock_device() {
+    auto m = request(BrokerOp::LOCK_DEVICE);
+    call(m);
+    return get_error_code();
+}
+
+extern int NK_totp_set_time(uint64_t time) {
+    auto m = request(BrokerOp::TOTP_SET_TIME);
+    m.put_u64(time);
+    call(m);
+    return get_error_code();
+}
+
+extern uint32_t NK_get_hotp_code_PIN(uint8_t slot_number, const char *user_temporary_password) {
+    auto m = request(BrokerOp::GET_HOTP_CODE);
+    m.put_u8(slot_number);
+    m.put_string(user_temporary_password);
+    return get_number(call(m));
+}
+
+extern uint32_t NK_get_hotp_code(uint8_t slot_number) {
+    return NK_get_hotp_code_PIN(slot_number, "");
+}
+
+extern uint32_t NK_get_totp_code_PIN(uint8_t slot_number, uint64_t challenge, uint64_t last_totp_time,
+                                       uint8_t last_interval, const char *user_temporary_password) {
+    auto m = request(BrokerOp::GET_TOTP_CODE);
+    m.put_u8(slot_number);
+    m.put_u64(challenge);
+    m.put_u64(last_totp_time);
+    m.put_u8(last_interval);
+    m.put_string(user_temporary_password);
+    return get_number(call(m));
+}
+
+extern uint32_t NK_get_totp_code(uint8_t slot_number, uint64_t challenge, uint64_t last_totp_time,
+                                   uint8_t last_interval) {
+    return NK_get_totp_code_PIN(slot_number, challenge, last_totp_time, last_interval, "");
+}
+
+extern const char *NK_get_hotp_slot_name(uint8_t slot_number) {
+    return get_string(BrokerOp::GET_HOTP_SLOT_NAME, slot_number);
+}
+
+extern const char *NK_get_totp_slot_name(uint8_t slot_number) {
+    return get_string(BrokerOp::GET_TOTP_SLOT_NAME, slot_number);
+}
+
+extern uint8_t NK_get_user_retry_count() {
+    auto m = request(BrokerOp::GET_USER_RETRY_COUNT);
+    return (uint8_t) get_number(call(m));
+}
+
+extern uint8_t NK_get_admin_retry_count() {
+    auto m = request(BrokerOp::GET_ADMIN_RETRY_COUNT);
+    return (uint8_t) get_number(call(m));
+}
+
+extern int NK_enable_password_safe(const char *user_pin) {
+    auto m = request(BrokerOp::ENABLE_PASSWORD_SAFE);
+    m.put_string(user_pin);
+    call(m);
+    return get_error_code();
+}
+
+extern const char *NK_get_password_safe_slot_name(uint8_t slot_number) {
+    return get_string(BrokerOp::GET_PASSWORD_SAFE_SLOT_NAME, slot_number);
+}
+
+extern const char *NK_get_password_safe_slot_login(uint8_t slot_number) {
+    return get_string(BrokerOp::GET_PASSWORD_SAFE_SLOT_LOGIN, slot_number);
+}
+
+extern const char *NK_get_password_safe_slot_password(uint8_t slot_number) {
+    return get_string(BrokerOp::GET_PASSWORD_SAFE_SLOT_PASSWORD, slot_number);
+}
+
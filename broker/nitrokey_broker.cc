@@ -0,0 +1,48 @@
+/*
+ * Daemon sharing the connected devices between processes (@see Broker.h).
+ *
+ *   LD_LIBRARY_PATH=../build ./nitrokey-broker [SOCKET_PATH]
+ *
+ * Stops on SIGINT or SIGTERM.
+ */
+#include <csignal>
+#include <iostream>
+#include <pthread.h>
+#include "Broker.h"
+#include "../NK_C_API.h"
+
+using namespace nitrokey::broker;
+
+int main(int argc, char **argv) {
+    const std::string socket_path = argc > 1 ? argv[1] : default_socket_path();
+
+    // blocked in all threads started from here, received by the signal thread only
+    sigset_t signals;
+    sigemptyset(&signals);
+    sigaddset(&signals, SIGINT);
+    sigaddset(&signals, SIGTERM);
+    pthread_sigmask(SIG_BLOCK, &signals, nullptr);
+
+    NK_set_debug(false);
+    try {
+        Broker broker(socket_path);
+        std::thread signal_thread([&]() {
+            int signal_number;
+            sigwait(&signals, &signal_number);
+            broker.stop();
+        });
+        std::cout << "Serving on " << socket_path << std::endl;
+        broker.run();
+        // still waiting if accept() failed, the signal is ignored otherwise
+        pthread_kill(signal_thread.native_handle(), SIGTERM);
+        signal_thread.join();
+        auto stats = broker.get_stats();
+        std::cout << "Requests: " << stats.requests << ", coalesced: " << stats.coalesced
+                  << ", executed: " << stats.executed << std::endl;
+    }
+    catch (std::runtime_error &e) {
+        std::cerr << e.what() << std::endl;
+        return 1;
+    }
+    return 0;
+}
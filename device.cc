@@ -1,3 +1,4 @@
+#include <algorithm>
 #include <chrono>
 #include <thread>
 #include <cstddef>
@@ -5,94 +6,206 @@
 #include <hidapi/hidapi.h>
 #include "include/misc.h"
 #include "include/device.h"
+#include "include/hid_trace.h"
 #include "include/log.h"
 
 using namespace nitrokey::device;
 using namespace nitrokey::log;
+using nitrokey::proto::CommandID;
 
 Device::Device()
     : m_vid(0),
       m_pid(0),
-      m_retry_count(40),
-      m_retry_timeout(100),
+      m_timing({100ms, 10ms, 100ms, 40, 4000ms}),
       mp_devhandle(NULL),
-      last_command_status(0){}
+      last_command_status(0){
+  m_command_latency.fill(std::chrono::milliseconds(0));
+}
 
 bool Device::disconnect() {
   Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
 
-  hid_exit();
+  // close only this device's handle, other devices might be still in use
+  if (mp_devhandle != NULL) hid_close(mp_devhandle);
   mp_devhandle = NULL;
+  m_path.clear();
+  m_serial.clear();
   return true;
 }
 bool Device::connect() {
   Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
 
-  // hid_init();
-  mp_devhandle = hid_open(m_vid, m_pid, NULL);
-  // hid_init();
-  return mp_devhandle != NULL;
+  // open by path, so the device can be found again by reconnect()
+  auto devices = enumerate();
+  if (devices.empty()) return false;
+  return connect_with_path(devices.front().path);
+}
+
+bool Device::connect_with_path(const std::string &path) {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+  mp_devhandle = hid_open_path(path.c_str());
+  if (mp_devhandle == NULL) return false;
+  m_path = path;
+  wchar_t wserial[64];
+  if (hid_get_serial_number_string(mp_devhandle, wserial,
+                                   sizeof wserial / sizeof wserial[0]) == 0) {
+    std::wstring ws(wserial);
+    m_serial = std::string(ws.begin(), ws.end());
+  } else {
+    m_serial.clear();
+  }
+  return true;
+}
+
+bool Device::reconnect() {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+  const std::string serial = m_serial, path = m_path;
+  if (mp_devhandle != NULL) hid_close(mp_devhandle);
+  mp_devhandle = NULL;
+  for (auto &info : enumerate()) {
+    const bool same_device =
+        serial.empty() ? info.path == path : info.serial == serial;
+    if (same_device && connect_with_path(info.path)) {
+      Log::instance().lazy([&]() {
+        return "Reconnected device " + serial + " at " + info.path;
+      }, Loglevel::INFO);
+      return true;
+    }
+  }
+  // keep the identity for the next attempt
+  m_serial = serial;
+  m_path = path;
+  return false;
+}
+
+bool Device::connect_with_serial(const std::string &serial) {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+  for (auto &info : enumerate()) {
+    if (info.serial == serial) return connect_with_path(info.path);
+  }
+  return false;
+}
+
+std::vector<DeviceInfo> Device::enumerate() const {
+  std::vector<DeviceInfo> devices;
+  auto *devs = hid_enumerate(m_vid, m_pid);
+  for (auto *cur = devs; cur != NULL; cur = cur->next) {
+    std::wstring wserial =
+        (cur->serial_number != NULL) ? cur->serial_number : L"";
+    devices.push_back({std::string(cur->path),
+                       std::string(wserial.begin(), wserial.end()), m_model,
+                       false, cur->interface_number});
+  }
+  hid_free_enumeration(devs);
+  return devices;
 }
 
 int Device::send(const void *packet) {
   Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
 
-  if (mp_devhandle == NULL)
+  // a previous reconnection attempt might have failed
+  if (mp_devhandle == NULL && (m_path.empty() || !reconnect()))
     throw std::runtime_error("Attempted HID send on an invalid descriptor.");
 
-  return (hid_send_feature_report(
-      mp_devhandle, (const unsigned char *)(packet), HID_REPORT_SIZE));
+  int status = hid_send_feature_report(
+      mp_devhandle, (const unsigned char *)(packet), HID_REPORT_SIZE);
+  // the device might have been unplugged and plugged in again since
+  // the last command, the old handle is invalid then
+  if (status < 0 && reconnect()) {
+    status = hid_send_feature_report(
+        mp_devhandle, (const unsigned char *)(packet), HID_REPORT_SIZE);
+  }
+  return status;
 }
 
 int Device::recv(void *packet) {
   int status;
-  int retry_count = 0;
 
   Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
 
   if (mp_devhandle == NULL)
     throw std::runtime_error("Attempted HID receive on an invalid descriptor.");
 
-  // FIXME extract error handling and repeating to parent function in
-  // device_proto:192
-  for (;;) {
-    status = (hid_get_feature_report(mp_devhandle, (unsigned char *)(packet),
-                                     HID_REPORT_SIZE));
+  status = (hid_get_feature_report(mp_devhandle, (unsigned char *)(packet),
+                                   HID_REPORT_SIZE));
 
-    // FIXME handle getting libhid error message somewhere else
+  // FIXME handle getting libhid error message somewhere else
+  Log::instance().lazy([&]() {
     auto pwherr = hid_error(mp_devhandle);
     std::wstring wherr = (pwherr != NULL) ? pwherr : L"No error message";
     std::string herr(wherr.begin(), wherr.end());
-    Log::instance()(std::string("libhid error message: ") + herr,
-                    Loglevel::DEBUG_L2);
-
-    if (status > 0) break;  // success
-    if (retry_count++ >= m_retry_count) {
-      Log::instance()(
-          "Maximum retry count reached" + std::to_string(retry_count),
-          Loglevel::WARNING);
-      break;
-    }
-    Log::instance()("Retrying... " + std::to_string(retry_count),
-                    Loglevel::DEBUG);
-    std::this_thread::sleep_for(m_retry_timeout);
-  }
+    return std::string("libhid error message: ") + herr;
+  }, Loglevel::DEBUG_L2);
 
   return status;
 }
 
+void Device::set_trace(std::shared_ptr<TraceWriter> trace) {
+  auto l = lock();
+  m_trace = trace;
+}
+
+void Device::set_timing(const TimingProfile &timing) {
+  auto l = lock();
+  m_timing = timing;
+}
+
+TimingProfile Device::get_timing(CommandID cmd) const {
+  auto it = m_command_timing.find(cmd);
+  return it != m_command_timing.end() ? it->second : m_timing;
+}
+
+void Device::set_command_timing(CommandID cmd, const TimingProfile &timing) {
+  auto l = lock();
+  m_command_timing[cmd] = timing;
+}
+
+void Device::clear_command_timing() {
+  auto l = lock();
+  m_command_timing.clear();
+}
+
+std::chrono::milliseconds Device::get_first_poll_delay(CommandID cmd) const {
+  const auto timing = get_timing(cmd);
+  auto expected = m_command_latency[(uint8_t)cmd];
+  if (expected == 0ms) return timing.min_poll_delay;
+  // never wait longer than the fixed delay used before any measurements
+  return std::min(std::max(expected, timing.min_poll_delay),
+                  timing.send_receive_delay);
+}
+
+std::chrono::milliseconds Device::get_next_poll_delay(
+    CommandID cmd, std::chrono::milliseconds previous) const {
+  const auto timing = get_timing(cmd);
+  return std::min(std::max(previous * 2, timing.min_poll_delay),
+                  timing.retry_timeout);
+}
+
+void Device::register_response_latency(CommandID cmd,
+                                       std::chrono::milliseconds latency,
+                                       bool ready_on_first_poll) {
+  auto &expected = m_command_latency[(uint8_t)cmd];
+  // The response was already waiting on the first poll, so the device
+  // might be faster than expected - probe a bit earlier next time.
+  if (ready_on_first_poll) latency -= latency / 4;
+  const auto min_poll_delay = get_timing(cmd).min_poll_delay;
+  if (latency < min_poll_delay) latency = min_poll_delay;
+  expected = (expected == 0ms) ? latency : (3 * expected + latency) / 4;
+}
+
 Stick10::Stick10() {
   m_vid = 0x20a0;
   m_pid = 0x4108;
   m_model = DeviceModel::PRO;
-    m_send_receive_delay = 100ms;
-  m_retry_count = 100;
+  m_timing = {100ms, 10ms, 100ms, 100, 10000ms};
 }
 
 Stick20::Stick20() {
   m_vid = 0x20a0;
   m_pid = 0x4109;
-  m_retry_timeout = std::chrono::milliseconds(500);
   m_model = DeviceModel::STORAGE;
-    m_send_receive_delay = 1000ms;
+  m_timing = {1000ms, 10ms, 500ms, 40, 20000ms};
 }
@@ -0,0 +1,270 @@
+#include <cstddef>
+#include <cstring>
+#include <ctime>
+#include <fstream>
+#include <iomanip>
+#include <sstream>
+#include <stdexcept>
+#include <thread>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include "include/hid_trace.h"
+#include "include/log.h"
+#include "include/misc.h"
+
+using namespace nitrokey::device;
+using namespace nitrokey::log;
+using nitrokey::proto::CommandID;
+using namespace std::chrono;
+
+namespace {
+
+const char trace_magic[7] = {'N', 'K', 'T', 'R', 'A', 'C', 'E'};
+const uint8_t trace_version = 1;
+// the file grows by this much when the mapping is full
+const size_t trace_chunk_size = 1 << 20;
+
+// offsets of the fields shared by all responses, see DeviceResponse
+const size_t response_device_status = 1;
+const size_t response_command_id = 2;
+const size_t response_last_command_crc = 3;
+const size_t response_last_command_status = 7;
+const size_t report_crc = HID_REPORT_SIZE - 4;
+const uint8_t device_status_busy = 1;
+
+uint32_t read_u32(const uint8_t *p) {
+  uint32_t value;
+  memcpy(&value, p, sizeof value);
+  return value;
+}
+
+void update_report_CRC(uint8_t *report) {
+  const uint32_t crc = nitrokey::misc::stm_crc32(report + 1, HID_REPORT_SIZE - 5);
+  memcpy(report + report_crc, &crc, sizeof crc);
+}
+
+bool is_accepted_response(const TraceRecord &response, uint32_t sent_crc) {
+  return response.status > 0 && response.report[response_device_status] == 0 &&
+         read_u32(response.report + response_last_command_crc) == sent_crc;
+}
+}
+
+TraceWriter::TraceWriter(const std::string &path, DeviceModel model)
+    : m_fd(-1), mp_map(NULL), m_mapped_size(0), m_size(0) {
+  m_fd = open(path.c_str(), O_RDWR | O_CREAT, 0600);
+  if (m_fd < 0) throw std::runtime_error("Cannot open trace file " + path);
+  struct stat st;
+  if (fstat(m_fd, &st) != 0) {
+    close(m_fd);
+    throw std::runtime_error("Cannot open trace file " + path);
+  }
+  const size_t file_size = (size_t)st.st_size;
+
+  if (file_size < sizeof(TraceHeader)) {
+    reserve(sizeof(TraceHeader));
+    TraceHeader header = {};
+    memcpy(header.magic, trace_magic, sizeof header.magic);
+    header.version = trace_version;
+    header.model = (uint8_t)model;
+    memcpy(mp_map, &header, sizeof header);
+    m_size = sizeof header;
+    return;
+  }
+
+  reserve(file_size);
+  TraceHeader header;
+  memcpy(&header, mp_map, sizeof header);
+  if (memcmp(header.magic, trace_magic, sizeof header.magic) != 0 ||
+      header.version != trace_version || header.model != (uint8_t)model) {
+    munmap(mp_map, m_mapped_size);
+    close(m_fd);
+    throw std::runtime_error("Not a trace of this device model: " + path);
+  }
+  // continue after the last complete record, the rest is unused space
+  // of the previous writer's mapping
+  m_size = sizeof header;
+  while (m_size + sizeof(TraceRecord) <= file_size &&
+         mp_map[m_size + offsetof(TraceRecord, direction)] != 0)
+    m_size += sizeof(TraceRecord);
+}
+
+TraceWriter::~TraceWriter() {
+  if (mp_map != NULL) munmap(mp_map, m_mapped_size);
+  if (ftruncate(m_fd, m_size) != 0)
+    Log::instance()("Cannot truncate trace file", Loglevel::WARNING);
+  close(m_fd);
+}
+
+void TraceWriter::reserve(size_t size) {
+  if (size <= m_mapped_size) return;
+  const size_t new_size = (size / trace_chunk_size + 1) * trace_chunk_size;
+  if (mp_map != NULL) munmap(mp_map, m_mapped_size);
+  mp_map = NULL;
+  m_mapped_size = 0;
+  if (ftruncate(m_fd, new_size) != 0)
+    throw std::runtime_error("Cannot extend trace file");
+  void *map = mmap(NULL, new_size, PROT_READ | PROT_WRITE, MAP_SHARED, m_fd, 0);
+  if (map == MAP_FAILED) throw std::runtime_error("Cannot map trace file");
+  mp_map = (uint8_t *)map;
+  m_mapped_size = new_size;
+}
+
+void TraceWriter::append(CommandID cmd, TraceDirection direction, int status,
+                         const void *report) {
+  TraceRecord record;
+  record.time_us = (uint64_t)duration_cast<microseconds>(
+                       system_clock::now().time_since_epoch()).count();
+  record.direction = (uint8_t)direction;
+  record.command_id = (uint8_t)cmd;
+  record.status = (int16_t)status;
+  memcpy(record.report, report, HID_REPORT_SIZE);
+
+  std::lock_guard<std::mutex> lock(m_mutex);
+  reserve(m_size + sizeof record);
+  memcpy(mp_map + m_size, &record, sizeof record);
+  m_size += sizeof record;
+}
+
+std::vector<TraceRecord> nitrokey::device::read_trace(const std::string &path,
+                                                      DeviceModel &model) {
+  std::ifstream file(path, std::ios::binary);
+  TraceHeader header;
+  if (!file.read((char *)&header, sizeof header) ||
+      memcmp(header.magic, trace_magic, sizeof header.magic) != 0 ||
+      header.version != trace_version)
+    throw std::runtime_error("Not a trace file: " + path);
+  model = (DeviceModel)header.model;
+
+  std::vector<TraceRecord> records;
+  TraceRecord record;
+  while (file.read((char *)&record, sizeof record) && record.direction != 0)
+    records.push_back(record);
+  return records;
+}
+
+std::string nitrokey::device::dissect_trace_record(const TraceRecord &record) {
+  std::stringstream out;
+  const std::time_t t = (std::time_t)(record.time_us / 1000000);
+  std::tm tm;
+  gmtime_r(&t, &tm);
+  out << std::put_time(&tm, "%Y-%m-%dT%H:%M:%S") << '.' << std::setw(6)
+      << std::setfill('0') << record.time_us % 1000000 << "Z\t"
+      << (record.direction == (uint8_t)TraceDirection::SENT ? "sent" : "received")
+      << '\t' << proto::commandid_to_string((CommandID)record.command_id)
+      << "\tstatus: " << record.status << std::endl;
+  if (record.direction == (uint8_t)TraceDirection::RECEIVED) {
+    out << "Device status:\t" << (int)record.report[response_device_status]
+        << std::endl
+        << "Last command status:\t" << (int)record.report[response_last_command_status] << std::endl
+        << "Last command CRC:\t" << std::hex
+        << read_u32(record.report + response_last_command_crc) << std::dec
+        << std::endl;
+  }
+  out << misc::hexdump((const char *)record.report, HID_REPORT_SIZE);
+  return out.str();
+}
+
+ReplayDevice::ReplayDevice(const std::string &trace_path, double time_scale)
+    : m_time_scale(time_scale),
+      m_connected(false),
+      m_next(0),
+      mp_current(NULL),
+      m_next_response(0),
+      m_sent_crc(0) {
+  auto records = read_trace(trace_path, m_model);
+  m_timing = m_model == DeviceModel::PRO ? Stick10().get_timing()
+                                         : Stick20().get_timing();
+  m_path = trace_path;
+
+  for (auto &record : records) {
+    if (record.direction == (uint8_t)TraceDirection::SENT) {
+      m_exchanges.push_back({record, {}, -1, microseconds(0)});
+      continue;
+    }
+    // responses without a preceding command can't be replayed
+    if (m_exchanges.empty()) continue;
+    auto &exchange = m_exchanges.back();
+    exchange.responses.push_back(record);
+    if (exchange.accepted == -1 &&
+        is_accepted_response(record, read_u32(exchange.sent.report + report_crc))) {
+      exchange.accepted = (int)exchange.responses.size() - 1;
+      exchange.latency = microseconds(record.time_us - exchange.sent.time_us);
+    }
+  }
+}
+
+bool ReplayDevice::connect() {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+  m_connected = true;
+  return true;
+}
+
+bool ReplayDevice::disconnect() {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+  m_connected = false;
+  return true;
+}
+
+int ReplayDevice::send(const void *packet) {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+  if (!m_connected)
+    throw std::runtime_error("Attempted HID send on an invalid descriptor.");
+
+  const uint8_t *report = (const uint8_t *)packet;
+  mp_current = NULL;
+  if (m_next == m_exchanges.size()) {
+    Log::instance()("Replayed trace has no more commands", Loglevel::ERROR);
+    return -1;
+  }
+  if (m_exchanges[m_next].sent.command_id != report[1]) {
+    Log::instance().lazy([&]() {
+      return std::string("Replayed trace expects command ") +
+             proto::commandid_to_string((CommandID)m_exchanges[m_next].sent.command_id) +
+             ", got " + proto::commandid_to_string((CommandID)report[1]);
+    }, Loglevel::ERROR);
+    return -1;
+  }
+  mp_current = &m_exchanges[m_next++];
+  m_next_response = 0;
+  // the payload (e.g. time) might differ from the recorded one,
+  // responses are patched to answer this report
+  m_sent_crc = read_u32(report + report_crc);
+  m_response_ready_at =
+      steady_clock::now() +
+      duration_cast<steady_clock::duration>(mp_current->latency * m_time_scale);
+  return mp_current->sent.status;
+}
+
+int ReplayDevice::recv(void *packet) {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+  if (!m_connected)
+    throw std::runtime_error("Attempted HID receive on an invalid descriptor.");
+  if (mp_current == NULL) return -1;
+
+  uint8_t *report = (uint8_t *)packet;
+  if (mp_current->accepted == -1) {
+    // the device never answered during recording, repeat what was seen
+    if (m_next_response == mp_current->responses.size()) return -1;
+    auto &response = mp_current->responses[m_next_response++];
+    memcpy(report, response.report, HID_REPORT_SIZE);
+    return response.status;
+  }
+
+  auto &response = mp_current->responses[mp_current->accepted];
+  memcpy(report, response.report, HID_REPORT_SIZE);
+  if (steady_clock::now() < m_response_ready_at) {
+    // still working on the command, nothing but the status is valid
+    memset(report, 0, HID_REPORT_SIZE);
+    report[response_device_status] = device_status_busy;
+    report[response_command_id] = mp_current->sent.command_id;
+    update_report_CRC(report);
+    return HID_REPORT_SIZE;
+  }
+  memcpy(report + response_last_command_crc, &m_sent_crc, sizeof m_sent_crc);
+  update_report_CRC(report);
+  return response.status;
+}
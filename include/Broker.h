@@ -0,0 +1,121 @@
+#ifndef LIBNITROKEY_BROKER_H
+#define LIBNITROKEY_BROKER_H
+
+#include <atomic>
+#include <condition_variable>
+#include <deque>
+#include <list>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <set>
+#include <string>
+#include <thread>
+#include "broker_protocol.h"
+
+namespace nitrokey {
+namespace broker {
+
+    /**
+     * Local daemon owning the device connections, so many processes can use one device at the same time.
+     * Clients connect to a Unix domain socket and send the operations of BrokerOp (@see broker_protocol.h).
+     * Each device (selected by the model given on login) is used by a single worker thread.
+     * Waiting requests are served round-robin between client processes, so a process with many
+     * connections does not starve the others. Identical reads waiting in the queue at the same time
+     * (e.g. TOTP codes of the same slot and challenge) are sent to the device once.
+     *
+     * The socket is accessible to the user running the broker only, and only processes of that user
+     * (or root) are served (@see is_trusted_peer). All clients share the device's authentication state:
+     * once one client unlocked the password safe or authenticated, every client can read the passwords.
+     * LOGOUT only detaches the client from the device and locks nothing, and password reads of different
+     * clients are answered with the same result.
+     */
+    class Broker {
+    public:
+        struct Stats {
+            uint64_t requests;
+            uint64_t coalesced;  // requests answered with the result of an identical one
+            uint64_t executed;   // operations run on a device
+        };
+
+        /**
+         * Create the socket, replacing a stale one.
+         * @throws std::runtime_error if the socket can't be created
+         */
+        explicit Broker(const std::string &socket_path = default_socket_path());
+
+        /**
+         * Stop serving and disconnect the devices.
+         */
+        ~Broker();
+
+        Broker(const Broker &) = delete;
+        Broker &operator=(const Broker &) = delete;
+
+        /**
+         * Accept and serve clients until stop() is called.
+         */
+        void run();
+        void stop();
+
+        Stats get_stats();
+
+    private:
+        struct Job {
+            BrokerOp op;
+            Message arguments;
+            std::string key;  // empty if not coalescable
+            bool done = false;
+            Message result;
+        };
+
+        /**
+         * Device used by all clients which logged in with the same model.
+         */
+        class Worker {
+        public:
+            Worker(Broker &broker, const std::string &model);
+            ~Worker();
+
+            /**
+             * Queue the request and wait for its result.
+             */
+            Message execute(uint64_t client, BrokerOp op, Message &arguments);
+
+        private:
+            void run();
+            bool connect();
+            Message execute_operation(BrokerOp op, Message &arguments);
+
+            Broker &m_broker;
+            const std::string m_model;
+            bool m_connected;
+
+            std::mutex m_mutex;
+            std::condition_variable m_jobs_cv;
+            std::condition_variable m_done_cv;
+            // waiting jobs of each client process, clients take turns in m_turns order
+            std::map<uint64_t, std::deque<std::shared_ptr<Job>>> m_queues;
+            std::list<uint64_t> m_turns;
+            std::map<std::string, std::shared_ptr<Job>> m_waiting_reads;
+            bool m_stop;
+            std::thread m_thread;
+        };
+
+        void serve(int fd);
+        Worker &get_worker(const std::string &model);
+
+        const std::string m_socket_path;
+        int m_listen_fd;
+        std::atomic<bool> m_stop;
+
+        std::mutex m_mutex;
+        std::map<std::string, std::unique_ptr<Worker>> m_workers;
+        std::set<int> m_client_fds;
+        std::condition_variable m_clients_cv;
+        Stats m_stats;
+    };
+}
+}
+
+#endif //LIBNITROKEY_BROKER_H
@@ -0,0 +1,58 @@
+#ifndef LIBNITROKEY_COMMANDQUEUE_H
+#define LIBNITROKEY_COMMANDQUEUE_H
+
+#include <condition_variable>
+#include <deque>
+#include <functional>
+#include <future>
+#include <memory>
+#include <mutex>
+#include <thread>
+
+namespace nitrokey {
+
+    /**
+     * Worker thread executing submitted jobs one after another, in submission order.
+     * Used to run device commands without blocking the caller.
+     */
+    class CommandQueue {
+    public:
+        CommandQueue();
+
+        /**
+         * Waits for all already submitted jobs to finish. If called from one of the jobs (e.g. the job released
+         * the last reference to the queue's owner), the waiting jobs are dropped instead, their futures report
+         * std::future_errc::broken_promise, and the worker thread exits after the current job.
+         */
+        ~CommandQueue();
+
+        CommandQueue(const CommandQueue &) = delete;
+        CommandQueue &operator=(const CommandQueue &) = delete;
+
+        template <typename F>
+        auto submit(F &&job) -> std::future<decltype(job())> {
+            using R = decltype(job());
+            auto task = std::make_shared<std::packaged_task<R()>>(std::forward<F>(job));
+            auto result = task->get_future();
+            push([task](){ (*task)(); });
+            return result;
+        }
+
+    private:
+        // shared with the worker thread, which might outlive the queue (@see ~CommandQueue)
+        struct State {
+            std::mutex mutex;
+            std::condition_variable cv;
+            std::deque<std::function<void()>> jobs;
+            bool stop = false;
+        };
+
+        void push(std::function<void()> job);
+        static void run(std::shared_ptr<State> state);
+
+        std::shared_ptr<State> m_state;
+        std::thread m_thread;
+    };
+}
+
+#endif //LIBNITROKEY_COMMANDQUEUE_H
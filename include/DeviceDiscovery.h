@@ -0,0 +1,61 @@
+#ifndef LIBNITROKEY_DEVICEDISCOVERY_H
+#define LIBNITROKEY_DEVICEDISCOVERY_H
+
+#include <chrono>
+#include <mutex>
+#include <string>
+#include <vector>
+#include "device.h"
+
+namespace nitrokey {
+    using namespace nitrokey::device;
+
+    /**
+     * Connected Nitrokey devices, found with a single hid_enumerate pass over all HID devices and classified
+     * by VID/PID as Pro, Storage or Storage in firmware update mode. The list is cached and enumerated again
+     * only after a hot-plug event, detected as a change of the USB device nodes in /dev/bus/usb. Where there
+     * are none (e.g. not on Linux), the list is enumerated again when older than the refresh interval.
+     * All methods are thread-safe.
+     */
+    class DeviceDiscovery {
+    public:
+        static DeviceDiscovery &instance();
+
+        /**
+         * @param include_update_mode include Storage devices in firmware update mode, which accept no commands
+         */
+        std::vector<DeviceInfo> get_devices(bool include_update_mode = false);
+
+        /**
+         * Enumerate again on the next request, e.g. after failing to open a listed device.
+         */
+        void invalidate();
+
+        void set_refresh_interval(std::chrono::milliseconds interval);
+
+        /**
+         * Number of hid_enumerate passes done so far.
+         */
+        uint64_t get_enumeration_count();
+
+        /**
+         * Nitrokey devices from the result of hid_enumerate, others are skipped.
+         */
+        static std::vector<DeviceInfo> from_enumeration(const hid_device_info *devices);
+
+    private:
+        DeviceDiscovery();
+
+        static std::string hotplug_state();
+
+        std::mutex m_mutex;
+        bool m_valid;
+        std::vector<DeviceInfo> m_devices;
+        std::string m_hotplug_state;
+        std::chrono::steady_clock::time_point m_enumerated;
+        std::chrono::milliseconds m_refresh_interval;
+        uint64_t m_enumeration_count;
+    };
+}
+
+#endif //LIBNITROKEY_DEVICEDISCOVERY_H
@@ -0,0 +1,84 @@
+#ifndef LIBNITROKEY_DEVICEPOOL_H
+#define LIBNITROKEY_DEVICEPOOL_H
+
+#include <chrono>
+#include <functional>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <vector>
+#include "device.h"
+
+namespace nitrokey {
+    using namespace nitrokey::device;
+
+    /**
+     * Process-wide pool of open Nitrokey Pro and Storage devices, keyed by USB serial number
+     * (or by path for devices without one). Devices are opened on first request and kept open
+     * after being released, so connecting again does not enumerate and open the device.
+     * A device idle in the pool for longer than the keep-alive interval is checked with GetStatus
+     * when handed out again; if it does not answer it is reopened, otherwise dropped. The check holds only
+     * the device's lock, so a device that does not answer does not delay requests for the other devices.
+     * Devices are shared between all their users, access is serialized with Device::lock.
+     * All methods are thread-safe.
+     */
+    class DevicePool {
+    public:
+        static DevicePool &instance();
+        static std::shared_ptr<Device> make_device(DeviceModel model);
+
+        /**
+         * @return first open device of the model, or first connected one if none is open;
+         * nullptr if there is none
+         */
+        std::shared_ptr<Device> get(DeviceModel model);
+        std::shared_ptr<Device> get_by_path(const std::string &path);
+        std::shared_ptr<Device> get_by_serial(const std::string &serial);
+
+        /**
+         * Mark the device as idle.
+         * @return false if the device is not managed by the pool
+         */
+        bool release(const std::shared_ptr<Device> &device);
+
+        /**
+         * Close all pooled devices. Devices still held elsewhere are closed as well.
+         */
+        void close_all();
+
+        void set_keep_alive_interval(std::chrono::milliseconds interval);
+
+    private:
+        DevicePool();
+
+        struct Entry {
+            DeviceModel model;
+            std::string path;  // as of the last check, the device's own is changed under its lock
+            std::shared_ptr<Device> device;
+            std::chrono::steady_clock::time_point last_used;
+        };
+
+        // pooled device handed out, checked without the pool lock
+        struct Candidate {
+            std::shared_ptr<Device> device;
+            bool idle;  // unused for longer than the keep-alive interval
+            std::string path;
+        };
+
+        std::vector<Candidate> candidates(std::function<bool(const std::string &key, const Entry &)> matches);
+        static bool check(Candidate &candidate);
+        /**
+         * Check the device, drop it from the pool if it cannot be reconnected.
+         */
+        bool usable(Candidate &candidate);
+        std::shared_ptr<Device> open(const DeviceInfo &info);
+        static std::string key(const DeviceInfo &info);
+
+        std::mutex m_mutex;
+        std::map<std::string, Entry> m_devices;
+        std::chrono::milliseconds m_keep_alive_interval;
+    };
+}
+
+#endif //LIBNITROKEY_DEVICEPOOL_H
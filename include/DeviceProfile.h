@@ -0,0 +1,91 @@
+#ifndef LIBNITROKEY_DEVICEPROFILE_H
+#define LIBNITROKEY_DEVICEPROFILE_H
+
+#include <string>
+#include <vector>
+#include "inttypes.h"
+#include "misc.h"
+
+namespace nitrokey {
+
+    /**
+     * Overwrite the secret before its memory is released.
+     */
+    inline void clear_secret(std::string &secret) {
+        misc::secure_clear(&secret[0], secret.size());
+        secret.clear();
+    }
+
+    struct GeneralConfigProfile {
+        uint8_t numlock;
+        uint8_t capslock;
+        uint8_t scrolllock;
+        bool enable_user_password;
+        bool delete_user_password;
+    };
+
+    struct OTPSlotProfile {
+        uint8_t slot_number;
+        std::string name;
+        std::string secret; // hex string
+        bool use_8_digits;
+        bool use_enter;
+        bool use_tokenID;
+        std::string token_ID;
+        uint8_t hotp_counter; // HOTP only
+        uint16_t time_window; // TOTP only
+        /**
+         * Secrets can't be read back from the device, so OTP slots are written unconditionally.
+         * When set, the slot is skipped if its name, flags and token ID already match;
+         * use it only when the secret is known to be unchanged.
+         */
+        bool skip_if_unchanged;
+
+        // also disables moving, so copies are cleared as well
+        ~OTPSlotProfile() { clear_secret(secret); }
+    };
+
+    struct PasswordSafeSlotProfile {
+        uint8_t slot_number;
+        std::string name;
+        std::string login;
+        std::string password;
+
+        ~PasswordSafeSlotProfile() { clear_secret(password); }
+    };
+
+    /**
+     * Complete device configuration applied with NitrokeyManager::apply_profile.
+     * OTP secrets and passwords are overwritten when the items are released.
+     */
+    struct DeviceProfile {
+        bool set_config = false;
+        GeneralConfigProfile config = {};
+        std::vector<OTPSlotProfile> hotp_slots;
+        std::vector<OTPSlotProfile> totp_slots;
+        std::vector<PasswordSafeSlotProfile> password_safe_slots;
+
+        void clear() {
+            set_config = false;
+            config = {};
+            hotp_slots.clear();
+            totp_slots.clear();
+            password_safe_slots.clear();
+        }
+
+        size_t size() const {
+            return (set_config ? 1 : 0) + hotp_slots.size() + totp_slots.size() + password_safe_slots.size();
+        }
+    };
+
+    /**
+     * Outcome of a single profile item. Items are reported in the order: configuration (if set),
+     * HOTP slots, TOTP slots, password safe slots.
+     */
+    struct ProfileItemResult {
+        bool written;   // false if the device already had the requested state or on failure
+        uint8_t status; // last command status or library error code, 0 on success
+    };
+}
+
+#endif //LIBNITROKEY_DEVICEPROFILE_H
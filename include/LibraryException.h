@@ -12,6 +12,68 @@ public:
 
 
 
+class DeviceCommunicationException : public LibraryException {
+public:
+    virtual uint8_t exception_id() override {
+        return 207;
+    }
+
+    std::string message;
+
+    DeviceCommunicationException(const std::string &message) : message(message) {}
+
+    virtual const char *what() const throw() override {
+        return message.c_str();
+    }
+
+};
+
+class DeviceNotConnectedException : public LibraryException {
+public:
+    virtual uint8_t exception_id() override {
+        return 206;
+    }
+
+    virtual const char *what() const throw() override {
+        return "Device not connected";
+    }
+
+};
+
+class UnknownOTPSecretException : public LibraryException {
+public:
+    virtual uint8_t exception_id() override {
+        return 205;
+    }
+
+public:
+    int secret_id;
+
+    UnknownOTPSecretException(int secret_id) : secret_id(secret_id) {}
+
+    virtual const char *what() const throw() override {
+        return "Unknown OTP secret selected";
+    }
+
+};
+
+class InvalidOTPAlgorithmException : public LibraryException {
+public:
+    virtual uint8_t exception_id() override {
+        return 204;
+    }
+
+public:
+    uint8_t algorithm;
+
+    InvalidOTPAlgorithmException(uint8_t algorithm) : algorithm(algorithm) {}
+
+    virtual const char *what() const throw() override {
+        return "Unsupported OTP hash algorithm";
+    }
+
+};
+
 class TargetBufferSmallerThanSource: public LibraryException {
 public:
     virtual uint8_t exception_id() override {
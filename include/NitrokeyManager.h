@@ -6,8 +6,19 @@
 #include "device_proto.h"
 #include "stick10_commands.h"
 #include "stick20_commands.h"
+#include "CommandQueue.h"
+#include "simulated_device.h"
+#include "hid_trace.h"
+#include "DevicePool.h"
+#include "DeviceDiscovery.h"
+#include "DeviceProfile.h"
+#include "TOTPService.h"
+#include <chrono>
 #include <vector>
+#include <map>
 #include <memory>
+#include <future>
+#include <mutex>
 
 namespace nitrokey {
     using namespace nitrokey::device;
@@ -19,7 +30,19 @@ namespace nitrokey {
 
     class NitrokeyManager {
     public:
+        /**
+         * Process-wide manager used by the C API by default.
+         * Further, independent managers (e.g. one per connected device) can be
+         * created with the public constructor.
+         */
         static shared_ptr <NitrokeyManager> instance();
+        NitrokeyManager();
+
+        /**
+         * List all connected Nitrokey Pro and Storage devices, Pro first (@see DeviceDiscovery).
+         * @param include_update_mode include Storage devices in firmware update mode, which cannot be connected
+         */
+        static vector<DeviceInfo> list_devices(bool include_update_mode = false);
 
         bool first_authenticate(const char *pin, const char *temporary_password);
         bool write_HOTP_slot(uint8_t slot_number, const char *slot_name, const char *secret, uint8_t hotp_counter,
@@ -31,12 +54,82 @@ namespace nitrokey {
         uint32_t get_HOTP_code(uint8_t slot_number, const char *user_temporary_password);
         uint32_t get_TOTP_code(uint8_t slot_number, uint64_t challenge, uint64_t last_totp_time, uint8_t last_interval,
                                const char *user_temporary_password);
+
+        /**
+         * Run the job on this manager's worker thread. Jobs are executed one by one in submission order,
+         * so the device is used by a single thread; the worker is started on first use.
+         * @return future with the job's result or exception
+         */
+        template <typename F>
+        auto async(F &&job) -> std::future<decltype(job())> {
+            return get_command_queue().submit(std::forward<F>(job));
+        }
+
+        std::future<uint32_t> get_HOTP_code_async(uint8_t slot_number, const char *user_temporary_password);
+        std::future<uint32_t> get_TOTP_code_async(uint8_t slot_number, uint64_t challenge, uint64_t last_totp_time,
+                                                  uint8_t last_interval, const char *user_temporary_password);
         bool set_time(uint64_t time);
         bool get_time();
+
+        /**
+         * Read the TOTP code for the given time, with no other command in between. The device time is set
+         * only if it is not known to match the given time (@see device_time_matches), so calling this with
+         * the current host time does not rewrite the device clock with each read.
+         * @see get_TOTP_code
+         */
+        uint32_t get_TOTP_code_at(uint8_t slot_number, uint64_t time, const char *user_temporary_password);
+
+        /**
+         * Memoized TOTP codes for the current time, created on first use.
+         * The service sets the device time when it has drifted from the host time.
+         */
+        TOTPService &get_TOTP_service();
         bool erase_totp_slot(uint8_t slot_number, const char *temporary_password);
         bool erase_hotp_slot(uint8_t slot_number, const char *temporary_password);
+        /**
+         * Connect to device of given model: "P" - Pro, "S" - Storage, or to an in-process simulated device:
+         * "sim" or "sim-pro" - Pro, "sim-storage" - Storage (@see SimulatedDevice).
+         */
         bool connect(const char *device_model);
         bool connect();
+        bool connect_simulated(DeviceModel model, SimulatedDevice::Options options);
+
+        /**
+         * Change latency and busy responses of the connected simulated device.
+         * @return false if the connected device is not simulated
+         */
+        bool set_simulation_options(SimulatedDevice::Options options);
+
+        /**
+         * Connect to a device replaying the trace recorded with start_recording (@see ReplayDevice).
+         * @param time_scale multiplies the recorded response latencies, 0 answers immediately
+         * @throws std::runtime_error if the file is not a trace
+         */
+        bool connect_replay(const string &trace_path, double time_scale);
+
+        /**
+         * Record all reports sent to and received from the connected device into the trace file,
+         * appending to the trace already there. Reports contain PINs and secrets as sent to the device.
+         * @throws std::runtime_error if the file can't be used
+         */
+        void start_recording(const string &trace_path);
+        void stop_recording();
+
+        /**
+         * Change response polling of the connected device, for all commands or for a single one.
+         * Pooled devices are shared, so the change applies to all users of the device.
+         */
+        TimingProfile get_timing();
+        TimingProfile get_timing(CommandID command);
+        void set_timing(const TimingProfile &timing);
+        void set_command_timing(CommandID command, const TimingProfile &timing);
+        void clear_command_timing();
+        bool connect_with_path(const string &path);
+        bool connect_with_serial(const string &serial);
+        /**
+         * Stop using the device. Nitrokey Pro and Storage devices are kept open in DevicePool,
+         * simulated devices are disconnected.
+         */
         bool disconnect();
         void set_debug(bool state);
         string get_status();
@@ -45,6 +138,40 @@ namespace nitrokey {
         const char * get_totp_slot_name(uint8_t slot_number);
         const char * get_hotp_slot_name(uint8_t slot_number);
 
+        /**
+         * Variants of the getters above writing the null-terminated result into the caller's buffer
+         * instead of a new heap copy.
+         * @throws TargetBufferSmallerThanSource if the result with terminating null does not fit
+         */
+        void get_totp_slot_name(uint8_t slot_number, char *buffer, size_t buffer_size);
+        void get_hotp_slot_name(uint8_t slot_number, char *buffer, size_t buffer_size);
+
+        /**
+         * Read names of all OTP slots in one go, HOTP slots first, then TOTP slots.
+         * @param statuses set to command processing error code for each slot
+         * @return slot names, empty for slots which could not be read
+         */
+        vector<string> get_all_slot_names(vector<uint8_t> &statuses);
+
+        /**
+         * Get TOTP codes from many slots in one go.
+         * @see get_TOTP_code
+         * @param statuses set to command processing error code for each slot
+         * @return codes in order of slot_numbers, 0 for slots which could not be read
+         */
+        vector<uint32_t> get_TOTP_codes(const vector<uint8_t> &slot_numbers, uint64_t challenge,
+                                        uint64_t last_totp_time, uint8_t last_interval,
+                                        const char *user_temporary_password, vector<uint8_t> &statuses);
+
+        /**
+         * Bring the device to the state described by the profile. Configuration and slots already
+         * matching the profile are skipped; the admin PIN is checked only if something has to be written,
+         * the password safe is unlocked only if the profile has password safe slots.
+         * @return result for each profile item, see ProfileItemResult for the order
+         */
+        vector<ProfileItemResult> apply_profile(const DeviceProfile &profile, const char *admin_pin,
+                                                const char *user_pin, const char *admin_temporary_password);
+
         void change_user_PIN(char *current_PIN, char *new_PIN);
         void change_admin_PIN(char *current_PIN, char *new_PIN);
 
@@ -61,10 +188,46 @@ namespace nitrokey {
         const char *get_password_safe_slot_password(uint8_t slot_number);
         const char *get_password_safe_slot_login(uint8_t slot_number);
 
+        /**
+         * Variants writing into the caller's buffer. The value is copied straight from the device response,
+         * which is cleared afterwards, so no other copy of it is left in memory.
+         * @throws TargetBufferSmallerThanSource if the value with terminating null does not fit
+         */
+        void get_password_safe_slot_name(uint8_t slot_number, char *buffer, size_t buffer_size);
+        void get_password_safe_slot_password(uint8_t slot_number, char *buffer, size_t buffer_size);
+        void get_password_safe_slot_login(uint8_t slot_number, char *buffer, size_t buffer_size);
+
         void
     write_password_safe_slot(uint8_t slot_number, const char *slot_name, const char *slot_login,
                                  const char *slot_password);
 
+        /**
+         * Password safe slot in the buffers of get_password_safe_slots and write_password_safe_slots,
+         * with null-terminated fields.
+         */
+        struct PasswordSafeSlot {
+            char name[PWS_SLOTNAME_LENGTH + 1];
+            char login[PWS_LOGINNAME_LENGTH + 1];
+            char password[PWS_PASSWORD_LENGTH + 1];
+        };
+
+        /**
+         * Read all programmed password safe slots with the device locked for the whole read. Empty slots are
+         * skipped by the slot status. Values are copied straight from the device responses, which are cleared.
+         * @param slots PWS_SLOT_COUNT records, filled for programmed slots and zeroed for the others;
+         * zeroed completely if reading fails
+         * @return slot status, 1 for programmed slots
+         */
+        vector<uint8_t> get_password_safe_slots(PasswordSafeSlot *slots);
+
+        /**
+         * Write the slots with non-zero status in one sequence of commands, with the device locked.
+         * @param slots PWS_SLOT_COUNT records
+         * @param slot_status PWS_SLOT_COUNT values, e.g. as returned by get_password_safe_slots
+         * @throws CommandFailedException for the first failed write, the following slots are not written
+         */
+        void write_password_safe_slots(const PasswordSafeSlot *slots, const vector<uint8_t> &slot_status);
+
         void erase_password_safe_slot(uint8_t slot_number);
 
         void user_authenticate(const char *user_password, const char *temporary_password);
@@ -82,14 +245,74 @@ namespace nitrokey {
 
         bool is_AES_supported(const char *user_password);
 
+        /**
+         * Enable cache for rarely changing, read-only data: OTP slot names, password safe slot status,
+         * configuration and serial number. The cache is cleared by every command changing this data
+         * (slot writes and erases, configuration writes, locking, factory reset, AES key generation)
+         * and by connecting or disconnecting. Disabled by default.
+         */
+        void set_cache_enabled(bool enabled);
+        void get_cache_statistics(uint64_t &hits, uint64_t &misses);
+        void reset_cache_statistics();
+
+        /**
+         * Incremented whenever cached data is invalidated (@see set_cache_enabled), also with the cache disabled,
+         * so callers can tell whether data they keep might be outdated.
+         */
+        uint64_t get_cache_generation();
+
         ~NitrokeyManager();
     private:
-        NitrokeyManager();
-
         static shared_ptr <NitrokeyManager> _instance;
         bool connected;
         std::shared_ptr<Device> device;
 
+
+        template <typename T>
+        struct CachedValue {
+            bool valid = false;
+            T value;
+        };
+        std::mutex cache_mutex;
+        bool cache_enabled;
+        uint64_t cache_generation;
+        uint64_t cache_hits;
+        uint64_t cache_misses;
+        CachedValue<GetStatus::ResponsePayload> cached_status;
+        CachedValue<vector<uint8_t>> cached_password_safe_slot_status;
+        std::map<uint8_t, CachedValue<string>> cached_slot_names;
+        // last time set on the device and when, guarded by cache_mutex, forgotten with the cache
+        bool device_time_known;
+        uint64_t device_time;
+        std::chrono::steady_clock::time_point device_time_set_at;
+        bool device_time_matches(uint64_t time);
+
+        template <typename T, typename F>
+        T cached(CachedValue<T> &entry, F read_from_device);
+        void invalidate_cache();
+        GetStatus::ResponsePayload read_status();
+
+        /**
+         * Held by commands changing data on the device: keeps the device locked and invalidates the cache
+         * after the command, also when it failed. Invalidating before the change would let a concurrent read
+         * cache the old value again.
+         */
+        class CacheInvalidation {
+        public:
+            explicit CacheInvalidation(NitrokeyManager &manager);
+            ~CacheInvalidation();
+        private:
+            NitrokeyManager &manager;
+            std::unique_lock<std::recursive_mutex> lock;
+        };
+
+        std::mutex command_queue_mutex;
+        unique_ptr<CommandQueue> command_queue;
+        CommandQueue &get_command_queue();
+
+        std::mutex totp_service_mutex;
+        unique_ptr<TOTPService> totp_service;
+
         bool is_valid_hotp_slot_number(uint8_t slot_number) const;
         bool is_valid_totp_slot_number(uint8_t slot_number) const;
         bool is_valid_password_safe_slot_number(uint8_t slot_number) const;
@@ -97,6 +320,8 @@ namespace nitrokey {
         uint8_t get_internal_slot_number_for_totp(uint8_t slot_number) const;
         bool erase_slot(uint8_t slot_number, const char *temporary_password);
         const char * get_slot_name(uint8_t slot_number);
+        string read_slot_name(uint8_t slot_number);
+        bool otp_slot_matches(uint8_t internal_slot_number, const OTPSlotProfile &slot);
 
         template <typename ProCommand, PasswordKind StoKind>
         void change_PIN_general(char *current_PIN, char *new_PIN);
@@ -0,0 +1,80 @@
+#ifndef LIBNITROKEY_OTPVERIFIER_H
+#define LIBNITROKEY_OTPVERIFIER_H
+
+#include <map>
+#include <memory>
+#include <mutex>
+#include <vector>
+#include "inttypes.h"
+
+namespace nitrokey {
+
+    enum class OTPAlgorithm : uint8_t {
+        SHA1 = 0,
+        SHA256 = 1,
+        SHA512 = 2,
+    };
+
+    /**
+     * Host-side HOTP (RFC 4226) and TOTP (RFC 6238) verification for many secrets.
+     * Secrets are kept only as precomputed HMAC key states. Codes computed for a secret are cached,
+     * together with the codes for the next counter/time step after each checked window,
+     * so consecutive verifications mostly compare against already computed values.
+     * All methods are thread-safe.
+     */
+    class OTPVerifier {
+    public:
+        static const int64_t no_match = -1;
+
+        struct TOTPRequest {
+            int secret_id;
+            uint32_t code;
+        };
+
+        OTPVerifier();
+        ~OTPVerifier();
+
+        /**
+         * Register secret given as hex string, the same format as used for the device slots.
+         * @return secret id, greater than 0
+         */
+        int add_secret(const char *secret, OTPAlgorithm algorithm, bool use_8_digits);
+        bool remove_secret(int secret_id);
+
+        uint32_t get_HOTP_code(int secret_id, uint64_t counter);
+        uint32_t get_TOTP_code(int secret_id, uint64_t time, uint16_t time_step = 30);
+
+        /**
+         * Check the code against counters counter..counter+look_ahead.
+         * @return matching counter or no_match
+         */
+        int64_t verify_HOTP(int secret_id, uint32_t code, uint64_t counter, uint32_t look_ahead);
+
+        /**
+         * Check the code against time steps time/time_step-window..time/time_step+window.
+         * @return matching time step or no_match
+         */
+        int64_t verify_TOTP(int secret_id, uint32_t code, uint64_t time, uint16_t time_step, uint8_t window);
+
+        /**
+         * Verify many TOTP codes for the same moment under a single lock.
+         * @return matching time step or no_match for each request, in request order;
+         * requests for unknown secrets are reported as no_match
+         */
+        std::vector<int64_t> verify_TOTP(const std::vector<TOTPRequest> &requests, uint64_t time,
+                                         uint16_t time_step, uint8_t window);
+
+    private:
+        struct Secret;
+
+        Secret &get_secret(int secret_id);
+        uint32_t get_code(Secret &secret, uint64_t counter);
+        int64_t find_code(Secret &secret, uint32_t code, uint64_t first_counter, uint64_t last_counter);
+
+        std::mutex m_mutex;
+        std::map<int, std::unique_ptr<Secret>> m_secrets;
+        int m_last_secret_id;
+    };
+}
+
+#endif //LIBNITROKEY_OTPVERIFIER_H
@@ -0,0 +1,75 @@
+#ifndef LIBNITROKEY_TOTPSERVICE_H
+#define LIBNITROKEY_TOTPSERVICE_H
+
+#include <chrono>
+#include <functional>
+#include <map>
+#include <mutex>
+#include <string>
+#include <tuple>
+#include "inttypes.h"
+
+namespace nitrokey {
+
+    class NitrokeyManager;
+
+    /**
+     * TOTP codes for the current host time, read from the device once per slot and time step.
+     * The device time is set to the host time when it is unknown or has drifted
+     * (@see NitrokeyManager::get_TOTP_code_at), so callers do not have to set it.
+     * Codes are not read ahead for the next time step, since that would need the device clock
+     * set to a future time.
+     * Codes read with a user temporary password (PIN protected OTP) are returned only to callers giving
+     * the same password, the password itself is not kept.
+     * Codes are dropped when slots or the configuration change (@see NitrokeyManager::get_cache_generation).
+     * All methods are thread-safe.
+     */
+    class TOTPService {
+    public:
+        // seconds in unix epoch
+        typedef std::function<uint64_t()> Clock;
+
+        struct Statistics {
+            uint64_t hits;          // codes returned without a device read
+            uint64_t device_reads;  // codes read from the device
+        };
+
+        static uint64_t system_time();
+
+        explicit TOTPService(NitrokeyManager &manager, Clock clock = system_time);
+
+        TOTPService(const TOTPService &) = delete;
+        TOTPService &operator=(const TOTPService &) = delete;
+
+        /**
+         * @param time_window time step the slot was written with
+         * @param user_temporary_password user temporary password if PIN protected OTP codes are enabled,
+         * otherwise empty string or nullptr
+         * @throws CommandFailedException, LibraryException like NitrokeyManager::get_TOTP_code
+         */
+        uint32_t get_code(uint8_t slot_number, uint16_t time_window = 30,
+                          const char *user_temporary_password = "");
+
+        void set_clock(Clock clock);
+
+        Statistics get_statistics();
+        void reset_statistics();
+        void clear();
+
+    private:
+        // slot, time window, time step, hash of the user temporary password
+        typedef std::tuple<uint8_t, uint16_t, uint64_t, std::string> CodeKey;
+
+        void drop_outdated_codes(uint64_t now);
+
+        NitrokeyManager &m_manager;
+        Clock m_clock;
+
+        std::mutex m_mutex;
+        std::map<CodeKey, uint32_t> m_codes;
+        uint64_t m_generation;
+        Statistics m_statistics;
+    };
+}
+
+#endif //LIBNITROKEY_TOTPSERVICE_H
@@ -0,0 +1,134 @@
+#ifndef LIBNITROKEY_ASYNC_LOG_H
+#define LIBNITROKEY_ASYNC_LOG_H
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <fstream>
+#include <memory>
+#include <mutex>
+#include <ostream>
+#include <string>
+#include <thread>
+#include "log.h"
+
+namespace nitrokey {
+namespace log {
+
+struct LogRecord {
+  std::chrono::system_clock::time_point time;
+  Loglevel level;
+  std::string message;
+};
+
+/*
+ *	Output of AsyncLogHandler, used only from its writer thread.
+ */
+class LogSink {
+ public:
+  virtual ~LogSink() {}
+  virtual void write(const LogRecord &record) = 0;
+  /*
+   *	Called once after each batch of written records.
+   */
+  virtual void flush() = 0;
+};
+
+/*
+ *	Lines formatted like StdlogHandler's.
+ */
+class StreamLogSink : public LogSink {
+ public:
+  explicit StreamLogSink(std::ostream &stream) : m_stream(stream) {}
+  virtual void write(const LogRecord &record);
+  virtual void flush();
+
+ private:
+  std::ostream &m_stream;
+};
+
+/*
+ *	One JSON object per line: {"time": "<UTC ISO 8601>", "level": "...",
+ *	"message": "..."}, appended to the file.
+ */
+class JsonLinesLogSink : public LogSink {
+ public:
+  explicit JsonLinesLogSink(const std::string &path);
+  bool is_open() const { return m_file.is_open(); }
+  virtual void write(const LogRecord &record);
+  virtual void flush();
+
+ private:
+  std::ofstream m_file;
+};
+
+/*
+ *	Bounded lock-free queue of records, for many producers and one consumer.
+ */
+class LogRecordQueue {
+ public:
+  /*
+   *	capacity is rounded up to a power of 2
+   */
+  explicit LogRecordQueue(size_t capacity);
+
+  /*
+   *	Returns false, leaving record unchanged, when the queue is full.
+   */
+  bool push(LogRecord &record);
+  bool pop(LogRecord &record);
+
+ private:
+  struct Cell {
+    std::atomic<size_t> sequence;
+    LogRecord record;
+  };
+  std::unique_ptr<Cell[]> m_cells;
+  size_t m_mask;
+  std::atomic<size_t> m_enqueue_position;
+  std::atomic<size_t> m_dequeue_position;
+};
+
+/*
+ *	Moves messages into a buffer and returns; a writer thread formats them
+ *	and writes them to the sink in batches, flushing once per batch.
+ *	Messages logged while the buffer is full are dropped, the writer
+ *	reports their number with a warning.
+ *
+ *	Register with Log::instance().set_handler(). On destruction the buffered
+ *	messages are written and, if still registered, stdlog_handler is restored.
+ */
+class AsyncLogHandler : public LogHandler {
+ public:
+  AsyncLogHandler(std::unique_ptr<LogSink> sink, size_t capacity = 4096);
+  ~AsyncLogHandler();
+
+  virtual void print(const std::string &, Loglevel lvl);
+
+  /*
+   *	Wait until all messages printed before the call are written.
+   */
+  void flush();
+
+  uint64_t dropped() const { return m_dropped; }
+
+ private:
+  void run();
+
+  std::unique_ptr<LogSink> m_sink;
+  LogRecordQueue m_queue;
+  std::atomic<uint64_t> m_pushed;
+  std::atomic<uint64_t> m_dropped;
+  std::atomic<bool> m_writer_waiting;
+
+  std::mutex m_mutex;
+  std::condition_variable m_wakeup;
+  std::condition_variable m_written_cv;
+  uint64_t m_written;
+  bool m_stopping;
+
+  std::thread m_writer;
+};
+}
+}
+
+#endif
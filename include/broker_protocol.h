@@ -0,0 +1,231 @@
+#ifndef LIBNITROKEY_BROKER_PROTOCOL_H
+#define LIBNITROKEY_BROKER_PROTOCOL_H
+#include <algorithm>
+#include <cerrno>
+#include <cstdlib>
+#include <cstring>
+#include <stdexcept>
+#include <string>
+#include <vector>
+#include <sys/socket.h>
+#include <sys/un.h>
+#include <unistd.h>
+#include "inttypes.h"
+
+/*
+ *	Framing shared by the broker (Broker.h) and its clients. Every message
+ *	is a uint32 body length followed by the body; a request body is the
+ *	operation and its arguments, a response body is the last command status
+ *	and the result. Integers are little-endian, strings are a uint16
+ *	length followed by the bytes. Each connection has at most one request
+ *	in flight.
+ */
+namespace nitrokey {
+namespace broker {
+
+/*
+ *	In the runtime directory of the user, accessible to the user only,
+ *	or /run/nitrokey if it is not set.
+ */
+inline std::string default_socket_path() {
+  const char *runtime_dir = getenv("XDG_RUNTIME_DIR");
+  if (runtime_dir != NULL && runtime_dir[0] != 0)
+    return std::string(runtime_dir) + "/nitrokey-broker.sock";
+  return "/run/nitrokey/broker.sock";
+}
+
+const uint32_t max_message_size = 64 * 1024;
+// last command status of responses to requests which could not be sent to a device
+const uint8_t status_not_connected = 255;
+
+/*
+ *	Operations of NK_C_API.h available through the broker,
+ *	arguments and results as in the C API.
+ */
+enum class BrokerOp : uint8_t {
+  LOGIN = 1,  // model string, "" for any
+  LOGOUT,
+  STATUS,
+  SERIAL_NUMBER,
+  FIRST_AUTHENTICATE,
+  USER_AUTHENTICATE,
+  LOCK_DEVICE,
+  TOTP_SET_TIME,
+  GET_HOTP_CODE,
+  GET_TOTP_CODE,
+  GET_HOTP_SLOT_NAME,
+  GET_TOTP_SLOT_NAME,
+  GET_USER_RETRY_COUNT,
+  GET_ADMIN_RETRY_COUNT,
+  ENABLE_PASSWORD_SAFE,
+  GET_PASSWORD_SAFE_SLOT_NAME,
+  GET_PASSWORD_SAFE_SLOT_LOGIN,
+  GET_PASSWORD_SAFE_SLOT_PASSWORD,
+};
+
+/*
+ *	Reads of the device state, answered once for identical requests
+ *	waiting in the queue at the same time.
+ */
+inline bool is_coalescable(BrokerOp op) {
+  switch (op) {
+    case BrokerOp::STATUS:
+    case BrokerOp::SERIAL_NUMBER:
+    case BrokerOp::GET_TOTP_CODE:
+    case BrokerOp::GET_HOTP_SLOT_NAME:
+    case BrokerOp::GET_TOTP_SLOT_NAME:
+    case BrokerOp::GET_USER_RETRY_COUNT:
+    case BrokerOp::GET_ADMIN_RETRY_COUNT:
+    case BrokerOp::GET_PASSWORD_SAFE_SLOT_NAME:
+    case BrokerOp::GET_PASSWORD_SAFE_SLOT_LOGIN:
+    case BrokerOp::GET_PASSWORD_SAFE_SLOT_PASSWORD:
+      return true;
+    default:
+      return false;
+  }
+}
+
+class Message {
+ public:
+  Message() : m_position(0) {}
+
+  void put_u8(uint8_t v) { m_data.push_back(v); }
+  void put_u32(uint32_t v) { put_le(v, 4); }
+  void put_u64(uint64_t v) { put_le(v, 8); }
+  void put_string(const char *s) {
+    const size_t size = s == nullptr ? 0 : strnlen(s, UINT16_MAX);
+    put_le(size, 2);
+    m_data.insert(m_data.end(), s, s + size);
+  }
+
+  /*
+   *	Throw std::runtime_error when the message is too short.
+   */
+  uint8_t get_u8() { return (uint8_t)get_le(1); }
+  uint32_t get_u32() { return (uint32_t)get_le(4); }
+  uint64_t get_u64() { return get_le(8); }
+  std::string get_string() {
+    const size_t size = (size_t)get_le(2);
+    check_available(size);
+    std::string s(m_data.begin() + m_position, m_data.begin() + m_position + size);
+    m_position += size;
+    return s;
+  }
+
+  std::vector<uint8_t> &data() { return m_data; }
+  const std::vector<uint8_t> &data() const { return m_data; }
+
+  /*
+   *	Overwrite the content, e.g. the passwords, before releasing.
+   */
+  void clear() {
+    std::fill(m_data.begin(), m_data.end(), 0);
+    m_data.clear();
+    m_position = 0;
+  }
+
+ private:
+  void put_le(uint64_t v, size_t size) {
+    for (size_t i = 0; i < size; i++) m_data.push_back((uint8_t)(v >> (8 * i)));
+  }
+  uint64_t get_le(size_t size) {
+    check_available(size);
+    uint64_t v = 0;
+    for (size_t i = 0; i < size; i++) v |= (uint64_t)m_data[m_position + i] << (8 * i);
+    m_position += size;
+    return v;
+  }
+  void check_available(size_t size) const {
+    if (m_data.size() - m_position < size)
+      throw std::runtime_error("Broker message too short");
+  }
+
+  std::vector<uint8_t> m_data;
+  size_t m_position;
+};
+
+inline bool write_all(int fd, const uint8_t *data, size_t size) {
+  while (size > 0) {
+    ssize_t written = send(fd, data, size, MSG_NOSIGNAL);
+    if (written < 0 && errno == EINTR) continue;
+    if (written <= 0) return false;
+    data += written;
+    size -= (size_t)written;
+  }
+  return true;
+}
+
+inline bool read_all(int fd, uint8_t *data, size_t size) {
+  while (size > 0) {
+    ssize_t got = recv(fd, data, size, 0);
+    if (got < 0 && errno == EINTR) continue;
+    if (got <= 0) return false;
+    data += got;
+    size -= (size_t)got;
+  }
+  return true;
+}
+
+/*
+ *	Return false if the connection was closed or broken.
+ */
+inline bool write_message(int fd, const Message &message) {
+  uint8_t header[4];
+  const uint32_t size = (uint32_t)message.data().size();
+  for (size_t i = 0; i < 4; i++) header[i] = (uint8_t)(size >> (8 * i));
+  return write_all(fd, header, sizeof header) &&
+         write_all(fd, message.data().data(), size);
+}
+
+inline bool read_message(int fd, Message &message) {
+  uint8_t header[4];
+  if (!read_all(fd, header, sizeof header)) return false;
+  uint32_t size = 0;
+  for (size_t i = 0; i < 4; i++) size |= (uint32_t)header[i] << (8 * i);
+  if (size > max_message_size) return false;
+  message.clear();
+  message.data().resize(size);
+  return read_all(fd, message.data().data(), size);
+}
+
+/*
+ *	Processes of the same user or root, the only ones trusted with the
+ *	PINs and passwords sent through the socket, on either side.
+ */
+inline bool is_trusted_peer(int fd) {
+  uid_t uid;
+#ifdef SO_PEERCRED
+  ucred credentials;
+  socklen_t size = sizeof credentials;
+  if (getsockopt(fd, SOL_SOCKET, SO_PEERCRED, &credentials, &size) != 0)
+    return false;
+  uid = credentials.uid;
+#else
+  gid_t gid;
+  if (getpeereid(fd, &uid, &gid) != 0) return false;
+#endif
+  return uid == geteuid() || uid == 0;
+}
+
+/*
+ *	Return connected socket, -1 on failure or if the listening
+ *	process is not trusted (e.g. another user took the path).
+ */
+inline int connect_socket(const std::string &path) {
+  sockaddr_un address = {};
+  if (path.size() >= sizeof address.sun_path) return -1;
+  address.sun_family = AF_UNIX;
+  strncpy(address.sun_path, path.c_str(), sizeof address.sun_path - 1);
+  int fd = socket(AF_UNIX, SOCK_STREAM, 0);
+  if (fd < 0) return -1;
+  if (connect(fd, (sockaddr *)&address, sizeof address) != 0 ||
+      !is_trusted_peer(fd)) {
+    close(fd);
+    return -1;
+  }
+  return fd;
+}
+}
+}
+
+#endif
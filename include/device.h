@@ -1,22 +1,57 @@
 #ifndef DEVICE_H
 #define DEVICE_H
+#include <array>
 #include <chrono>
+#include <map>
+#include <memory>
+#include <mutex>
+#include <string>
+#include <vector>
 #include <hidapi/hidapi.h>
 #include "inttypes.h"
+#include "command_id.h"
 
 #define HID_REPORT_SIZE 65
 
-// TODO !! SEMAPHORE
-
 namespace nitrokey {
 namespace device {
     using namespace std::chrono_literals;
 
+class TraceWriter;
+
 enum class DeviceModel{
     PRO,
     STORAGE
 };
 
+/*
+ *	Connected device as reported by hidapi's enumeration.
+ */
+struct DeviceInfo {
+    std::string path;
+    std::string serial;  // USB serial number string
+    DeviceModel model;
+    // Storage in firmware update mode, which does not accept commands
+    bool update_mode;
+    int interface_number;  // -1 if not known
+};
+
+/*
+ *	Response polling settings, see Transaction<>::execute.
+ *	A transaction fails when there is no response after
+ *	retry_count polls or after the deadline, whichever comes first.
+ */
+struct TimingProfile {
+  // upper bound of the wait before the first poll
+  std::chrono::milliseconds send_receive_delay;
+  std::chrono::milliseconds min_poll_delay;
+  // upper bound of the wait between following polls
+  std::chrono::milliseconds retry_timeout;
+  int retry_count;
+  // maximal time from sending the command to the response, 0 for none
+  std::chrono::milliseconds deadline;
+};
+
 class Device {
 
 public:
@@ -27,6 +62,40 @@ public:
   virtual bool connect();
   virtual bool disconnect();
 
+  /*
+   *	Connect to the particular device of this model,
+   *	selected by its USB path or USB serial number.
+   */
+  bool connect_with_path(const std::string &path);
+  bool connect_with_serial(const std::string &serial);
+
+  /*
+   *	List all connected devices matching this model's VID/PID.
+   */
+  std::vector<DeviceInfo> enumerate() const;
+  const std::string &get_path() const { return m_path; }
+  const std::string &get_serial() const { return m_serial; }
+  virtual bool is_connected() const { return mp_devhandle != NULL; }
+
+  /*
+   *	Reopen the device after it was unplugged and plugged in again,
+   *	possibly under another path. The device is looked up by the
+   *	USB serial number seen on connection, or by path when there
+   *	was none.
+   */
+  virtual bool reconnect();
+
+  /*
+   *	Serializes access to the device between threads.
+   *	Taken by each Transaction<>::run(); callers sending a sequence of
+   *	dependent commands (e.g. authorization and the authorized command)
+   *	should hold it for the whole sequence. Recursive, so transactions
+   *	can be run while holding it.
+   */
+  std::unique_lock<std::recursive_mutex> lock() {
+    return std::unique_lock<std::recursive_mutex>(m_mutex);
+  }
+
   /*
    *	Sends packet of HID_REPORT_SIZE.
    */
@@ -34,13 +103,44 @@ public:
 
   /*
    *	Gets packet of HID_REPORT_SIZE.
-   *	Can sleep. See below.
+   *	Reads once, repeating is left to Transaction<>::execute.
    */
   virtual int recv(void *packet);
 
-  int get_retry_count() const { return m_retry_count; };
-  std::chrono::milliseconds get_retry_timeout() const { return m_retry_timeout; };
-    std::chrono::milliseconds get_send_receive_delay() const {return m_send_receive_delay;}
+  int get_retry_count() const { return m_timing.retry_count; };
+  std::chrono::milliseconds get_retry_timeout() const { return m_timing.retry_timeout; };
+    std::chrono::milliseconds get_send_receive_delay() const {return m_timing.send_receive_delay;}
+
+  /*
+   *	Timing used for all commands without their own profile.
+   *	Setters take the device lock, so they don't change the timing
+   *	of a running transaction.
+   */
+  TimingProfile get_timing() const { return m_timing; }
+  void set_timing(const TimingProfile &timing);
+  TimingProfile get_timing(proto::CommandID cmd) const;
+  void set_command_timing(proto::CommandID cmd, const TimingProfile &timing);
+  void clear_command_timing();
+
+  /*
+   *	Adaptive response polling.
+   *	The first poll for a command is scheduled after the latency
+   *	observed so far for that command (or min_poll_delay when
+   *	nothing is known yet), following polls back off exponentially
+   *	up to retry_timeout of the command's timing.
+   */
+  std::chrono::milliseconds get_first_poll_delay(proto::CommandID cmd) const;
+  std::chrono::milliseconds get_next_poll_delay(proto::CommandID cmd,
+                                                std::chrono::milliseconds previous) const;
+  void register_response_latency(proto::CommandID cmd, std::chrono::milliseconds latency,
+                                 bool ready_on_first_poll);
+
+  /*
+   *	Record all reports sent and received by Transaction<>::execute,
+   *	nullptr to stop. Takes the device lock.
+   */
+  void set_trace(std::shared_ptr<TraceWriter> trace);
+  TraceWriter *get_trace() const { return m_trace.get(); }
 
     int get_last_command_status() {auto a = last_command_status; last_command_status = 0; return a;};
     void set_last_command_status(uint8_t _err) { last_command_status = _err;} ;
@@ -59,11 +159,22 @@ private:
    *	library, there's no way of doing it asynchronously,
    *	hence polling.
    */
-  int m_retry_count;
-  std::chrono::milliseconds m_retry_timeout;
-  std::chrono::milliseconds m_send_receive_delay;
+  TimingProfile m_timing;
+  std::map<proto::CommandID, TimingProfile> m_command_timing;
+
+  /*
+   *	Moving average of the response latency per command,
+   *	indexed by CommandID, 0 means not measured yet.
+   */
+  std::array<std::chrono::milliseconds, 256> m_command_latency;
+
+  std::shared_ptr<TraceWriter> m_trace;
 
   hid_device *mp_devhandle;
+  std::string m_path;
+  std::string m_serial;
+
+  std::recursive_mutex m_mutex;
 };
 
 class Stick10 : public Device {
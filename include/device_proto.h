@@ -1,6 +1,10 @@
 #ifndef DEVICE_PROTO_H
 #define DEVICE_PROTO_H
+#include <chrono>
+#include <functional>
+#include <memory>
 #include <utility>
+#include <vector>
 #include <thread>
 #include <type_traits>
 #include <stdexcept>
@@ -10,8 +14,10 @@
 #include "inttypes.h"
 #include "cxx_semantics.h"
 #include "device.h"
+#include "hid_trace.h"
 #include "misc.h"
 #include "log.h"
+#include "metrics.h"
 #include "command_id.h"
 #include "dissect.h"
 #include "CommandFailedException.h"
@@ -21,6 +27,8 @@
 
 #define PAYLOAD_SIZE 53
 #define PWS_SLOT_COUNT 16
+#define HOTP_SLOT_COUNT 3
+#define TOTP_SLOT_COUNT 15
 #define PWS_SLOTNAME_LENGTH 11
 #define PWS_PASSWORD_LENGTH 20
 #define PWS_LOGINNAME_LENGTH 32
@@ -185,66 +193,144 @@ class Transaction : semantics::non_constructible {
     }
 
 
-    static ClearingProxy<ResponsePacket, response_payload> run(device::Device &dev,
-                              const command_payload &payload) {
+  /*
+   *	Build the packet to be sent, with CRC.
+   */
+  static OutgoingPacket prepare(const command_payload &payload) {
+    OutgoingPacket outp;
+    // POD types can't have non-default constructors
+    outp.initialize();
+    outp.payload = payload;
+    outp.update_CRC();
+    return outp;
+  }
+
+  /*
+   *	Send the prepared packet and poll until the device answers it.
+   *	The command status of the response is not checked.
+   *	The caller has to hold the device lock.
+   */
+  static ResponsePacket execute(device::Device &dev, const OutgoingPacket &outp) {
     using namespace ::nitrokey::device;
     using namespace ::nitrokey::log;
-     using namespace std::chrono_literals;
-
-    Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
 
     int status;
-    OutgoingPacket outp;
     ResponsePacket resp;
-
-    // POD types can't have non-default constructors
-    outp.initialize();
     resp.initialize();
-
-    outp.payload = payload;
-    outp.update_CRC();
+    metrics::CommandRecorder recorder(cmd_id);
 
     Log::instance()("Outgoing HID packet:", Loglevel::DEBUG);
-    Log::instance()((std::string)(outp), Loglevel::DEBUG);
+    Log::instance().lazy([&]() { return (std::string)(outp); }, Loglevel::DEBUG);
 
     if (!outp.isValid()) throw std::runtime_error("Invalid outgoing packet");
 
+    const auto send_started_at = std::chrono::steady_clock::now();
     status = dev.send(&outp);
+    const auto sent_at = std::chrono::steady_clock::now();
+    if (dev.get_trace() != nullptr)
+      dev.get_trace()->append(cmd_id, TraceDirection::SENT, status, &outp);
+    recorder.sample.send_time =
+        std::chrono::duration_cast<std::chrono::microseconds>(sent_at - send_started_at);
     if (status <= 0)
       throw std::runtime_error(
           std::string("Device error while sending command ") +
           std::to_string((int)(status)));
 
-      std::this_thread::sleep_for(dev.get_send_receive_delay());
-
-      // FIXME make checks done in device:recv here
-    int retry = dev.get_retry_count();
-    while (retry-- > 0) {
+    // first poll after the latency observed for this command so far,
+    // then back off exponentially (see Device::get_first_poll_delay)
+    const auto timing = dev.get_timing(cmd_id);
+    auto poll_delay = dev.get_first_poll_delay(cmd_id);
+    recorder.sample.first_poll_delay = poll_delay;
+    bool first_poll = true;
+    bool received = false;
+    bool deadline_reached = false;
+
+    // the only loop waiting for the device, bounded by both the poll count and the deadline
+    int polls = 0;
+    while (polls++ < timing.retry_count) {
+      if (timing.deadline > 0ms) {
+        const auto remaining = timing.deadline -
+            std::chrono::duration_cast<std::chrono::milliseconds>(std::chrono::steady_clock::now() - sent_at);
+        if (remaining <= 0ms) {
+          deadline_reached = true;
+          break;
+        }
+        poll_delay = std::min(poll_delay, remaining);
+      }
+      std::this_thread::sleep_for(poll_delay);
       status = dev.recv(&resp);
+      recorder.sample.polls++;
+      if (dev.get_trace() != nullptr)
+        dev.get_trace()->append(cmd_id, TraceDirection::RECEIVED, status, &resp);
+      poll_delay = dev.get_next_poll_delay(cmd_id, poll_delay);
+
+      if (status <= 0) {
+        recorder.sample.recv_retries++;
+        Log::instance().lazy([&]() {
+          return "Reading response failed with " + std::to_string(status) + ", retrying...";
+        }, Loglevel::DEBUG);
+        first_poll = false;
+        continue;
+      }
 
       dev.set_last_command_status(resp.last_command_status); // FIXME should be handled on device.recv
 
-      if (resp.device_status == 0 && resp.last_command_crc == outp.crc) break;
+      if (resp.device_status == 0 && resp.last_command_crc == outp.crc) {
+        dev.register_response_latency(cmd_id,
+            std::chrono::duration_cast<std::chrono::milliseconds>(
+                std::chrono::steady_clock::now() - sent_at),
+            first_poll);
+        received = true;
+        break;
+      }
+      if (resp.device_status != 0)
+        recorder.sample.busy_responses++;
+      else
+        recorder.sample.crc_mismatches++;
       Log::instance()("Device is not ready or received packet's last CRC is not equal to sent CRC packet, retrying...",
                       Loglevel::DEBUG);
       Log::instance()("Invalid incoming HID packet:", Loglevel::DEBUG_L2);
-      Log::instance()((std::string)(resp), Loglevel::DEBUG_L2);
-      std::this_thread::sleep_for(dev.get_retry_timeout());
-      continue;
+      Log::instance().lazy([&]() { return (std::string)(resp); }, Loglevel::DEBUG_L2);
+      first_poll = false;
     }
-    clear_packet(outp);
 
-    if (status <= 0)
+    if (!received && status <= 0)
       throw std::runtime_error(
           std::string("Device error while executing command ") +
           std::to_string(status));
+    if (deadline_reached)
+      throw std::runtime_error("Deadline reached while waiting for response from the device!");
+    if (!received) throw std::runtime_error("Maximum retry count reached for receiving response from the device!");
 
     Log::instance()("Incoming HID packet:", Loglevel::DEBUG);
-    Log::instance()((std::string)(resp), Loglevel::DEBUG);
-    Log::instance()(std::string("Retry count: ") + std::to_string(retry), Loglevel::DEBUG);
+    Log::instance().lazy([&]() { return (std::string)(resp); }, Loglevel::DEBUG);
+    Log::instance().lazy([&]() { return std::string("Polls: ") + std::to_string(polls); },
+                         Loglevel::DEBUG);
 
     if (!resp.isValid()) throw std::runtime_error("Invalid incoming packet");
-    if (retry <= 0) throw std::runtime_error("Maximum retry count reached for receiving response from the device!");
+    recorder.finish(resp.last_command_status);
+    return resp;
+  }
+
+    static ClearingProxy<ResponsePacket, response_payload> run(device::Device &dev,
+                              const command_payload &payload) {
+    using namespace ::nitrokey::log;
+
+    Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+    auto lock = dev.lock();
+
+    OutgoingPacket outp = prepare(payload);
+    ResponsePacket resp;
+    try {
+      resp = execute(dev, outp);
+    }
+    catch (...) {
+      clear_packet(outp);
+      throw;
+    }
+    clear_packet(outp);
+
     if (resp.last_command_status!=0) throw CommandFailedException(resp.command_id, resp.last_command_status);
 
 
@@ -257,6 +343,95 @@ class Transaction : semantics::non_constructible {
     return run(dev, empty_payload);
   }
 };
+
+/*
+ *	Dependent transactions sent back to back under a single device lock,
+ *	e.g. an authorization and the authorized command, or both parts of
+ *	password safe slot data. All packets are built before the first one
+ *	is sent. The device holds a single response report, so each packet is
+ *	still polled until answered before the next one goes out; the sequence
+ *	stops at the first failed step. Statuses of the executed steps are
+ *	available with get_step_statuses(), also after a failure.
+ */
+class TransactionSequence {
+ public:
+  explicit TransactionSequence(device::Device &dev) : m_dev(dev) {}
+
+  TransactionSequence(const TransactionSequence &) = delete;
+  TransactionSequence &operator=(const TransactionSequence &) = delete;
+
+  /*
+   *	Queue a command, which response payload is not needed.
+   */
+  template <typename T>
+  TransactionSequence &add(const typename T::CommandPayload &payload) {
+    typedef typename T::CommandTransaction Tr;
+    typedef typename Tr::OutgoingPacket Packet;
+    // packets might carry secrets, clear them when the sequence is done
+    std::shared_ptr<Packet> packet(new Packet(Tr::prepare(payload)),
+                                   [](Packet *p) {
+                                     Tr::clear_packet(*p);
+                                     delete p;
+                                   });
+    m_steps.push_back([packet](device::Device &dev) {
+      auto resp = Tr::execute(dev, *packet);
+      const auto status = std::make_pair(resp.command_id, resp.last_command_status);
+      Tr::clear_packet(resp);
+      return status;
+    });
+    return *this;
+  }
+
+  /*
+   *	Execute the queued commands.
+   *	@throws CommandFailedException for the first failed step
+   */
+  void run() {
+    auto lock = m_dev.lock();
+    auto steps = std::move(m_steps);
+    m_steps.clear();
+    for (auto &step : steps) {
+      const auto status = step(m_dev);
+      m_statuses.push_back(status.second);
+      if (status.second != 0)
+        throw CommandFailedException(status.first, status.second);
+    }
+  }
+
+  /*
+   *	Execute the queued commands followed by the given one,
+   *	and return the response of the latter.
+   */
+  template <typename T>
+  ClearingProxy<typename T::CommandTransaction::ResponsePacket,
+                typename T::CommandTransaction::ResponsePayload>
+  run(const typename T::CommandPayload &payload) {
+    auto lock = m_dev.lock();
+    run();
+    typedef typename T::CommandTransaction Tr;
+    auto outp = Tr::prepare(payload);
+    typename Tr::ResponsePacket resp;
+    try {
+      resp = Tr::execute(m_dev, outp);
+    }
+    catch (...) {
+      Tr::clear_packet(outp);
+      throw;
+    }
+    Tr::clear_packet(outp);
+    m_statuses.push_back(resp.last_command_status);
+    if (resp.last_command_status != 0)
+      throw CommandFailedException(resp.command_id, resp.last_command_status);
+    return resp;
+  }
+
+  const std::vector<uint8_t> &get_step_statuses() const { return m_statuses; }
+
+ private:
+  device::Device &m_dev;
+  std::vector<std::function<std::pair<uint8_t, uint8_t>(device::Device &)>> m_steps;
+  std::vector<uint8_t> m_statuses;
+};
 }
 }
 #endif
@@ -0,0 +1,109 @@
+#ifndef LIBNITROKEY_HASH_H
+#define LIBNITROKEY_HASH_H
+#include <cstddef>
+#include "inttypes.h"
+
+namespace nitrokey {
+namespace hash {
+
+/*
+ *	Hash functions needed for host-side HMAC-based OTP computation
+ *	(RFC 4226, RFC 6238). Contexts are plain values, so a context
+ *	with a key already absorbed can be copied and reused.
+ */
+class SHA1 {
+ public:
+  static const size_t block_size = 64;
+  static const size_t digest_size = 20;
+
+  SHA1();
+  void update(const uint8_t *data, size_t size);
+  void finish(uint8_t *digest);
+
+ private:
+  void compress(const uint8_t *block);
+
+  uint32_t m_state[5];
+  uint8_t m_buffer[block_size];
+  size_t m_buffer_size;
+  uint64_t m_length;
+};
+
+class SHA256 {
+ public:
+  static const size_t block_size = 64;
+  static const size_t digest_size = 32;
+
+  SHA256();
+  void update(const uint8_t *data, size_t size);
+  void finish(uint8_t *digest);
+
+ private:
+  void compress(const uint8_t *block);
+
+  uint32_t m_state[8];
+  uint8_t m_buffer[block_size];
+  size_t m_buffer_size;
+  uint64_t m_length;
+};
+
+class SHA512 {
+ public:
+  static const size_t block_size = 128;
+  static const size_t digest_size = 64;
+
+  SHA512();
+  void update(const uint8_t *data, size_t size);
+  void finish(uint8_t *digest);
+
+ private:
+  void compress(const uint8_t *block);
+
+  uint64_t m_state[8];
+  uint8_t m_buffer[block_size];
+  size_t m_buffer_size;
+  uint64_t m_length;
+};
+
+/*
+ *	HMAC with inner and outer key pads absorbed once, at construction.
+ */
+template <typename Hash>
+class HMAC {
+ public:
+  static const size_t digest_size = Hash::digest_size;
+
+  HMAC(const uint8_t *key, size_t key_size) {
+    uint8_t pad[Hash::block_size] = {};
+    if (key_size > Hash::block_size) {
+      Hash h;
+      h.update(key, key_size);
+      h.finish(pad);
+    } else {
+      for (size_t i = 0; i < key_size; i++) pad[i] = key[i];
+    }
+    for (auto &b : pad) b ^= 0x36;
+    m_inner.update(pad, sizeof pad);
+    for (auto &b : pad) b ^= 0x36 ^ 0x5c;
+    m_outer.update(pad, sizeof pad);
+    for (auto &b : pad) b = 0;
+  }
+
+  void compute(const uint8_t *message, size_t size, uint8_t *mac) const {
+    uint8_t inner_digest[Hash::digest_size];
+    Hash inner = m_inner;
+    inner.update(message, size);
+    inner.finish(inner_digest);
+    Hash outer = m_outer;
+    outer.update(inner_digest, sizeof inner_digest);
+    outer.finish(mac);
+  }
+
+ private:
+  Hash m_inner;
+  Hash m_outer;
+};
+}
+}
+
+#endif  // LIBNITROKEY_HASH_H
@@ -0,0 +1,119 @@
+#ifndef LIBNITROKEY_HID_TRACE_H
+#define LIBNITROKEY_HID_TRACE_H
+#include <chrono>
+#include <mutex>
+#include <string>
+#include <vector>
+#include "cxx_semantics.h"
+#include "device.h"
+
+namespace nitrokey {
+namespace device {
+
+/*
+ *	Trace file: TraceHeader followed by TraceRecords, one per report sent
+ *	or received by Transaction<>::execute. A record with direction 0 (or
+ *	the end of the file) ends the trace.
+ */
+enum class TraceDirection : uint8_t {
+  SENT = 1,
+  RECEIVED = 2,
+};
+
+struct TraceHeader {
+  char magic[7];  // "NKTRACE"
+  uint8_t version;
+  uint8_t model;  // DeviceModel
+  uint8_t _reserved[7];
+} __packed;
+
+struct TraceRecord {
+  uint64_t time_us;  // system clock, microseconds since the epoch
+  uint8_t direction;  // TraceDirection
+  uint8_t command_id;  // command the report belongs to
+  int16_t status;  // result of Device::send/recv
+  uint8_t report[HID_REPORT_SIZE];
+} __packed;
+
+/*
+ *	Appends records to a memory-mapped trace file, growing it in chunks.
+ *	Records already in the file are kept. Only one writer per file.
+ */
+class TraceWriter {
+ public:
+  /*
+   *	Throws std::runtime_error if the file can't be opened or holds
+   *	a trace of another device model.
+   */
+  TraceWriter(const std::string &path, DeviceModel model);
+  ~TraceWriter();
+
+  void append(proto::CommandID cmd, TraceDirection direction, int status,
+              const void *report);
+
+ private:
+  void reserve(size_t size);
+
+  std::mutex m_mutex;
+  int m_fd;
+  uint8_t *mp_map;
+  size_t m_mapped_size;
+  size_t m_size;
+};
+
+/*
+ *	Throws std::runtime_error if the file is not a trace.
+ */
+std::vector<TraceRecord> read_trace(const std::string &path, DeviceModel &model);
+
+/*
+ *	Offline decoding of a record: time, direction, command and the
+ *	report's header fields, followed by the hexdump.
+ */
+std::string dissect_trace_record(const TraceRecord &record);
+
+/*
+ *	Device answering with the responses of a recorded trace, for
+ *	repeatable measurements without hardware. Commands have to be sent
+ *	in the recorded order, a different command fails to send.
+ *
+ *	Each response is ready after the latency seen in the trace, from
+ *	sending the command to the accepted response, multiplied by
+ *	time_scale (0 answers immediately); polls before that get a busy
+ *	status. The recorded latency includes the recording library's
+ *	polling, so it's an upper bound of the device's.
+ */
+class ReplayDevice : public Device {
+ public:
+  explicit ReplayDevice(const std::string &trace_path, double time_scale = 1.0);
+
+  virtual bool connect() override;
+  virtual bool disconnect() override;
+  virtual bool reconnect() override { return connect(); }
+  virtual bool is_connected() const override { return m_connected; }
+  virtual int send(const void *packet) override;
+  virtual int recv(void *packet) override;
+
+  size_t get_remaining_commands() const { return m_exchanges.size() - m_next; }
+
+ private:
+  struct Exchange {
+    TraceRecord sent;
+    std::vector<TraceRecord> responses;
+    // index of the response accepted by the recording library, -1 if none
+    int accepted;
+    std::chrono::microseconds latency;
+  };
+
+  double m_time_scale;
+  bool m_connected;
+  std::vector<Exchange> m_exchanges;
+  size_t m_next;
+  Exchange *mp_current;
+  size_t m_next_response;
+  uint32_t m_sent_crc;
+  std::chrono::steady_clock::time_point m_response_ready_at;
+};
+}
+}
+#endif
@@ -1,7 +1,9 @@
 #ifndef LOG_H
 #define LOG_H
-#include <string>
+#include <atomic>
 #include <cstddef>
+#include <mutex>
+#include <string>
 
 namespace nitrokey {
 namespace log {
@@ -12,8 +14,7 @@ class LogHandler {
  public:
   virtual void print(const std::string &, Loglevel lvl) = 0;
 
- protected:
-  std::string loglevel_to_str(Loglevel);
+  static std::string loglevel_to_str(Loglevel);
 };
 
 class StdlogHandler : public LogHandler {
@@ -25,24 +26,53 @@ extern StdlogHandler stdlog_handler;
 
 class Log {
  public:
-  Log() : mp_loghandler(&stdlog_handler), m_loglevel(Loglevel::WARNING) {}
+  Log() : m_loglevel(Loglevel::WARNING), mp_loghandler(&stdlog_handler), m_epoch(0), m_printing{{0}, {0}} {}
 
   static Log &instance() {
-    if (mp_instance == NULL) mp_instance = new Log;
-    return *mp_instance;
+    // thread-safe initialization of function-local static
+    static Log log;
+    return log;
   }
 
   void operator()(const std::string &, Loglevel);
+  void operator()(const char *, Loglevel);
+
+  bool enabled(Loglevel lvl) const {
+    return mp_loghandler.load() != NULL && (int)(lvl) >= (int)(m_loglevel.load());
+  }
+
+  /*
+   *	Deferred formatting: build_message() is called only when
+   *	the message would be printed with the current log level.
+   */
+  template <typename F>
+  void lazy(F &&build_message, Loglevel lvl) {
+    if (enabled(lvl)) print(build_message(), lvl);
+  }
 
   void set_loglevel(Loglevel lvl) { m_loglevel = lvl; }
 
-  void set_handler(LogHandler *handler) { mp_loghandler = handler; }
+  /*
+   *	Waits for messages being printed by the previous handler,
+   *	so it can be destroyed afterwards. Must not be called from
+   *	a handler's print().
+   */
+  void set_handler(LogHandler *handler);
+  LogHandler *handler() const { return mp_loghandler; }
 
  private:
-  Loglevel m_loglevel;
-  LogHandler *mp_loghandler;
+  void print(const std::string &, Loglevel);
 
-  static Log *mp_instance;
+  std::atomic<Loglevel> m_loglevel;
+  std::atomic<LogHandler *> mp_loghandler;
+  /*
+   *	Messages being printed, counted by the parity of the epoch in which
+   *	they started. set_handler starts a new epoch and waits only for the
+   *	previous one, so it is not held up by messages logged meanwhile.
+   */
+  std::atomic<unsigned> m_epoch;
+  std::atomic<int> m_printing[2];
+  std::mutex m_handler_mutex;
 };
 }
 }
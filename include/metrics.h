@@ -0,0 +1,118 @@
+#ifndef LIBNITROKEY_METRICS_H
+#define LIBNITROKEY_METRICS_H
+#include <array>
+#include <atomic>
+#include <chrono>
+#include <mutex>
+#include <utility>
+#include <vector>
+#include "inttypes.h"
+#include "command_id.h"
+
+namespace nitrokey {
+namespace metrics {
+
+/*
+ *	Latency histogram bucket i counts commands which took less than
+ *	2^i milliseconds, the last bucket counts all slower ones.
+ */
+const size_t latency_buckets = 12;
+
+/*
+ *	Measurements of a single transaction, see Transaction<>::execute.
+ */
+struct CommandSample {
+  std::chrono::microseconds send_time;
+  std::chrono::microseconds first_poll_delay;  // wait before the first poll
+  std::chrono::microseconds total_time;        // from sending to response
+  uint32_t polls;           // responses read from the device
+  uint32_t busy_responses;  // responses with busy device status
+  uint32_t crc_mismatches;  // responses to another command
+  uint32_t recv_retries;    // failed HID reads, repeated with the next poll
+  uint8_t last_command_status;
+  bool failed;  // communication error, no valid response
+};
+
+/*
+ *	Totals for all transactions of a single command.
+ */
+struct CommandMetrics {
+  uint64_t commands;
+  uint64_t failures;
+  uint64_t command_errors;  // responses with non-zero last_command_status
+  uint64_t polls;
+  uint64_t busy_responses;
+  uint64_t crc_mismatches;
+  uint64_t recv_retries;
+  std::chrono::microseconds send_time;
+  std::chrono::microseconds first_poll_delay;
+  std::chrono::microseconds total_time;
+  std::chrono::microseconds max_time;
+  std::array<uint64_t, latency_buckets> latency_histogram;
+};
+
+class MetricsHandler {
+ public:
+  /*
+   *	Called after each transaction from the thread which ran it,
+   *	still holding the device lock. It must not block, nor wait for
+   *	commands of other threads: they might need the same device.
+   */
+  virtual void record(proto::CommandID cmd, const CommandSample &sample) = 0;
+};
+
+class Metrics {
+ public:
+  Metrics() : m_enabled(true), mp_handler(NULL), m_commands() {}
+
+  static Metrics &instance() {
+    static Metrics metrics;
+    return metrics;
+  }
+
+  void set_enabled(bool enabled) { m_enabled = enabled; }
+  bool enabled() const { return m_enabled; }
+
+  /*
+   *	A replaced handler might still be called by transactions in progress,
+   *	so it has to stay valid until they finish.
+   */
+  void set_handler(MetricsHandler *handler) { mp_handler = handler; }
+
+  void record(proto::CommandID cmd, const CommandSample &sample);
+
+  /*
+   *	Totals of the commands run since the last reset.
+   */
+  std::vector<std::pair<proto::CommandID, CommandMetrics>> snapshot();
+  void reset();
+
+ private:
+  // read by all threads running transactions
+  std::atomic<bool> m_enabled;
+  std::atomic<MetricsHandler *> mp_handler;
+  std::mutex m_mutex;
+  std::array<CommandMetrics, 256> m_commands;
+};
+
+/*
+ *	Records the transaction's sample when going out of scope,
+ *	as failed unless finish() was called.
+ */
+class CommandRecorder {
+ public:
+  explicit CommandRecorder(proto::CommandID cmd);
+  ~CommandRecorder();
+
+  void finish(uint8_t last_command_status);
+
+  CommandSample sample;
+
+ private:
+  proto::CommandID m_cmd;
+  std::chrono::steady_clock::time_point m_started_at;
+};
+}
+}
+
+#endif
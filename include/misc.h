@@ -18,7 +18,11 @@ typename T::CommandPayload get_payload(){
 
     std::string hexdump(const char *p, size_t size, bool print_header=true);
     uint32_t stm_crc32(const uint8_t *data, size_t size);
+    // reference implementation of stm_crc32, one polynomial step per bit
+    uint32_t stm_crc32_bitwise(const uint8_t *data, size_t size);
     std::vector<uint8_t> hex_string_to_byte(const char* hexString);
+    // zero memory holding secrets, also when it is not read afterwards
+    void secure_clear(void *p, size_t size);
 }
 }
 
@@ -0,0 +1,146 @@
+#ifndef LIBNITROKEY_SIMULATED_DEVICE_H
+#define LIBNITROKEY_SIMULATED_DEVICE_H
+#include <array>
+#include <chrono>
+#include <string>
+#include "device.h"
+#include "device_proto.h"
+
+namespace nitrokey {
+namespace device {
+
+/*
+ *	Values of DeviceResponse::device_status and
+ *	DeviceResponse::last_command_status, as sent by the firmware.
+ */
+enum class DeviceStatus : uint8_t {
+  READY = 0,
+  BUSY = 1,
+  ERROR = 2,
+  RECEIVED_REPORT = 3,
+};
+
+enum class CommandStatus : uint8_t {
+  OK = 0,
+  WRONG_CRC = 1,
+  WRONG_SLOT = 2,
+  SLOT_NOT_PROGRAMMED = 3,
+  WRONG_PASSWORD = 4,
+  NOT_AUTHORIZED = 5,
+  TIMESTAMP_WARNING = 6,
+  NO_NAME_ERROR = 7,
+  NOT_SUPPORTED = 8,
+  UNKNOWN_COMMAND = 9,
+  AES_DEC_FAILED = 10,
+};
+
+/*
+ *	In-process device answering HID reports like the Pro or Storage
+ *	firmware, without hidapi. Keeps OTP slots, password safe, PINs with
+ *	retry counters and general config in memory, checks the CRC of each
+ *	report and enforces the temporary password authorization.
+ *	Storage-only commands (encrypted volumes, firmware update etc.)
+ *	are answered with NOT_SUPPORTED, except the PIN change.
+ *
+ *	Latency is simulated by answering polls with a busy status until
+ *	the response is due, so the polling in Transaction<>::run is
+ *	exercised as with a real device.
+ */
+class SimulatedDevice : public Device {
+ public:
+  static const char *const default_admin_pin;
+  static const char *const default_user_pin;
+
+  struct Options {
+    // time after sending a command until the response is ready
+    std::chrono::milliseconds latency;
+    // number of polls answered as busy for each command, on top of latency
+    unsigned busy_responses;
+  };
+
+  explicit SimulatedDevice(DeviceModel model = DeviceModel::PRO,
+                           Options options = {std::chrono::milliseconds(0), 0});
+
+  virtual bool connect() override;
+  virtual bool disconnect() override;
+  virtual bool reconnect() override { return connect(); }
+  virtual bool is_connected() const override { return m_connected; }
+  virtual int send(const void *packet) override;
+  virtual int recv(void *packet) override;
+
+  void set_options(Options options) { m_options = options; }
+  Options get_options() const { return m_options; }
+
+  /*
+   *	Restore the state of a new device: default PINs, empty slots.
+   */
+  void factory_reset();
+
+  uint64_t get_received_commands() const { return m_received_commands; }
+  uint64_t get_polls() const { return m_polls; }
+
+ private:
+  struct OTPSlot {
+    bool programmed;
+    uint8_t name[15];
+    uint8_t secret[20];
+    uint8_t config;
+    uint8_t token_id[13];
+    uint64_t counter;
+    uint16_t interval;
+  };
+
+  struct PasswordSafeSlot {
+    bool programmed;
+    uint8_t name[PWS_SLOTNAME_LENGTH];
+    uint8_t password[PWS_PASSWORD_LENGTH];
+    uint8_t login[PWS_LOGINNAME_LENGTH];
+  };
+
+  struct PIN {
+    std::string value;
+    std::string temporary_password;
+    uint8_t retry_count;
+    // CRC of the report authorized with the temporary password, 0 if none
+    uint32_t authorized_crc;
+  };
+
+  CommandStatus execute(proto::CommandID command_id, const uint8_t *packet,
+                        uint32_t crc, uint8_t *response_payload);
+  CommandStatus check_PIN(PIN &pin, const uint8_t *value, size_t size);
+  CommandStatus authorize(PIN &pin, const uint8_t *temporary_password,
+                          size_t size, uint32_t crc_to_authorize);
+  bool consume_authorization(PIN &pin, uint32_t crc);
+  OTPSlot *get_OTP_slot(uint8_t internal_slot_number);
+  uint32_t get_OTP_code(const OTPSlot &slot, uint64_t counter) const;
+  uint64_t get_time() const;
+
+  Options m_options;
+  bool m_connected;
+
+  std::array<OTPSlot, HOTP_SLOT_COUNT> m_hotp_slots;
+  std::array<OTPSlot, TOTP_SLOT_COUNT> m_totp_slots;
+  std::array<PasswordSafeSlot, PWS_SLOT_COUNT> m_password_safe;
+  // SET_PW_SAFE_SLOT_DATA_1 part, stored with SET_PW_SAFE_SLOT_DATA_2
+  PasswordSafeSlot m_password_safe_pending;
+  bool m_password_safe_enabled;
+  PIN m_admin_pin;
+  PIN m_user_pin;
+  // PIN kind verified with the first part of Storage's PIN change, 0 if none
+  uint8_t m_pin_change_kind;
+  uint8_t m_config[5];
+  // time last set, advancing with the clock like the device's RTC
+  uint64_t m_time;
+  std::chrono::steady_clock::time_point m_time_set_at;
+
+  uint8_t m_response[HID_REPORT_SIZE];
+  bool m_response_pending;
+  unsigned m_busy_responses_left;
+  std::chrono::steady_clock::time_point m_response_ready_at;
+
+  uint64_t m_received_commands;
+  uint64_t m_polls;
+};
+}
+}
+#endif
@@ -2,12 +2,13 @@
 #include <string>
 #include <ctime>
 #include <iomanip>
+#include <mutex>
+#include <thread>
 #include "log.h"
 
 namespace nitrokey {
 namespace log {
 
-Log *Log::mp_instance = NULL;
 StdlogHandler stdlog_handler;
 
 std::string LogHandler::loglevel_to_str(Loglevel lvl) {
@@ -27,8 +28,34 @@ std::string LogHandler::loglevel_to_str(Loglevel lvl) {
 }
 
 void Log::operator()(const std::string &logstr, Loglevel lvl) {
-  if (mp_loghandler != NULL)
-    if ((int)(lvl) >= (int)(m_loglevel)) mp_loghandler->print(logstr, lvl);
+  if (enabled(lvl)) print(logstr, lvl);
+}
+
+void Log::operator()(const char *logstr, Loglevel lvl) {
+  // std::string is created only for messages which are printed
+  if (enabled(lvl)) print(logstr, lvl);
+}
+
+void Log::print(const std::string &logstr, Loglevel lvl) {
+  unsigned epoch;
+  for (;;) {
+    epoch = m_epoch;
+    m_printing[epoch & 1]++;
+    // otherwise set_handler might not wait for this message
+    if (m_epoch == epoch) break;
+    m_printing[epoch & 1]--;
+  }
+  // might have been replaced since the enabled() check
+  LogHandler *handler = mp_loghandler;
+  if (handler != NULL) handler->print(logstr, lvl);
+  m_printing[epoch & 1]--;
+}
+
+void Log::set_handler(LogHandler *handler) {
+  std::lock_guard<std::mutex> lock(m_handler_mutex);
+  mp_loghandler = handler;
+  const unsigned previous = m_epoch++;
+  while (m_printing[previous & 1] != 0) std::this_thread::yield();
 }
 
 void StdlogHandler::print(const std::string &str, Loglevel lvl) {
@@ -0,0 +1,69 @@
+#include "metrics.h"
+
+namespace nitrokey {
+namespace metrics {
+
+using namespace std::chrono;
+
+void Metrics::record(proto::CommandID cmd, const CommandSample &sample) {
+  if (!m_enabled) return;
+  {
+    std::lock_guard<std::mutex> lock(m_mutex);
+    auto &m = m_commands[(uint8_t)cmd];
+    m.commands++;
+    if (sample.failed) m.failures++;
+    if (sample.last_command_status != 0) m.command_errors++;
+    m.polls += sample.polls;
+    m.busy_responses += sample.busy_responses;
+    m.crc_mismatches += sample.crc_mismatches;
+    m.recv_retries += sample.recv_retries;
+    m.send_time += sample.send_time;
+    m.first_poll_delay += sample.first_poll_delay;
+    m.total_time += sample.total_time;
+    m.max_time = std::max(m.max_time, sample.total_time);
+    size_t bucket = 0;
+    while (bucket + 1 < latency_buckets &&
+           sample.total_time >= milliseconds(1 << bucket))
+      bucket++;
+    m.latency_histogram[bucket]++;
+  }
+  MetricsHandler *handler = mp_handler;
+  if (handler != NULL) handler->record(cmd, sample);
+}
+
+std::vector<std::pair<proto::CommandID, CommandMetrics>> Metrics::snapshot() {
+  std::vector<std::pair<proto::CommandID, CommandMetrics>> commands;
+  std::lock_guard<std::mutex> lock(m_mutex);
+  for (size_t i = 0; i < m_commands.size(); i++) {
+    if (m_commands[i].commands == 0) continue;
+    commands.push_back(std::make_pair((proto::CommandID)i, m_commands[i]));
+  }
+  return commands;
+}
+
+void Metrics::reset() {
+  std::lock_guard<std::mutex> lock(m_mutex);
+  m_commands.fill(CommandMetrics());
+}
+
+CommandRecorder::CommandRecorder(proto::CommandID cmd)
+    : sample(), m_cmd(cmd), m_started_at(steady_clock::now()) {
+  sample.failed = true;
+}
+
+void CommandRecorder::finish(uint8_t last_command_status) {
+  sample.failed = false;
+  sample.last_command_status = last_command_status;
+}
+
+CommandRecorder::~CommandRecorder() {
+  sample.total_time =
+      duration_cast<microseconds>(steady_clock::now() - m_started_at);
+  try {
+    Metrics::instance().record(m_cmd, sample);
+  } catch (...) {
+    // an exporting handler must not break the command
+  }
+}
+}
+}
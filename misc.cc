@@ -34,6 +34,12 @@ std::vector<uint8_t> hex_string_to_byte(const char* hexString){
     return data;
 };
 
+void secure_clear(void *p, size_t size) {
+    // written through volatile, so the stores are not optimized away
+    volatile uint8_t *v = reinterpret_cast<volatile uint8_t *>(p);
+    for (size_t i = 0; i < size; i++) v[i] = 0;
+}
+
 std::string hexdump(const char *p, size_t size, bool print_header) {
   std::stringstream out;
   char formatbuf[128];
@@ -68,12 +74,60 @@ static uint32_t _crc32(uint32_t crc, uint32_t data) {
   return crc;
 }
 
-uint32_t stm_crc32(const uint8_t *data, size_t size) {
+/*
+ *	Slice-by-8 tables for the STM32 (non-reflected, word-wise) CRC.
+ *	_crc32() is linear, so processing a word is a XOR of per-byte
+ *	contributions: crc_tables[k][b] is the result of shifting byte b,
+ *	placed at byte position k (0 being the least significant byte of the
+ *	later word), through 32 (k < 4) or 64 (k >= 4) polynomial steps.
+ */
+struct CRCTables {
+  uint32_t t[8][256];
+
+  CRCTables() {
+    for (uint32_t b = 0; b < 256; b++) {
+      for (int k = 0; k < 4; k++) {
+        t[k][b] = _crc32(0, b << (8 * k));
+        t[k + 4][b] = _crc32(t[k][b], 0);
+      }
+    }
+  }
+};
+
+static const CRCTables &crc_tables() {
+  static const CRCTables tables;
+  return tables;
+}
+
+uint32_t stm_crc32_bitwise(const uint8_t *data, size_t size) {
   uint32_t crc = 0xffffffff;
   const uint32_t *pend = (const uint32_t *)(data + size);
   for (const uint32_t *p = (const uint32_t *)(data); p < pend; p++)
     crc = _crc32(crc, *p);
   return crc;
 }
+
+uint32_t stm_crc32(const uint8_t *data, size_t size) {
+  const auto &t = crc_tables().t;
+  uint32_t crc = 0xffffffff;
+  const uint32_t *p = (const uint32_t *)(data);
+  const uint32_t *pend = (const uint32_t *)(data + size);
+
+  // two words per step
+  for (; p + 1 < pend; p += 2) {
+    const uint32_t a = crc ^ p[0];
+    const uint32_t b = p[1];
+    crc = t[7][a >> 24] ^ t[6][(a >> 16) & 0xFF] ^ t[5][(a >> 8) & 0xFF] ^
+          t[4][a & 0xFF] ^ t[3][b >> 24] ^ t[2][(b >> 16) & 0xFF] ^
+          t[1][(b >> 8) & 0xFF] ^ t[0][b & 0xFF];
+  }
+  // remaining word, if any
+  for (; p < pend; p++) {
+    const uint32_t a = crc ^ *p;
+    crc = t[3][a >> 24] ^ t[2][(a >> 16) & 0xFF] ^ t[1][(a >> 8) & 0xFF] ^
+          t[0][a & 0xFF];
+  }
+  return crc;
+}
 }
 }
@@ -0,0 +1,305 @@
+"""
+Python bindings of libnitrokey.
+
+    from nitrokey import Nitrokey
+
+    with Nitrokey() as nk:
+        nk.login()
+        nk.first_authenticate('12345678', '123123123')
+        nk.write_hotp_slot(1, 'python_test', '3132333435363738393031323334353637383930', admin_temporary_password='123123123')
+        print(nk.get_hotp_code(1))
+
+Failed commands raise NitrokeyError. Strings returned by the library are copied and freed automatically.
+Functions without a wrapper are available as attributes of Nitrokey.lib.
+"""
+import ctypes.util
+import os
+from collections import namedtuple
+from enum import IntEnum
+
+from nitrokey._nitrokey_cffi import ffi
+
+__all__ = ['Nitrokey', 'NitrokeyError', 'DeviceErrorCode', 'LibraryErrors', 'DeviceInfo', 'CommandMetrics',
+           'load_library']
+
+
+class DeviceErrorCode(IntEnum):
+    STATUS_OK = 0
+    WRONG_CRC = 1
+    WRONG_SLOT = 2
+    NOT_PROGRAMMED = 3
+    WRONG_PASSWORD = 4
+    STATUS_NOT_AUTHORIZED = 5
+    TIMESTAMP_WARNING = 6
+    NO_NAME_ERROR = 7
+    NOT_SUPPORTED = 8
+    UNKNOWN_COMMAND = 9
+    STATUS_AES_DEC_FAILED = 0xa
+
+
+class LibraryErrors(IntEnum):
+    TOO_LONG_STRING = 200
+    INVALID_SLOT = 201
+    INVALID_HEX_STRING = 202
+    TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE = 203
+    INVALID_OTP_ALGORITHM = 204
+    UNKNOWN_OTP_SECRET = 205
+    DEVICE_NOT_CONNECTED = 206
+    DEVICE_COMMUNICATION_ERROR = 207
+
+
+class NitrokeyError(Exception):
+    def __init__(self, status):
+        self.status = status
+        for codes in (DeviceErrorCode, LibraryErrors):
+            try:
+                self.status = codes(status)
+            except ValueError:
+                pass
+        super(NitrokeyError, self).__init__('Command failed with status {!r}'.format(self.status))
+
+
+DeviceInfo = namedtuple('DeviceInfo', 'model serial path')
+
+CommandMetrics = namedtuple('CommandMetrics', 'commands failures command_errors polls busy_responses '
+                                              'crc_mismatches recv_retries send_time_us first_poll_delay_us '
+                                              'total_time_us max_time_us latency_histogram')
+
+_library = None
+
+
+def load_library(path=None):
+    """
+    Open libnitrokey once per process. Looked up in: the given path, LIBNITROKEY_PATH environment variable,
+    the package directory and the system library path.
+    """
+    global _library
+    if _library is not None and path is None:
+        return _library
+    candidates = [path, os.environ.get('LIBNITROKEY_PATH'),
+                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'libnitrokey.so'),
+                  ctypes.util.find_library('nitrokey')]
+    for candidate in candidates:
+        if candidate and (os.path.sep not in candidate or os.path.exists(candidate)):
+            _library = ffi.dlopen(candidate)
+            return _library
+    raise OSError('libnitrokey not found, set LIBNITROKEY_PATH')
+
+
+def _b(s):
+    if s is None:
+        return b''
+    return s.encode('utf-8') if not isinstance(s, bytes) else s
+
+
+class Nitrokey(object):
+    """
+    Typed wrappers of the C API. The library keeps one connection per thread, see NK_login and
+    NK_connect_by_path, so instances share it.
+    """
+
+    def __init__(self, library_path=None):
+        self.lib = load_library(library_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.logout()
+
+    # results
+
+    def _check(self, status):
+        if status != 0:
+            raise NitrokeyError(status)
+
+    def _check_last_status(self, result):
+        self._check(self.lib.NK_get_last_command_status())
+        return result
+
+    def _string(self, result):
+        try:
+            value = ffi.string(result).decode('utf-8', 'replace')
+        finally:
+            self.lib.NK_free(result)
+        return self._check_last_status(value)
+
+    def _array(self, result, size):
+        if result == ffi.NULL:
+            return self._check_last_status(None)
+        try:
+            return list(ffi.unpack(result, size))
+        finally:
+            self.lib.NK_free(result)
+
+    # connection
+
+    def set_debug(self, state):
+        self.lib.NK_set_debug(state)
+
+    def login(self, model=None):
+        """
+        Connect to the device of the model ('P', 'S', 'sim' or 'sim-storage'), or to any device.
+        :return: True if connected
+        """
+        connected = self.lib.NK_login(_b(model)) if model else self.lib.NK_login_auto()
+        return connected == 1
+
+    def logout(self):
+        self._check(self.lib.NK_logout())
+
+    def close_devices(self):
+        self._check(self.lib.NK_close_devices())
+
+    def list_devices(self):
+        devices = []
+        for line in self._string(self.lib.NK_list_devices()).splitlines():
+            model, serial, path = line.split('\t')
+            devices.append(DeviceInfo(model, serial, path))
+        return devices
+
+    def connect_by_path(self, path):
+        return self.lib.NK_connect_by_path(_b(path)) == 1
+
+    def connect_by_serial(self, serial):
+        return self.lib.NK_connect_by_serial(_b(serial)) == 1
+
+    def set_timing(self, send_receive_delay_ms, retry_count, retry_timeout_ms, deadline_ms, command_id=None):
+        if command_id is None:
+            self._check(self.lib.NK_set_timing(send_receive_delay_ms, retry_count, retry_timeout_ms, deadline_ms))
+        else:
+            self._check(self.lib.NK_set_command_timing(command_id, send_receive_delay_ms, retry_count,
+                                                       retry_timeout_ms, deadline_ms))
+
+    # device
+
+    def status(self):
+        return self._string(self.lib.NK_status())
+
+    def serial_number(self):
+        return self._string(self.lib.NK_device_serial_number())
+
+    def get_admin_retry_count(self):
+        return self._check_last_status(self.lib.NK_get_admin_retry_count())
+
+    def get_user_retry_count(self):
+        return self._check_last_status(self.lib.NK_get_user_retry_count())
+
+    def first_authenticate(self, admin_pin, admin_temporary_password):
+        self._check(self.lib.NK_first_authenticate(_b(admin_pin), _b(admin_temporary_password)))
+
+    def user_authenticate(self, user_pin, user_temporary_password):
+        self._check(self.lib.NK_user_authenticate(_b(user_pin), _b(user_temporary_password)))
+
+    def lock_device(self):
+        self._check(self.lib.NK_lock_device())
+
+    def change_admin_PIN(self, current_pin, new_pin):
+        self._check(self.lib.NK_change_admin_PIN(ffi.new('char[]', _b(current_pin)), ffi.new('char[]', _b(new_pin))))
+
+    def change_user_PIN(self, current_pin, new_pin):
+        self._check(self.lib.NK_change_user_PIN(ffi.new('char[]', _b(current_pin)), ffi.new('char[]', _b(new_pin))))
+
+    def read_config(self):
+        return self._array(self.lib.NK_read_config(), 5)
+
+    def write_config(self, numlock, capslock, scrolllock, enable_user_password, delete_user_password,
+                     admin_temporary_password):
+        self._check(self.lib.NK_write_config(numlock, capslock, scrolllock, enable_user_password,
+                                             delete_user_password, _b(admin_temporary_password)))
+
+    def set_time(self, time):
+        self._check(self.lib.NK_totp_set_time(time))
+
+    # OTP
+
+    def get_hotp_slot_name(self, slot_number):
+        return self._string(self.lib.NK_get_hotp_slot_name(slot_number))
+
+    def get_totp_slot_name(self, slot_number):
+        return self._string(self.lib.NK_get_totp_slot_name(slot_number))
+
+    def write_hotp_slot(self, slot_number, slot_name, secret, hotp_counter=0, use_8_digits=False, use_enter=False,
+                        use_tokenID=False, token_ID='', admin_temporary_password=''):
+        self._check(self.lib.NK_write_hotp_slot(slot_number, _b(slot_name), _b(secret), hotp_counter, use_8_digits,
+                                                use_enter, use_tokenID, _b(token_ID), _b(admin_temporary_password)))
+
+    def write_totp_slot(self, slot_number, slot_name, secret, time_window=30, use_8_digits=False, use_enter=False,
+                        use_tokenID=False, token_ID='', admin_temporary_password=''):
+        self._check(self.lib.NK_write_totp_slot(slot_number, _b(slot_name), _b(secret), time_window, use_8_digits,
+                                                use_enter, use_tokenID, _b(token_ID), _b(admin_temporary_password)))
+
+    def erase_hotp_slot(self, slot_number, admin_temporary_password):
+        self._check(self.lib.NK_erase_hotp_slot(slot_number, _b(admin_temporary_password)))
+
+    def erase_totp_slot(self, slot_number, admin_temporary_password):
+        self._check(self.lib.NK_erase_totp_slot(slot_number, _b(admin_temporary_password)))
+
+    def get_hotp_code(self, slot_number, user_temporary_password=None):
+        code = self.lib.NK_get_hotp_code_PIN(slot_number, _b(user_temporary_password))
+        return self._check_last_status(code)
+
+    def get_totp_code(self, slot_number, challenge=0, last_totp_time=0, last_interval=30,
+                      user_temporary_password=None):
+        code = self.lib.NK_get_totp_code_PIN(slot_number, challenge, last_totp_time, last_interval,
+                                             _b(user_temporary_password))
+        return self._check_last_status(code)
+
+    def get_totp_codes(self, slot_numbers, challenge=0, last_totp_time=0, last_interval=30,
+                       user_temporary_password=None):
+        """
+        Read TOTP codes of many slots with one library call.
+        :return: list of (code, status) tuples, code is 0 for slots which could not be read
+        """
+        slot_numbers = list(slot_numbers)
+        codes = ffi.new('uint32_t[]', len(slot_numbers))
+        statuses = ffi.new('uint8_t[]', len(slot_numbers))
+        self._check(self.lib.NK_get_totp_codes(slot_numbers, len(slot_numbers), challenge, last_totp_time,
+                                               last_interval, _b(user_temporary_password), codes, statuses))
+        return list(zip(codes, statuses))
+
+    def get_all_slot_names(self):
+        """
+        Read names of all OTP slots with one library call.
+        :return: (HOTP slot names, TOTP slot names), names of slots which could not be read are empty
+        """
+        name_size, hotp_slots, totp_slots = 16, 3, 15
+        buffer = ffi.new('char[]', name_size * (hotp_slots + totp_slots))
+        self._check(self.lib.NK_get_all_slot_names(buffer, len(buffer), ffi.NULL))
+        names = [ffi.string(buffer + i * name_size).decode('utf-8', 'replace')
+                 for i in range(hotp_slots + totp_slots)]
+        return names[:hotp_slots], names[hotp_slots:]
+
+    # password safe
+
+    def enable_password_safe(self, user_pin):
+        self._check(self.lib.NK_enable_password_safe(_b(user_pin)))
+
+    def get_password_safe_slot_status(self):
+        return self._array(self.lib.NK_get_password_safe_slot_status(), 16)
+
+    def get_password_safe_slot(self, slot_number):
+        """:return: (name, login, password)"""
+        return (self._string(self.lib.NK_get_password_safe_slot_name(slot_number)),
+                self._string(self.lib.NK_get_password_safe_slot_login(slot_number)),
+                self._string(self.lib.NK_get_password_safe_slot_password(slot_number)))
+
+    def write_password_safe_slot(self, slot_number, name, login, password):
+        self._check(self.lib.NK_write_password_safe_slot(slot_number, _b(name), _b(login), _b(password)))
+
+    def erase_password_safe_slot(self, slot_number):
+        self._check(self.lib.NK_erase_password_safe_slot(slot_number))
+
+    # metrics
+
+    def get_metrics(self):
+        """:return: dict of CommandMetrics keyed by command name"""
+        metrics = {}
+        for line in self._string(self.lib.NK_get_metrics()).splitlines():
+            fields = line.split('\t')
+            histogram = [int(c) for c in fields[-1].split(',')]
+            metrics[fields[0]] = CommandMetrics(*([int(f) for f in fields[1:-1]] + [histogram]))
+        return metrics
+
+    def reset_metrics(self):
+        self.lib.NK_reset_metrics()
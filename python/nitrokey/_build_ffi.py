@@ -0,0 +1,35 @@
+"""
+Build script of the out-of-line cffi module nitrokey._nitrokey_cffi.
+
+The declarations of NK_C_API.h are parsed once here, at build time, and stored in the generated module,
+so importing the package does not read the header. The library itself is loaded at runtime,
+see nitrokey.load_library.
+"""
+import os
+import cffi
+
+HEADER = os.environ.get('NITROKEY_HEADER',
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'NK_C_API.h'))
+
+
+def read_declarations(path):
+    """Return the C API function declarations, one per item, without the extern keyword."""
+    declarations = []
+    with open(path, 'r') as f:
+        lines = iter(f.readlines())
+    for line in lines:
+        if line.startswith('extern') and '"C"' not in line:
+            declaration = line.replace('extern', '', 1).strip()
+            while ';' not in declaration:
+                declaration += ' ' + next(lines).strip()
+            declarations.append(declaration)
+    return declarations
+
+
+ffibuilder = cffi.FFI()
+ffibuilder.cdef('\n'.join(read_declarations(HEADER)))
+# ABI mode: no compiler needed, libnitrokey is opened with dlopen
+ffibuilder.set_source('nitrokey._nitrokey_cffi', None)
+
+if __name__ == '__main__':
+    ffibuilder.compile(tmpdir=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
@@ -0,0 +1,95 @@
+"""
+asyncio client of libnitrokey (Python 3.5+).
+
+    from nitrokey.aio import AsyncNitrokey
+
+    async def main():
+        for device in await AsyncNitrokey.connect_all(timeout=5):
+            async with device:
+                hotp_names, totp_names = await device.get_all_slot_names()
+                codes = await device.get_totp_codes(range(len(totp_names)))
+
+Each device is served by its own worker thread, so device I/O never blocks the event loop. cffi releases
+the GIL during library calls, so other coroutines and devices run while a command waits for the device.
+"""
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from nitrokey import Nitrokey
+
+__all__ = ['AsyncNitrokey']
+
+
+class AsyncNitrokey(object):
+    """
+    Coroutine versions of all Nitrokey methods, run one after another on the worker thread of the device.
+    The library keeps the connection per thread (see NK_connect_by_path), so the worker thread stays
+    connected to its device for the lifetime of the client.
+
+    Each method accepts keyword argument timeout (seconds, defaults to the client's timeout) and raises
+    asyncio.TimeoutError when it expires. A timed out or cancelled call which was still queued is not sent;
+    a command already sent to the device finishes in the background and delays the following calls.
+    """
+
+    def __init__(self, library_path=None, timeout=None):
+        self.timeout = timeout
+        self._nitrokey = Nitrokey(library_path)
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    @classmethod
+    async def connect(cls, model=None, path=None, serial=None, library_path=None, timeout=None):
+        """
+        Connect to the device under given USB path or with given serial number, or otherwise to any
+        device of the model ('P', 'S', 'sim' or 'sim-storage') like Nitrokey.login.
+        Devices connected by model share a single connection, use path or serial to work with many devices.
+        :raise ConnectionError: if the device could not be connected
+        """
+        client = cls(library_path, timeout)
+        if path is not None:
+            connected = await client.call('connect_by_path', path)
+        elif serial is not None:
+            connected = await client.call('connect_by_serial', serial)
+        else:
+            connected = await client.call('login', model)
+        if not connected:
+            client._executor.shutdown(wait=False)
+            raise ConnectionError('Could not connect to Nitrokey device')
+        return client
+
+    @classmethod
+    async def connect_all(cls, library_path=None, timeout=None):
+        """
+        Connect to all Nitrokey devices, concurrently.
+        :return: list of clients, one per device
+        """
+        loop = asyncio.get_event_loop()
+        devices = await loop.run_in_executor(None, Nitrokey(library_path).list_devices)
+        return await asyncio.gather(*[cls.connect(path=device.path, library_path=library_path, timeout=timeout)
+                                      for device in devices])
+
+    async def call(self, method, *args, **kwargs):
+        """Run Nitrokey method on the worker thread of the device."""
+        timeout = kwargs.pop('timeout', self.timeout)
+        loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(self._executor,
+                                      functools.partial(getattr(self._nitrokey, method), *args, **kwargs))
+        return await asyncio.wait_for(future, timeout)
+
+    def __getattr__(self, name):
+        if name.startswith('_') or not callable(getattr(Nitrokey, name, None)):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
+
+    async def close(self):
+        """Disconnect the device and stop the worker thread."""
+        try:
+            await self.call('logout')
+        finally:
+            self._executor.shutdown(wait=False)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
@@ -0,0 +1,12 @@
+from setuptools import setup
+
+setup(
+    name='nitrokey',
+    version='0.1',
+    description='Python bindings of libnitrokey',
+    license='LGPLv3',
+    packages=['nitrokey'],
+    setup_requires=['cffi>=1.9'],
+    install_requires=['cffi>=1.9', 'enum34;python_version<"3.4"'],
+    cffi_modules=['nitrokey/_build_ffi.py:ffibuilder'],
+)
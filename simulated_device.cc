@@ -0,0 +1,496 @@
+#include <algorithm>
+#include <cstring>
+#include "include/simulated_device.h"
+#include "include/hash.h"
+#include "include/log.h"
+#include "include/misc.h"
+#include "include/stick10_commands.h"
+#include "include/stick20_commands.h"
+
+using namespace nitrokey::device;
+using namespace nitrokey::log;
+using namespace nitrokey::proto;
+using namespace nitrokey::proto::stick10;
+using namespace nitrokey::proto::stick20;
+
+namespace {
+
+const uint8_t max_PIN_retry_count = 3;
+const uint16_t firmware_version = 8;
+const uint8_t card_serial[4] = {0x53, 0x49, 0x4d, 0x01};
+
+/*
+ *	Views of the raw reports as the packets defined for the commands.
+ *	All of them share the HIDReport/DeviceResponse layout.
+ */
+template <typename C>
+const typename C::CommandTransaction::CommandPayload &request(
+    const uint8_t *packet) {
+  return reinterpret_cast<const typename C::CommandTransaction::OutgoingPacket *>(
+             packet)->payload;
+}
+
+template <typename C>
+typename C::CommandTransaction::ResponsePayload &response(uint8_t *payload) {
+  return *reinterpret_cast<typename C::CommandTransaction::ResponsePayload *>(
+      payload);
+}
+
+typedef GetStatus::CommandTransaction::ResponsePacket ResponsePacket;
+
+template <typename T, size_t N>
+std::string field_string(const T (&field)[N]) {
+  return std::string((const char *)field, strnlen((const char *)field, N));
+}
+
+template <typename T, size_t N, typename U, size_t M>
+void copy_field(T (&dest)[N], const U (&src)[M]) {
+  static_assert(N == M, "field sizes differ");
+  memcpy(dest, src, N);
+}
+}
+
+const char *const SimulatedDevice::default_admin_pin = "12345678";
+const char *const SimulatedDevice::default_user_pin = "123456";
+
+SimulatedDevice::SimulatedDevice(DeviceModel model, Options options)
+    : m_options(options), m_connected(false), m_received_commands(0),
+      m_polls(0) {
+  m_model = model;
+  m_path = model == DeviceModel::PRO ? "sim-pro" : "sim-storage";
+  // there is no USB latency, poll as often as the response can be ready
+  m_timing = {std::chrono::milliseconds(20), std::chrono::milliseconds(1),
+              std::chrono::milliseconds(20), 100, std::chrono::milliseconds(2000)};
+  factory_reset();
+  bzero(m_response, sizeof m_response);
+  m_response_pending = false;
+  m_busy_responses_left = 0;
+}
+
+void SimulatedDevice::factory_reset() {
+  bzero(m_hotp_slots.data(), sizeof(m_hotp_slots));
+  bzero(m_totp_slots.data(), sizeof(m_totp_slots));
+  bzero(m_password_safe.data(), sizeof(m_password_safe));
+  bzero(&m_password_safe_pending, sizeof(m_password_safe_pending));
+  m_password_safe_enabled = false;
+  m_admin_pin = {default_admin_pin, "", max_PIN_retry_count, 0};
+  m_user_pin = {default_user_pin, "", max_PIN_retry_count, 0};
+  m_pin_change_kind = 0;
+  // OTP on lock keys disabled, codes not PIN protected
+  const uint8_t config[5] = {0xff, 0xff, 0xff, 0, 1};
+  memcpy(m_config, config, sizeof m_config);
+  m_time = 0;
+  m_time_set_at = std::chrono::steady_clock::now();
+}
+
+bool SimulatedDevice::connect() {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+  m_connected = true;
+  return true;
+}
+
+bool SimulatedDevice::disconnect() {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+  m_connected = false;
+  return true;
+}
+
+int SimulatedDevice::send(const void *packet) {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+  if (!m_connected)
+    throw std::runtime_error("Attempted HID send on an invalid descriptor.");
+
+  const uint8_t *report = (const uint8_t *)packet;
+  const CommandID command_id = (CommandID)report[1];
+  uint32_t crc;
+  memcpy(&crc, report + HID_REPORT_SIZE - 4, sizeof crc);
+  m_received_commands++;
+
+  bzero(m_response, sizeof m_response);
+  auto &resp = *reinterpret_cast<ResponsePacket *>(m_response);
+  resp.command_id = (uint8_t)command_id;
+  resp.last_command_crc = crc;
+  if (crc != misc::stm_crc32(report + 1, HID_REPORT_SIZE - 5)) {
+    resp.last_command_status = (uint8_t)CommandStatus::WRONG_CRC;
+  } else {
+    resp.last_command_status = (uint8_t)execute(
+        command_id, report, crc, (uint8_t *)&resp.payload);
+  }
+  resp.device_status = (uint8_t)DeviceStatus::READY;
+  resp.update_CRC();
+
+  m_response_pending = true;
+  m_busy_responses_left = m_options.busy_responses;
+  m_response_ready_at = std::chrono::steady_clock::now() + m_options.latency;
+  return HID_REPORT_SIZE;
+}
+
+int SimulatedDevice::recv(void *packet) {
+  Log::instance()(__PRETTY_FUNCTION__, Loglevel::DEBUG_L2);
+
+  if (!m_connected)
+    throw std::runtime_error("Attempted HID receive on an invalid descriptor.");
+
+  m_polls++;
+  const bool ready = m_busy_responses_left == 0 &&
+                     std::chrono::steady_clock::now() >= m_response_ready_at;
+  if (m_response_pending && !ready) {
+    if (m_busy_responses_left > 0) m_busy_responses_left--;
+    // still working on the command, nothing but the status is valid
+    ResponsePacket busy;
+    busy.initialize();
+    busy.device_status = (uint8_t)DeviceStatus::BUSY;
+    busy.command_id = m_response[2];
+    busy.update_CRC();
+    memcpy(packet, &busy, HID_REPORT_SIZE);
+    return HID_REPORT_SIZE;
+  }
+  memcpy(packet, m_response, HID_REPORT_SIZE);
+  return HID_REPORT_SIZE;
+}
+
+CommandStatus SimulatedDevice::check_PIN(PIN &pin, const uint8_t *value,
+                                         size_t size) {
+  if (pin.retry_count == 0) return CommandStatus::WRONG_PASSWORD;
+  if (std::string((const char *)value, strnlen((const char *)value, size)) !=
+      pin.value) {
+    pin.retry_count--;
+    return CommandStatus::WRONG_PASSWORD;
+  }
+  pin.retry_count = max_PIN_retry_count;
+  return CommandStatus::OK;
+}
+
+CommandStatus SimulatedDevice::authorize(PIN &pin,
+                                         const uint8_t *temporary_password,
+                                         size_t size,
+                                         uint32_t crc_to_authorize) {
+  const std::string password((const char *)temporary_password,
+                             strnlen((const char *)temporary_password, size));
+  if (pin.temporary_password.empty() || password != pin.temporary_password) {
+    pin.authorized_crc = 0;
+    return CommandStatus::WRONG_PASSWORD;
+  }
+  pin.authorized_crc = crc_to_authorize;
+  return CommandStatus::OK;
+}
+
+bool SimulatedDevice::consume_authorization(PIN &pin, uint32_t crc) {
+  const bool authorized = pin.authorized_crc != 0 && pin.authorized_crc == crc;
+  pin.authorized_crc = 0;
+  return authorized;
+}
+
+SimulatedDevice::OTPSlot *SimulatedDevice::get_OTP_slot(
+    uint8_t internal_slot_number) {
+  if (internal_slot_number >= 0x10 &&
+      internal_slot_number < 0x10 + HOTP_SLOT_COUNT)
+    return &m_hotp_slots[internal_slot_number - 0x10];
+  if (internal_slot_number >= 0x20 &&
+      internal_slot_number < 0x20 + TOTP_SLOT_COUNT)
+    return &m_totp_slots[internal_slot_number - 0x20];
+  return nullptr;
+}
+
+uint32_t SimulatedDevice::get_OTP_code(const OTPSlot &slot,
+                                       uint64_t counter) const {
+  uint8_t message[8];
+  for (int i = 7; i >= 0; i--, counter >>= 8) message[i] = counter & 0xFF;
+  // secret is zero padded to 20 bytes, as is the HMAC key anyway
+  hash::HMAC<hash::SHA1> hmac(slot.secret, sizeof slot.secret);
+  uint8_t mac[hash::SHA1::digest_size];
+  hmac.compute(message, sizeof message, mac);
+  const uint8_t offset = mac[sizeof mac - 1] & 0x0F;
+  const uint32_t code = ((uint32_t)(mac[offset] & 0x7F) << 24) |
+                        ((uint32_t)mac[offset + 1] << 16) |
+                        ((uint32_t)mac[offset + 2] << 8) |
+                        (uint32_t)mac[offset + 3];
+  const bool use_8_digits = slot.config & 1;
+  return code % (use_8_digits ? 100000000 : 1000000);
+}
+
+uint64_t SimulatedDevice::get_time() const {
+  const auto elapsed = std::chrono::steady_clock::now() - m_time_set_at;
+  return m_time + (uint64_t)std::chrono::duration_cast<std::chrono::seconds>(
+                      elapsed).count();
+}
+
+CommandStatus SimulatedDevice::execute(CommandID command_id,
+                                       const uint8_t *packet, uint32_t crc,
+                                       uint8_t *response_payload) {
+  switch (command_id) {
+    case CommandID::GET_STATUS: {
+      auto &r = response<GetStatus>(response_payload);
+      r.firmware_version = firmware_version;
+      copy_field(r.card_serial, card_serial);
+      copy_field(r.general_config, m_config);
+      return CommandStatus::OK;
+    }
+
+    case CommandID::GET_PASSWORD_RETRY_COUNT:
+      response<GetPasswordRetryCount>(response_payload).password_retry_count =
+          m_admin_pin.retry_count;
+      return CommandStatus::OK;
+
+    case CommandID::GET_USER_PASSWORD_RETRY_COUNT:
+      response<GetUserPasswordRetryCount>(response_payload)
+          .password_retry_count = m_user_pin.retry_count;
+      return CommandStatus::OK;
+
+    case CommandID::FIRST_AUTHENTICATE: {
+      auto &p = request<FirstAuthenticate>(packet);
+      auto status = check_PIN(m_admin_pin, p.card_password, sizeof p.card_password);
+      if (status == CommandStatus::OK)
+        m_admin_pin.temporary_password = field_string(p.temporary_password);
+      return status;
+    }
+
+    case CommandID::USER_AUTHENTICATE: {
+      auto &p = request<UserAuthenticate>(packet);
+      auto status = check_PIN(m_user_pin, p.card_password, sizeof p.card_password);
+      if (status == CommandStatus::OK)
+        m_user_pin.temporary_password = field_string(p.temporary_password);
+      return status;
+    }
+
+    case CommandID::AUTHORIZE: {
+      auto &p = request<Authorize>(packet);
+      return authorize(m_admin_pin, p.temporary_password,
+                       sizeof p.temporary_password, p.crc_to_authorize);
+    }
+
+    case CommandID::USER_AUTHORIZE: {
+      auto &p = request<UserAuthorize>(packet);
+      return authorize(m_user_pin, p.temporary_password,
+                       sizeof p.temporary_password, p.crc_to_authorize);
+    }
+
+    case CommandID::WRITE_TO_SLOT: {
+      if (!consume_authorization(m_admin_pin, crc))
+        return CommandStatus::NOT_AUTHORIZED;
+      // HOTP and TOTP payloads differ only in the last field
+      auto &p = request<WriteToHOTPSlot>(packet);
+      auto slot = get_OTP_slot(p.slot_number);
+      if (slot == nullptr) return CommandStatus::WRONG_SLOT;
+      if (p.slot_name[0] == 0) return CommandStatus::NO_NAME_ERROR;
+      slot->programmed = true;
+      copy_field(slot->name, p.slot_name);
+      copy_field(slot->secret, p.slot_secret);
+      slot->config = p._slot_config;
+      copy_field(slot->token_id, p.slot_token_id);
+      if (p.slot_number < 0x20) {
+        slot->counter = p.slot_counter;
+      } else {
+        slot->interval = request<WriteToTOTPSlot>(packet).slot_interval;
+      }
+      return CommandStatus::OK;
+    }
+
+    case CommandID::ERASE_SLOT: {
+      if (!consume_authorization(m_admin_pin, crc))
+        return CommandStatus::NOT_AUTHORIZED;
+      auto slot = get_OTP_slot(request<EraseSlot>(packet).slot_number);
+      if (slot == nullptr) return CommandStatus::WRONG_SLOT;
+      bzero(slot, sizeof *slot);
+      return CommandStatus::OK;
+    }
+
+    case CommandID::READ_SLOT_NAME: {
+      auto slot = get_OTP_slot(request<GetSlotName>(packet).slot_number);
+      if (slot == nullptr) return CommandStatus::WRONG_SLOT;
+      if (!slot->programmed) return CommandStatus::SLOT_NOT_PROGRAMMED;
+      copy_field(response<GetSlotName>(response_payload).slot_name, slot->name);
+      return CommandStatus::OK;
+    }
+
+    case CommandID::READ_SLOT: {
+      auto slot = get_OTP_slot(request<ReadSlot>(packet).slot_number);
+      if (slot == nullptr) return CommandStatus::WRONG_SLOT;
+      if (!slot->programmed) return CommandStatus::SLOT_NOT_PROGRAMMED;
+      auto &r = response<ReadSlot>(response_payload);
+      copy_field(r.slot_name, slot->name);
+      r.config = slot->config;
+      copy_field(r.token_id, slot->token_id);
+      r.counter = slot->counter;
+      return CommandStatus::OK;
+    }
+
+    case CommandID::GET_CODE: {
+      auto &p = request<GetTOTP>(packet);
+      auto slot = get_OTP_slot(p.slot_number);
+      if (slot == nullptr) return CommandStatus::WRONG_SLOT;
+      const bool pin_protected = m_config[3] != 0;
+      if (pin_protected && !consume_authorization(m_user_pin, crc))
+        return CommandStatus::NOT_AUTHORIZED;
+      if (!slot->programmed) return CommandStatus::SLOT_NOT_PROGRAMMED;
+      auto &r = response<GetTOTP>(response_payload);
+      if (p.slot_number < 0x20) {
+        r.code = get_OTP_code(*slot, slot->counter++);
+      } else {
+        const uint16_t interval = slot->interval != 0 ? slot->interval : 30;
+        r.code = get_OTP_code(*slot, get_time() / interval);
+      }
+      r._slot_config = slot->config;
+      return CommandStatus::OK;
+    }
+
+    case CommandID::SET_TIME: {
+      auto &p = request<SetTime>(packet);
+      // without reset, the device refuses to go back in time
+      if (p.reset == 0 && p.time < get_time())
+        return CommandStatus::TIMESTAMP_WARNING;
+      m_time = p.time;
+      m_time_set_at = std::chrono::steady_clock::now();
+      return CommandStatus::OK;
+    }
+
+    case CommandID::WRITE_CONFIG: {
+      if (!consume_authorization(m_admin_pin, crc))
+        return CommandStatus::NOT_AUTHORIZED;
+      copy_field(m_config, request<WriteGeneralConfig>(packet).config);
+      return CommandStatus::OK;
+    }
+
+    case CommandID::CHANGE_USER_PIN:
+    case CommandID::CHANGE_ADMIN_PIN: {
+      if (m_model != DeviceModel::PRO) return CommandStatus::UNKNOWN_COMMAND;
+      auto &p = request<ChangeUserPin>(packet);
+      auto &pin =
+          command_id == CommandID::CHANGE_USER_PIN ? m_user_pin : m_admin_pin;
+      auto status = check_PIN(pin, p.old_pin, sizeof p.old_pin);
+      if (status == CommandStatus::OK) pin.value = field_string(p.new_pin);
+      return status;
+    }
+
+    case CommandID::STICK20_CMD_SEND_PASSWORD: {
+      if (m_model != DeviceModel::STORAGE) return CommandStatus::UNKNOWN_COMMAND;
+      auto &p = request<ChangeAdminUserPin20Current>(packet);
+      auto &pin = p.kind == (uint8_t)PasswordKind::Admin ? m_admin_pin : m_user_pin;
+      auto status = check_PIN(pin, p.old_pin, sizeof p.old_pin);
+      m_pin_change_kind = status == CommandStatus::OK ? p.kind : 0;
+      return status;
+    }
+
+    case CommandID::STICK20_CMD_SEND_NEW_PASSWORD: {
+      if (m_model != DeviceModel::STORAGE) return CommandStatus::UNKNOWN_COMMAND;
+      auto &p = request<ChangeAdminUserPin20New>(packet);
+      const bool verified = m_pin_change_kind != 0 && m_pin_change_kind == p.kind;
+      m_pin_change_kind = 0;
+      if (!verified) return CommandStatus::NOT_AUTHORIZED;
+      auto &pin = p.kind == (uint8_t)PasswordKind::Admin ? m_admin_pin : m_user_pin;
+      pin.value = field_string(p.new_pin);
+      return CommandStatus::OK;
+    }
+
+    case CommandID::UNLOCK_USER_PASSWORD: {
+      auto &p = request<UnlockUserPassword>(packet);
+      auto status = check_PIN(m_admin_pin, p.admin_password, sizeof p.admin_password);
+      if (status == CommandStatus::OK) {
+        m_user_pin.value = field_string(p.user_new_password);
+        m_user_pin.retry_count = max_PIN_retry_count;
+      }
+      return status;
+    }
+
+    case CommandID::LOCK_DEVICE:
+      m_admin_pin.temporary_password.clear();
+      m_user_pin.temporary_password.clear();
+      m_password_safe_enabled = false;
+      return CommandStatus::OK;
+
+    case CommandID::FACTORY_RESET: {
+      auto &p = request<FactoryReset>(packet);
+      auto status = check_PIN(m_admin_pin, p.admin_password, sizeof p.admin_password);
+      if (status == CommandStatus::OK) factory_reset();
+      return status;
+    }
+
+    case CommandID::NEW_AES_KEY: {
+      auto &p = request<BuildAESKey>(packet);
+      auto status = check_PIN(m_admin_pin, p.admin_password, sizeof p.admin_password);
+      if (status == CommandStatus::OK) {
+        // data encrypted with the previous key is lost
+        bzero(m_password_safe.data(), sizeof(m_password_safe));
+        m_password_safe_enabled = false;
+      }
+      return status;
+    }
+
+    case CommandID::DETECT_SC_AES: {
+      auto &p = request<IsAESSupported>(packet);
+      return check_PIN(m_user_pin, p.user_password, sizeof p.user_password);
+    }
+
+    case CommandID::PW_SAFE_ENABLE: {
+      auto &p = request<EnablePasswordSafe>(packet);
+      auto status = check_PIN(m_user_pin, p.user_password, sizeof p.user_password);
+      m_password_safe_enabled = status == CommandStatus::OK;
+      return status;
+    }
+
+    case CommandID::GET_PW_SAFE_SLOT_STATUS: {
+      if (!m_password_safe_enabled) return CommandStatus::NOT_AUTHORIZED;
+      auto &r = response<GetPasswordSafeSlotStatus>(response_payload);
+      for (size_t i = 0; i < m_password_safe.size(); i++)
+        r.password_safe_status[i] = m_password_safe[i].programmed;
+      return CommandStatus::OK;
+    }
+
+    case CommandID::GET_PW_SAFE_SLOT_NAME:
+    case CommandID::GET_PW_SAFE_SLOT_PASSWORD:
+    case CommandID::GET_PW_SAFE_SLOT_LOGINNAME: {
+      if (!m_password_safe_enabled) return CommandStatus::NOT_AUTHORIZED;
+      const uint8_t slot_number = request<GetPasswordSafeSlotName>(packet).slot_number;
+      if (slot_number >= PWS_SLOT_COUNT) return CommandStatus::WRONG_SLOT;
+      auto &slot = m_password_safe[slot_number];
+      if (!slot.programmed) return CommandStatus::SLOT_NOT_PROGRAMMED;
+      if (command_id == CommandID::GET_PW_SAFE_SLOT_NAME)
+        copy_field(response<GetPasswordSafeSlotName>(response_payload).slot_name, slot.name);
+      else if (command_id == CommandID::GET_PW_SAFE_SLOT_PASSWORD)
+        copy_field(response<GetPasswordSafeSlotPassword>(response_payload).slot_password,
+                   slot.password);
+      else
+        copy_field(response<GetPasswordSafeSlotLogin>(response_payload).slot_login, slot.login);
+      return CommandStatus::OK;
+    }
+
+    case CommandID::SET_PW_SAFE_SLOT_DATA_1: {
+      if (!m_password_safe_enabled) return CommandStatus::NOT_AUTHORIZED;
+      auto &p = request<SetPasswordSafeSlotData>(packet);
+      if (p.slot_number >= PWS_SLOT_COUNT) return CommandStatus::WRONG_SLOT;
+      copy_field(m_password_safe_pending.name, p.slot_name);
+      copy_field(m_password_safe_pending.password, p.slot_password);
+      return CommandStatus::OK;
+    }
+
+    case CommandID::SET_PW_SAFE_SLOT_DATA_2: {
+      if (!m_password_safe_enabled) return CommandStatus::NOT_AUTHORIZED;
+      auto &p = request<SetPasswordSafeSlotData2>(packet);
+      if (p.slot_number >= PWS_SLOT_COUNT) return CommandStatus::WRONG_SLOT;
+      auto &slot = m_password_safe[p.slot_number];
+      slot = m_password_safe_pending;
+      copy_field(slot.login, p.slot_login_name);
+      slot.programmed = true;
+      bzero(&m_password_safe_pending, sizeof(m_password_safe_pending));
+      return CommandStatus::OK;
+    }
+
+    case CommandID::PW_SAFE_ERASE_SLOT: {
+      if (!m_password_safe_enabled) return CommandStatus::NOT_AUTHORIZED;
+      const uint8_t slot_number = request<ErasePasswordSafeSlot>(packet).slot_number;
+      if (slot_number >= PWS_SLOT_COUNT) return CommandStatus::WRONG_SLOT;
+      bzero(&m_password_safe[slot_number], sizeof(PasswordSafeSlot));
+      return CommandStatus::OK;
+    }
+
+    default:
+      break;
+  }
+  // Storage commands for volumes, firmware etc. are not simulated
+  if (m_model == DeviceModel::STORAGE &&
+      (uint8_t)command_id >= STICK20_CMD_START_VALUE &&
+      command_id < CommandID::GET_PW_SAFE_SLOT_STATUS)
+    return CommandStatus::NOT_SUPPORTED;
+  return CommandStatus::UNKNOWN_COMMAND;
+}
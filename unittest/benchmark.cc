@@ -0,0 +1,215 @@
+/*
+ * Benchmarks of the transaction layer and the C API, run against SimulatedDevice, so no hardware is needed.
+ *
+ *   LD_LIBRARY_PATH=. ./benchmark [--quick] [--save FILE] [--baseline FILE] [--tolerance 0.2]
+ *
+ * Prints latency percentiles and heap allocations per operation. With --baseline, the median of each
+ * benchmark is compared to the saved one and the exit code is 1 if any is slower by more than the tolerance.
+ */
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <cstdlib>
+#include <cstring>
+#include <fstream>
+#include <iomanip>
+#include <iostream>
+#include <map>
+#include <new>
+#include <sstream>
+#include <string>
+#include <vector>
+#include "NitrokeyManager.h"
+#include "../NK_C_API.h"
+#include "misc.h"
+
+using namespace std;
+using namespace nitrokey;
+
+// heap allocations of the whole process, the library included
+static std::atomic<uint64_t> allocations(0);
+
+void *operator new(size_t size) {
+    allocations++;
+    void *p = malloc(size == 0 ? 1 : size);
+    if (p == nullptr) throw std::bad_alloc();
+    return p;
+}
+
+void operator delete(void *p) noexcept { free(p); }
+void operator delete(void *p, size_t) noexcept { free(p); }
+
+const char *RFC_SECRET = "3132333435363738393031323334353637383930";
+const char *ADMIN_TEMP = "123123123";
+
+struct Result {
+    string name;
+    size_t iterations;
+    double mean_us;
+    double p50_us;
+    double p90_us;
+    double p99_us;
+    double max_us;
+    double allocations;  // per operation
+};
+
+template <typename F>
+Result measure(const string &name, size_t iterations, F operation) {
+    vector<double> times;
+    times.reserve(iterations);
+    operation();  // warm-up, e.g. adaptive polling learns the latency
+    const uint64_t allocations_before = allocations;
+    for (size_t i = 0; i < iterations; i++) {
+        auto start = chrono::steady_clock::now();
+        operation();
+        times.push_back(chrono::duration<double, micro>(chrono::steady_clock::now() - start).count());
+    }
+    const uint64_t operation_allocations = allocations - allocations_before;
+    sort(times.begin(), times.end());
+    auto percentile = [&](double p) { return times[min(times.size() - 1, (size_t) (p * times.size()))]; };
+    double total = 0;
+    for (auto t : times) total += t;
+    return {name, iterations, total / iterations, percentile(0.5), percentile(0.9), percentile(0.99),
+            times.back(), (double) operation_allocations / iterations};
+}
+
+shared_ptr<SimulatedDevice> simulated_device(chrono::milliseconds latency, unsigned busy_responses,
+                                             const TimingProfile *timing) {
+    auto device = make_shared<SimulatedDevice>(DeviceModel::PRO, SimulatedDevice::Options{latency, busy_responses});
+    device->connect();
+    if (timing != nullptr) device->set_timing(*timing);
+    return device;
+}
+
+vector<Result> run_benchmarks(size_t scale) {
+    vector<Result> results;
+    const size_t cpu_iterations = 100000 / scale, device_iterations = 2000 / scale, polling_iterations = 200 / scale;
+
+    uint8_t packet[HID_REPORT_SIZE];
+    for (size_t i = 0; i < sizeof packet; i++) packet[i] = (uint8_t) i;
+    volatile uint32_t crc_sink;
+    results.push_back(measure("stm_crc32", cpu_iterations, [&]() {
+        crc_sink = misc::stm_crc32(packet + 1, HID_REPORT_SIZE - 5);
+    }));
+    results.push_back(measure("stm_crc32_bitwise", cpu_iterations, [&]() {
+        crc_sink = misc::stm_crc32_bitwise(packet + 1, HID_REPORT_SIZE - 5);
+    }));
+    results.push_back(measure("hex_string_to_byte", cpu_iterations, [&]() {
+        misc::hex_string_to_byte(RFC_SECRET);
+    }));
+
+    auto query = GetSlotName::CommandTransaction::prepare({0x10});
+    GetSlotName::CommandTransaction::ResponsePacket response;
+    response.initialize();
+    results.push_back(measure("dissect_query", cpu_iterations / 10, [&]() { (std::string) query; }));
+    results.push_back(measure("dissect_response", cpu_iterations / 10, [&]() { (std::string) response; }));
+
+    // transaction overhead: the response is ready on the first poll, which is not delayed
+    auto timing = SimulatedDevice().get_timing();
+    timing.min_poll_delay = chrono::milliseconds(0);
+    auto device = simulated_device(chrono::milliseconds(0), 0, &timing);
+    results.push_back(measure("transaction_run", device_iterations, [&]() {
+        GetStatus::CommandTransaction::run(*device);
+    }));
+    device = simulated_device(chrono::milliseconds(0), 2, &timing);
+    results.push_back(measure("transaction_run_2_busy", device_iterations, [&]() {
+        GetStatus::CommandTransaction::run(*device);
+    }));
+
+    // response polling with the devices' default timing, for a command taking 5 ms
+    for (auto model : {DeviceModel::PRO, DeviceModel::STORAGE}) {
+        auto model_timing = (model == DeviceModel::PRO ? Stick10().get_timing() : Stick20().get_timing());
+        device = simulated_device(chrono::milliseconds(5), 0, &model_timing);
+        results.push_back(measure(model == DeviceModel::PRO ? "polling_5ms_pro_timing" : "polling_5ms_storage_timing",
+                                  polling_iterations, [&]() { GetStatus::CommandTransaction::run(*device); }));
+    }
+
+    // C API, called directly, with the simulated device's default timing like in benchmark_bindings.py,
+    // which makes the same calls through cffi
+    NK_login("sim");
+    auto manager = NitrokeyManager::instance();
+    manager->first_authenticate("12345678", ADMIN_TEMP);
+    for (uint8_t slot = 0; slot < 15; slot++)
+        manager->write_TOTP_slot(slot, "benchmark", RFC_SECRET, 30, false, false, false, "", ADMIN_TEMP);
+    results.push_back(measure("NK_get_totp_code", device_iterations, []() {
+        NK_get_totp_code(1, 0, 0, 30);
+    }));
+    results.push_back(measure("NK_get_totp_slot_name_loop", device_iterations / 15, []() {
+        for (uint8_t slot = 0; slot < 15; slot++) NK_free((void *) NK_get_totp_slot_name(slot));
+    }));
+    char names[18 * 16];
+    results.push_back(measure("NK_get_all_slot_names", device_iterations / 15, [&]() {
+        NK_get_all_slot_names(names, sizeof names, nullptr);
+    }));
+    NK_logout();
+    return results;
+}
+
+const char *results_header = "# name\titerations\tmean_us\tp50_us\tp90_us\tp99_us\tmax_us\tallocations";
+
+void save_results(const vector<Result> &results, const string &path) {
+    ofstream out(path);
+    out << results_header << endl;
+    for (auto &r : results)
+        out << r.name << '\t' << r.iterations << '\t' << r.mean_us << '\t' << r.p50_us << '\t' << r.p90_us << '\t'
+            << r.p99_us << '\t' << r.max_us << '\t' << r.allocations << endl;
+}
+
+map<string, Result> load_results(const string &path) {
+    map<string, Result> results;
+    ifstream in(path);
+    string line;
+    while (getline(in, line)) {
+        if (line.empty() || line[0] == '#') continue;
+        istringstream fields(line);
+        Result r;
+        fields >> r.name >> r.iterations >> r.mean_us >> r.p50_us >> r.p90_us >> r.p99_us >> r.max_us
+               >> r.allocations;
+        if (fields) results[r.name] = r;
+    }
+    return results;
+}
+
+int main(int argc, char **argv) {
+    string save_path, baseline_path;
+    double tolerance = 0.2;
+    size_t scale = 1;
+    for (int i = 1; i < argc; i++) {
+        string arg = argv[i];
+        if (arg == "--quick") scale = 10;
+        else if (arg == "--save" && i + 1 < argc) save_path = argv[++i];
+        else if (arg == "--baseline" && i + 1 < argc) baseline_path = argv[++i];
+        else if (arg == "--tolerance" && i + 1 < argc) tolerance = atof(argv[++i]);
+        else {
+            cerr << "Usage: " << argv[0] << " [--quick] [--save FILE] [--baseline FILE] [--tolerance 0.2]" << endl;
+            return 2;
+        }
+    }
+
+    NitrokeyManager::instance()->set_debug(false);
+    auto results = run_benchmarks(scale);
+    auto baseline = baseline_path.empty() ? map<string, Result>() : load_results(baseline_path);
+    bool regression = false;
+
+    cout << left << setw(28) << "benchmark" << right << setw(10) << "mean_us" << setw(10) << "p50_us"
+         << setw(10) << "p90_us" << setw(10) << "p99_us" << setw(10) << "max_us" << setw(8) << "allocs";
+    if (!baseline.empty()) cout << setw(10) << "p50_diff";
+    cout << endl << fixed << setprecision(2);
+    for (auto &r : results) {
+        cout << left << setw(28) << r.name << right << setw(10) << r.mean_us << setw(10) << r.p50_us << setw(10)
+             << r.p90_us << setw(10) << r.p99_us << setw(10) << r.max_us << setw(8) << r.allocations;
+        auto base = baseline.find(r.name);
+        if (base != baseline.end() && base->second.p50_us > 0) {
+            const double change = r.p50_us / base->second.p50_us - 1;
+            cout << setw(9) << showpos << change * 100 << noshowpos << '%';
+            if (change > tolerance) {
+                cout << "  slower";
+                regression = true;
+            }
+            if (r.allocations > base->second.allocations) cout << "  more allocations";
+        }
+        cout << endl;
+    }
+    if (!save_path.empty()) save_results(results, save_path);
+    return regression ? 1 : 0;
+}
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""
+Benchmarks of C API calls through cffi, against the simulated device, so no hardware is needed.
+Uses the nitrokey package from ../python (see README, `make python`).
+
+    python benchmark_bindings.py [--quick] [--save FILE] [--baseline FILE] [--tolerance 0.2]
+
+Prints latency percentiles per operation, in the format of the C++ benchmark (benchmark.cc), which also
+counts the library's allocations. With --baseline, the median of each benchmark is compared to the saved one
+and the exit code is 1 if any is slower by more than the tolerance.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+from nitrokey import Nitrokey, ffi  # noqa: E402
+
+RFC_SECRET = '3132333435363738393031323334353637383930'
+ADMIN_TEMP = '123123123'
+FIELDS = ['iterations', 'mean_us', 'p50_us', 'p90_us', 'p99_us', 'max_us', 'allocations']
+
+
+def measure(iterations, operation):
+    times = []
+    operation()  # warm-up
+    for _ in range(iterations):
+        start = timeit.default_timer()
+        operation()
+        times.append((timeit.default_timer() - start) * 1e6)
+    times.sort()
+
+    def percentile(p):
+        return times[min(len(times) - 1, int(p * len(times)))]
+
+    # allocations are counted by benchmark.cc only
+    return [iterations, sum(times) / iterations, percentile(0.5), percentile(0.9), percentile(0.99), times[-1], 0]
+
+
+def run_benchmarks(scale):
+    nk = Nitrokey()
+    lib = nk.lib
+    assert nk.login('sim')
+    nk.set_debug(False)
+    lib.NK_set_simulation(0, 0)
+    nk.first_authenticate('12345678', ADMIN_TEMP)
+    for slot in range(15):
+        nk.write_totp_slot(slot, 'benchmark', RFC_SECRET, admin_temporary_password=ADMIN_TEMP)
+
+    def slot_name_loop():
+        for slot in range(15):
+            name = lib.NK_get_totp_slot_name(slot)
+            ffi.string(name)
+            lib.NK_free(name)
+
+    names = ffi.new('char[]', 18 * 16)
+    iterations = 2000 // scale
+    # the first call does not use the device, it shows the cost of a cffi call alone
+    results = [
+        ('cffi_NK_get_last_command_status', measure(iterations * 10, lib.NK_get_last_command_status)),
+        ('cffi_NK_get_totp_code', measure(iterations, lambda: lib.NK_get_totp_code(1, 0, 0, 30))),
+        ('cffi_NK_get_totp_slot_name_loop', measure(iterations // 15, slot_name_loop)),
+        ('cffi_NK_get_all_slot_names',
+         measure(iterations // 15, lambda: lib.NK_get_all_slot_names(names, len(names), ffi.NULL))),
+        ('Nitrokey.get_totp_code', measure(iterations, lambda: nk.get_totp_code(1))),
+    ]
+    nk.logout()
+    return results
+
+
+def load_results(path):
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip() or line.startswith('#'):
+                continue
+            fields = line.split('\t')
+            results[fields[0]] = dict(zip(FIELDS, [float(v) for v in fields[1:]]))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--quick', action='store_true')
+    parser.add_argument('--save')
+    parser.add_argument('--baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run_benchmarks(10 if args.quick else 1)
+    baseline = load_results(args.baseline) if args.baseline else {}
+    regression = False
+
+    print('{:<34}{:>10}{:>10}{:>10}{:>10}{:>10}'.format('benchmark', *FIELDS[1:6]) +
+          ('{:>10}'.format('p50_diff') if baseline else ''))
+    for name, values in results:
+        line = '{:<34}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}'.format(name, *values[1:6])
+        base = baseline.get(name)
+        if base and base['p50_us'] > 0:
+            change = values[2] / base['p50_us'] - 1
+            line += '{:>+9.2f}%'.format(change * 100)
+            if change > args.tolerance:
+                line += '  slower'
+                regression = True
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            f.write('# name\t' + '\t'.join(FIELDS) + '\n')
+            for name, values in results:
+                f.write('\t'.join([name] + [str(v) for v in values]) + '\n')
+    return 1 if regression else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,133 @@
+#define CATCH_CONFIG_MAIN  // This tells Catch to provide a main()
+#include "catch.hpp"
+#include <chrono>
+#include <cstring>
+#include <iostream>
+#include "OTPVerifier.h"
+#include "hash.h"
+#include "LibraryException.h"
+
+using namespace std;
+using namespace nitrokey;
+
+template <typename Hash>
+string hex_digest(const char *message) {
+    uint8_t digest[Hash::digest_size];
+    Hash h;
+    h.update((const uint8_t *) message, strlen(message));
+    h.finish(digest);
+    char out[2 * Hash::digest_size + 1];
+    for (size_t i = 0; i < Hash::digest_size; i++) snprintf(out + 2 * i, 3, "%02x", digest[i]);
+    return out;
+}
+
+TEST_CASE("SHA test vectors", "[hash]") {
+    REQUIRE(hex_digest<nitrokey::hash::SHA1>("abc") == "a9993e364706816aba3e25717850c26c9cd0d89d");
+    REQUIRE(hex_digest<nitrokey::hash::SHA1>("") == "da39a3ee5e6b4b0d3255bfef95601890afd80709");
+    REQUIRE(hex_digest<nitrokey::hash::SHA256>("abc") ==
+            "ba7816bf8f01cfea414140de5dae2223b00361a396177a9cb410ff61f20015ad");
+    REQUIRE(hex_digest<nitrokey::hash::SHA256>("abcdbcdecdefdefgefghfghighijhijkijkljklmklmnlmnomnopnopq") ==
+            "248d6a61d20638b8e5c026930c3e6039a33ce45964ff2167f6ecedd419db06c1");
+    REQUIRE(hex_digest<nitrokey::hash::SHA512>("abc") ==
+            "ddaf35a193617abacc417349ae20413112e6fa4e89a97ea20a9eeee64b55d39a"
+            "2192992a274fc1a836ba3c23a3feebbd454d4423643ce80e2a9ac94fa54ca49f");
+}
+
+TEST_CASE("HOTP RFC 4226 test vectors", "[OTP]") {
+    OTPVerifier verifier;
+    auto id = verifier.add_secret("3132333435363738393031323334353637383930", OTPAlgorithm::SHA1, false);
+    const uint32_t codes[] = {755224, 287082, 359152, 969429, 338314, 254676, 287922, 162583, 399871, 520489};
+    for (uint64_t counter = 0; counter < 10; counter++) {
+        CAPTURE(counter);
+        REQUIRE(verifier.get_HOTP_code(id, counter) == codes[counter]);
+        REQUIRE(verifier.verify_HOTP(id, codes[counter], counter, 0) == (int64_t) counter);
+    }
+    REQUIRE(verifier.verify_HOTP(id, codes[7], 2, 10) == 7);
+    REQUIRE(verifier.verify_HOTP(id, codes[7], 2, 4) == OTPVerifier::no_match);
+    REQUIRE(verifier.verify_HOTP(id, codes[1], 2, 10) == OTPVerifier::no_match);
+}
+
+TEST_CASE("TOTP RFC 6238 test vectors", "[OTP]") {
+    OTPVerifier verifier;
+    auto sha1 = verifier.add_secret("3132333435363738393031323334353637383930", OTPAlgorithm::SHA1, true);
+    auto sha256 = verifier.add_secret("3132333435363738393031323334353637383930313233343536373839303132",
+                                      OTPAlgorithm::SHA256, true);
+    auto sha512 = verifier.add_secret("3132333435363738393031323334353637383930313233343536373839303132"
+                                      "3334353637383930313233343536373839303132333435363738393031323334",
+                                      OTPAlgorithm::SHA512, true);
+    struct {
+        uint64_t time;
+        uint32_t sha1, sha256, sha512;
+    } vectors[] = {
+        {59, 94287082, 46119246, 90693936},
+        {1111111109, 7081804, 68084774, 25091201},
+        {1111111111, 14050471, 67062674, 99943326},
+        {1234567890, 89005924, 91819424, 93441116},
+        {2000000000, 69279037, 90698825, 38618901},
+        {20000000000, 65353130, 77737706, 47863826},
+    };
+    for (auto &v : vectors) {
+        CAPTURE(v.time);
+        const int64_t step = v.time / 30;
+        REQUIRE(verifier.get_TOTP_code(sha1, v.time) == v.sha1);
+        REQUIRE(verifier.get_TOTP_code(sha256, v.time) == v.sha256);
+        REQUIRE(verifier.get_TOTP_code(sha512, v.time) == v.sha512);
+        REQUIRE(verifier.verify_TOTP(sha1, v.sha1, v.time, 30, 1) == step);
+        //accepted one step late, rejected two steps late with window of 1
+        REQUIRE(verifier.verify_TOTP(sha256, v.sha256, v.time + 30, 30, 1) == step);
+        REQUIRE(verifier.verify_TOTP(sha512, v.sha512, v.time + 60, 30, 1) == OTPVerifier::no_match);
+    }
+}
+
+TEST_CASE("Batch TOTP verification", "[OTP]") {
+    OTPVerifier verifier;
+    vector<int> ids;
+    for (int i = 0; i < 100; i++) {
+        char secret[41];
+        snprintf(secret, sizeof secret, "%040x", i + 1);
+        ids.push_back(verifier.add_secret(secret, OTPAlgorithm::SHA1, false));
+    }
+    const uint64_t time = 1234567890;
+    vector<OTPVerifier::TOTPRequest> requests;
+    for (size_t i = 0; i < ids.size(); i++) {
+        auto code = verifier.get_TOTP_code(ids[i], time);
+        //every other code is wrong
+        requests.push_back({ids[i], i % 2 ? (code + 1) % 1000000 : code});
+    }
+    requests.push_back({-1, 0});
+    auto matched = verifier.verify_TOTP(requests, time, 30, 1);
+    REQUIRE(matched.size() == requests.size());
+    for (size_t i = 0; i < ids.size(); i++) {
+        CAPTURE(i);
+        REQUIRE(matched[i] == (i % 2 ? OTPVerifier::no_match : (int64_t) (time / 30)));
+    }
+    REQUIRE(matched.back() == OTPVerifier::no_match);
+}
+
+TEST_CASE("Unknown and removed secrets", "[OTP]") {
+    OTPVerifier verifier;
+    auto id = verifier.add_secret("3132333435363738393031323334353637383930", OTPAlgorithm::SHA1, false);
+    REQUIRE(verifier.remove_secret(id));
+    REQUIRE_FALSE(verifier.remove_secret(id));
+    REQUIRE_THROWS_AS(verifier.verify_HOTP(id, 755224, 0, 0), UnknownOTPSecretException);
+    REQUIRE_THROWS_AS(verifier.add_secret("31323", OTPAlgorithm::SHA1, false), InvalidHexString);
+    REQUIRE_THROWS_AS(verifier.add_secret("3132", (OTPAlgorithm) 7, false), InvalidOTPAlgorithmException);
+}
+
+//hidden by default, run with: ./test_OTPVerifier [.benchmark]
+TEST_CASE("TOTP batch verification benchmark", "[.benchmark]") {
+    OTPVerifier verifier;
+    vector<OTPVerifier::TOTPRequest> requests;
+    for (int i = 0; i < 10000; i++) {
+        char secret[41];
+        snprintf(secret, sizeof secret, "%040x", i + 1);
+        requests.push_back({verifier.add_secret(secret, OTPAlgorithm::SHA1, false), 0});
+    }
+    uint64_t time = 1234567890;
+    for (int round = 0; round < 3; round++, time += 30) {
+        auto start = chrono::steady_clock::now();
+        verifier.verify_TOTP(requests, time, 30, 1);
+        auto elapsed = chrono::duration<double, milli>(chrono::steady_clock::now() - start).count();
+        cout << "verified " << requests.size() << " codes in " << elapsed << " ms" << endl;
+    }
+}
@@ -0,0 +1,102 @@
+#define CATCH_CONFIG_MAIN  // This tells Catch to provide a main()
+#include "catch.hpp"
+#include <atomic>
+#include <sstream>
+#include <thread>
+#include <vector>
+#include "async_log.h"
+
+using namespace std;
+using namespace nitrokey::log;
+
+class CollectingSink : public LogSink {
+public:
+    vector<LogRecord> records;
+    int flushes = 0;
+    virtual void write(const LogRecord &record) override { records.push_back(record); }
+    virtual void flush() override { flushes++; }
+};
+
+TEST_CASE("Record queue keeps order and refuses records when full", "[log]") {
+    LogRecordQueue queue(3); // rounded up to 4
+    for (int i = 0; i < 4; i++) {
+        LogRecord record{chrono::system_clock::now(), Loglevel::INFO, to_string(i)};
+        REQUIRE(queue.push(record));
+    }
+    LogRecord extra{chrono::system_clock::now(), Loglevel::INFO, "extra"};
+    REQUIRE_FALSE(queue.push(extra));
+    REQUIRE(extra.message == "extra");
+
+    LogRecord record;
+    for (int i = 0; i < 4; i++) {
+        REQUIRE(queue.pop(record));
+        REQUIRE(record.message == to_string(i));
+    }
+    REQUIRE_FALSE(queue.pop(record));
+}
+
+TEST_CASE("Messages from many threads are written by the writer thread", "[log]") {
+    auto sink = new CollectingSink;
+    {
+        AsyncLogHandler handler(unique_ptr<LogSink>(sink), 1 << 14);
+        vector<thread> threads;
+        for (int t = 0; t < 4; t++) {
+            threads.emplace_back([&handler, t]() {
+                for (int i = 0; i < 1000; i++) handler.print(to_string(t), Loglevel::DEBUG);
+            });
+        }
+        for (auto &t : threads) t.join();
+        handler.flush();
+        REQUIRE(handler.dropped() == 0);
+        REQUIRE(sink->records.size() == 4000);
+        REQUIRE(sink->flushes < 4000);
+    }
+}
+
+TEST_CASE("Dropped messages are reported", "[log]") {
+    auto sink = new CollectingSink;
+    AsyncLogHandler handler(unique_ptr<LogSink>(sink), 2);
+    for (int i = 0; i < 1000; i++) handler.print("message", Loglevel::DEBUG);
+    handler.flush();
+    size_t messages = 0, warnings = 0;
+    for (auto &record : sink->records) {
+        if (record.message == "message") messages++;
+        else if (record.message.find(" log messages dropped") != string::npos) warnings++;
+    }
+    REQUIRE(messages + handler.dropped() == 1000);
+    REQUIRE(handler.dropped() > 0);
+    REQUIRE(warnings > 0);
+}
+
+TEST_CASE("Handler restores standard log on destruction", "[log]") {
+    ostringstream out;
+    {
+        AsyncLogHandler handler(unique_ptr<LogSink>(new StreamLogSink(out)));
+        Log::instance().set_handler(&handler);
+        Log::instance().set_loglevel(Loglevel::DEBUG);
+        Log::instance()("buffered", Loglevel::INFO);
+    }
+    REQUIRE(Log::instance().handler() == &stdlog_handler);
+    REQUIRE(out.str().find("[INFO] [") == 0);
+    REQUIRE(out.str().find("]\tbuffered\n") != string::npos);
+}
+
+TEST_CASE("Handlers replaced while other threads log", "[log]") {
+    Log::instance().set_loglevel(Loglevel::DEBUG);
+    atomic<bool> stop(false);
+    vector<thread> threads;
+    for (int t = 0; t < 4; t++) {
+        threads.emplace_back([&stop]() {
+            while (!stop) Log::instance()("message", Loglevel::DEBUG);
+        });
+    }
+    for (int i = 0; i < 100; i++) {
+        // destroyed right after being replaced, while the threads keep logging
+        AsyncLogHandler handler(unique_ptr<LogSink>(new CollectingSink));
+        Log::instance().set_handler(&handler);
+    }
+    stop = true;
+    for (auto &t : threads) t.join();
+    REQUIRE(Log::instance().handler() == &stdlog_handler);
+    Log::instance().set_loglevel(Loglevel::WARNING);
+}
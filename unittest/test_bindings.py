@@ -1,3 +1,5 @@
+import os
+import time
 import pytest
 import cffi
 from enum import Enum
@@ -36,6 +38,10 @@ class LibraryErrors(Enum):
     INVALID_SLOT = 201
     INVALID_HEX_STRING = 202
     TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE = 203
+    INVALID_OTP_ALGORITHM = 204
+    UNKNOWN_OTP_SECRET = 205
+    DEVICE_NOT_CONNECTED = 206
+    DEVICE_COMMUNICATION_ERROR = 207
 
 
 @pytest.fixture(scope="module")
@@ -57,7 +63,9 @@ def C(request):
 
     C = ffi.dlopen("../build/libnitrokey.so")
     C.NK_set_debug(False)
-    nk_login = C.NK_login_auto()
+    # e.g. NK_DEVICE_MODEL=sim to run without hardware
+    device_model = os.environ.get('NK_DEVICE_MODEL')
+    nk_login = C.NK_login(device_model) if device_model else C.NK_login_auto()
     if nk_login != 1:
         print('No devices detected!')
     assert nk_login == 1  # returns 0 if not connected or wrong model or 1 when connected
@@ -134,6 +142,34 @@ def test_password_safe_slot_status(C):
     assert is_slot_programmed[1] == 1
 
 
+def test_password_safe_slots_bulk(C):
+    assert C.NK_enable_password_safe(DefaultPasswords.USER) == DeviceErrorCode.STATUS_OK
+    for slot in range(16):
+        assert C.NK_erase_password_safe_slot(slot) == DeviceErrorCode.STATUS_OK
+    slot_size = 12 + 33 + 21
+    buffer = ffi.new('char[]', 16 * slot_size)
+    status = ffi.new('uint8_t[]', 16)
+    for slot, name in [(1, 'slotname2'), (7, 'slotname8')]:
+        ffi.memmove(buffer + slot * slot_size, name, len(name))
+        ffi.memmove(buffer + slot * slot_size + 12, 'login', len('login'))
+        ffi.memmove(buffer + slot * slot_size + 12 + 33, 'pass', len('pass'))
+        status[slot] = 1
+    assert C.NK_write_password_safe_slots(buffer, len(buffer), ffi.NULL) == \
+        LibraryErrors.TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE
+    assert C.NK_write_password_safe_slots(buffer, len(buffer), status) == DeviceErrorCode.STATUS_OK
+
+    read = ffi.new('char[]', 16 * slot_size)
+    read_status = ffi.new('uint8_t[]', 16)
+    assert C.NK_get_password_safe_slots(read, len(read), read_status) == DeviceErrorCode.STATUS_OK
+    assert list(read_status) == list(status)
+    assert ffi.buffer(read)[:] == ffi.buffer(buffer)[:]
+    assert C.NK_get_password_safe_slots(read, len(read) - 1, ffi.NULL) == \
+        LibraryErrors.TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE
+    assert C.NK_lock_device() == DeviceErrorCode.STATUS_OK
+    assert C.NK_get_password_safe_slots(read, len(read), ffi.NULL) == DeviceErrorCode.STATUS_NOT_AUTHORIZED
+    assert ffi.buffer(read)[:] == b'\0' * len(read)
+
+
 @pytest.mark.xfail(run=False, reason="issue to register: device locks up "
                                      "after below commands sequence (reinsertion fixes), skipping for now")
 def test_issue_device_locks_on_second_key_generation_in_sequence(C):
@@ -391,6 +427,55 @@ def test_get_slot_names(C):
             assert C.NK_get_last_command_status() == DeviceErrorCode.NOT_PROGRAMMED
 
 
+def test_get_all_slot_names(C):
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_hotp_slot(1, 'python_test', RFC_SECRET, 0, False, False, False, "",
+                                DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    names = ffi.new('char[]', 18 * 16)
+    statuses = ffi.new('uint8_t[]', 18)
+    assert C.NK_get_all_slot_names(names, 18 * 16, statuses) == DeviceErrorCode.STATUS_OK
+    assert gs(names + 1 * 16) == 'python_test'
+    assert statuses[1] == DeviceErrorCode.STATUS_OK
+    for i in range(18):
+        if gs(names + i * 16) == '':
+            assert statuses[i] == DeviceErrorCode.NOT_PROGRAMMED
+    assert C.NK_get_all_slot_names(names, 16, statuses) == LibraryErrors.TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE
+
+
+def test_get_totp_codes(C):
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_config(255, 255, 255, False, True, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    slots = ffi.new('uint8_t[]', list(range(15)))
+    codes = ffi.new('uint32_t[]', 15)
+    statuses = ffi.new('uint8_t[]', 15)
+    assert C.NK_get_totp_codes(slots, 15, 0, 0, 0, '', codes, statuses) == DeviceErrorCode.STATUS_OK
+    for i in range(15):
+        if codes[i] == 0:
+            assert statuses[i] == DeviceErrorCode.NOT_PROGRAMMED
+
+
+def test_slot_name_cache(C):
+    hits = ffi.new('uint64_t *')
+    misses = ffi.new('uint64_t *')
+    C.NK_set_cache(True)
+    C.NK_reset_cache_statistics()
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_hotp_slot(1, 'python_test', RFC_SECRET, 0, False, False, False, "",
+                                DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert gs(C.NK_get_hotp_slot_name(1)) == 'python_test'
+    assert gs(C.NK_get_hotp_slot_name(1)) == 'python_test'
+    C.NK_get_cache_statistics(hits, misses)
+    assert (hits[0], misses[0]) == (1, 1)
+    # writing the slot invalidates cached name
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_hotp_slot(1, 'python_test2', RFC_SECRET, 0, False, False, False, "",
+                                DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert gs(C.NK_get_hotp_slot_name(1)) == 'python_test2'
+    C.NK_get_cache_statistics(hits, misses)
+    assert (hits[0], misses[0]) == (1, 2)
+    C.NK_set_cache(False)
+
+
 def test_get_OTP_codes(C):
     assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
     assert C.NK_write_config(255, 255, 255, False, True, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
@@ -532,3 +617,161 @@ def test_warning_binary_bigger_than_secret_buffer(C):
     invalid_hex_string = to_hex('1234567890') * 3
     assert C.NK_write_hotp_slot(1, 'slot_name', invalid_hex_string, 0, True, False, False, '',
                                 DefaultPasswords.ADMIN_TEMP) == LibraryErrors.TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE
+
+
+def test_otp_verifier_accepts_device_codes(C):
+    secret_id = C.NK_otp_add_secret(RFC_SECRET, 0, True)
+    assert secret_id > 0
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_config(255, 255, 255, False, True, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_totp_slot(1, 'python_test', RFC_SECRET, 30, True, False, False, "",
+                                DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    matched_step = ffi.new('uint64_t *')
+    for t in [59, 1111111109, 1234567890]:
+        assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+        assert C.NK_totp_set_time(t) == DeviceErrorCode.STATUS_OK
+        code = C.NK_get_totp_code(1, 0, 0, 30)
+        assert C.NK_otp_verify_totp(secret_id, code, t, 30, 1, matched_step) == 1
+        assert matched_step[0] == t // 30
+        assert C.NK_otp_verify_totp(secret_id, code, t + 90, 30, 1, matched_step) == 0
+    assert C.NK_otp_remove_secret(secret_id) == 1
+    assert C.NK_otp_verify_totp(secret_id, 0, 59, 30, 1, ffi.NULL) == 0
+    assert C.NK_get_last_command_status() == LibraryErrors.UNKNOWN_OTP_SECRET
+
+
+def test_get_current_totp_code(C):
+    secret_id = C.NK_otp_add_secret(RFC_SECRET, 0, True)
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_config(255, 255, 255, False, True, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_first_authenticate(DefaultPasswords.ADMIN, DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_totp_slot(1, 'python_test', RFC_SECRET, 30, True, False, False, "",
+                                DefaultPasswords.ADMIN_TEMP) == DeviceErrorCode.STATUS_OK
+    hits, device_reads = ffi.new('uint64_t *'), ffi.new('uint64_t *')
+    C.NK_get_current_totp_code_statistics(hits, device_reads)
+    start_hits, start_reads = hits[0], device_reads[0]
+    for _ in range(3):
+        code = C.NK_get_current_totp_code(1, 30, '')
+        assert C.NK_get_last_command_status() == DeviceErrorCode.STATUS_OK
+        # no NK_totp_set_time needed
+        assert C.NK_otp_verify_totp(secret_id, code, int(time.time()), 30, 1, ffi.NULL) == 1
+    C.NK_get_current_totp_code_statistics(hits, device_reads)
+    assert hits[0] - start_hits + device_reads[0] - start_reads == 3
+    # read again only if a time step ended meanwhile
+    assert device_reads[0] - start_reads <= 2
+    assert C.NK_otp_remove_secret(secret_id) == 1
+
+
+def test_results_into_buffers(C):
+    buffer = ffi.new('char[]', 64)
+    assert C.NK_device_serial_number_into(buffer, 64) == DeviceErrorCode.STATUS_OK
+    assert gs(buffer) == gs(C.NK_device_serial_number())
+    assert C.NK_device_serial_number_into(buffer, 1) == LibraryErrors.TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE
+    config = ffi.new('uint8_t[]', 5)
+    assert C.NK_read_config_into(config, 5) == DeviceErrorCode.STATUS_OK
+    assert C.NK_enable_password_safe(DefaultPasswords.USER) == DeviceErrorCode.STATUS_OK
+    assert C.NK_write_password_safe_slot(0, 'slotname1', 'login1', 'pass1') == DeviceErrorCode.STATUS_OK
+    status = ffi.new('uint8_t[]', 16)
+    assert C.NK_get_password_safe_slot_status_into(status, 16) == DeviceErrorCode.STATUS_OK
+    assert status[0] == 1
+    assert C.NK_get_password_safe_slot_password_into(0, buffer, 64) == DeviceErrorCode.STATUS_OK
+    assert gs(buffer) == 'pass1'
+    assert C.NK_get_password_safe_slot_login_into(0, buffer, 64) == DeviceErrorCode.STATUS_OK
+    assert gs(buffer) == 'login1'
+    name = C.NK_get_password_safe_slot_name(0)
+    assert gs(name) == 'slotname1'
+    C.NK_free(name)
+
+
+def test_login_after_logout_and_closing_devices(C):
+    device_model = os.environ.get('NK_DEVICE_MODEL')
+    login = lambda: C.NK_login(device_model) if device_model else C.NK_login_auto()
+    serial = gs(C.NK_device_serial_number())
+    assert C.NK_logout() == DeviceErrorCode.STATUS_OK
+    assert login() == 1
+    assert gs(C.NK_device_serial_number()) == serial
+    assert C.NK_close_devices() == DeviceErrorCode.STATUS_OK
+    assert login() == 1
+    assert gs(C.NK_device_serial_number()) == serial
+
+
+def add_profile_items(C):
+    assert C.NK_profile_add_hotp_slot(1, 'python_test', RFC_SECRET, 0, False, False, False, '', True) \
+        == DeviceErrorCode.STATUS_OK
+    assert C.NK_profile_add_password_safe_slot(0, 'slotname1', 'login1', 'pass1') == DeviceErrorCode.STATUS_OK
+
+
+def test_profile_apply(C):
+    C.NK_profile_clear()
+    assert C.NK_profile_add_hotp_slot(3, 'python_test', RFC_SECRET, 0, False, False, False, '', True) \
+        == LibraryErrors.INVALID_SLOT
+    add_profile_items(C)
+    statuses = ffi.new('uint8_t[]', 2)
+    written = ffi.new('uint8_t[]', 2)
+    assert C.NK_profile_apply(DefaultPasswords.ADMIN, DefaultPasswords.USER, DefaultPasswords.ADMIN_TEMP,
+                              statuses, written, 1) == LibraryErrors.TARGET_BUFFER_SIZE_SMALLER_THAN_SOURCE
+    assert C.NK_profile_apply(DefaultPasswords.ADMIN, DefaultPasswords.USER, DefaultPasswords.ADMIN_TEMP,
+                              statuses, written, 2) == DeviceErrorCode.STATUS_OK
+    assert gs(C.NK_get_hotp_slot_name(1)) == 'python_test'
+    # applied profiles are cleared
+    assert C.NK_profile_apply(DefaultPasswords.ADMIN, DefaultPasswords.USER, DefaultPasswords.ADMIN_TEMP,
+                              statuses, written, 0) == DeviceErrorCode.STATUS_OK
+    # already applied
+    add_profile_items(C)
+    assert C.NK_profile_apply(DefaultPasswords.ADMIN, DefaultPasswords.USER, DefaultPasswords.ADMIN_TEMP,
+                              statuses, written, 2) == DeviceErrorCode.STATUS_OK
+    assert list(written) == [0, 0]
+    C.NK_profile_clear()
+
+
+def test_get_metrics(C):
+    C.NK_reset_metrics()
+    assert gs(C.NK_status()) != ''
+    lines = gs(C.NK_get_metrics()).splitlines()
+    assert len(lines) == 1
+    fields = lines[0].split('\t')
+    assert fields[0] == 'GET_STATUS'
+    assert fields[1] == '1'
+    assert sum(int(c) for c in fields[-1].split(',')) == 1
+    C.NK_reset_metrics()
+    assert gs(C.NK_get_metrics()) == ''
+
+
+def test_set_timing(C):
+    get_status = 0x00
+    timing = [ffi.new('uint32_t *') for _ in range(4)]
+    assert C.NK_get_timing(*timing) == DeviceErrorCode.STATUS_OK
+    defaults = [t[0] for t in timing]
+    try:
+        # no polls allowed, the command cannot get its response
+        assert C.NK_set_command_timing(get_status, 100, 0, 100, 10000) == DeviceErrorCode.STATUS_OK
+        assert gs(C.NK_status()) == ''
+        assert C.NK_get_last_command_status() == LibraryErrors.DEVICE_COMMUNICATION_ERROR
+        # other commands keep the device's timing
+        assert C.NK_get_user_retry_count() > 0
+        assert C.NK_clear_command_timing() == DeviceErrorCode.STATUS_OK
+        assert gs(C.NK_status()) != ''
+
+        assert C.NK_set_timing(100, 0, 100, 10000) == DeviceErrorCode.STATUS_OK
+        assert C.NK_get_timing(*timing) == DeviceErrorCode.STATUS_OK
+        assert [t[0] for t in timing] == [100, 0, 100, 10000]
+        assert gs(C.NK_status()) == ''
+        assert C.NK_get_last_command_status() == LibraryErrors.DEVICE_COMMUNICATION_ERROR
+    finally:
+        C.NK_clear_command_timing()
+        assert C.NK_set_timing(*defaults) == DeviceErrorCode.STATUS_OK
+    assert gs(C.NK_status()) != ''
+
+
+def test_async_log(C, tmpdir):
+    import json
+    log_path = str(tmpdir.join('log.jsonl'))
+    assert C.NK_set_async_log(log_path) == 1
+    C.NK_set_debug(True)
+    assert gs(C.NK_status()) != ''
+    C.NK_set_sync_log()
+    with open(log_path) as f:
+        records = [json.loads(line) for line in f]
+    assert len(records) > 0
+    assert set(records[0].keys()) == {'time', 'level', 'message'}
+    assert C.NK_set_async_log('/nonexistent/log.jsonl') == 0
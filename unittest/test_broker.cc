@@ -0,0 +1,114 @@
+#define CATCH_CONFIG_MAIN  // This tells Catch to provide a main()
+#include "catch.hpp"
+#include <thread>
+#include <vector>
+#include <unistd.h>
+#include <sys/stat.h>
+#include "Broker.h"
+#include "../NK_C_API.h"
+
+using namespace std;
+using namespace nitrokey::broker;
+
+class Client {
+public:
+    int fd;
+    explicit Client(const string &path) : fd(connect_socket(path)) { REQUIRE(fd >= 0); }
+    ~Client() { close(fd); }
+
+    Message call(Message request) {
+        REQUIRE(write_message(fd, request));
+        Message response;
+        REQUIRE(read_message(fd, response));
+        return response;
+    }
+
+    Message call(BrokerOp op) {
+        Message request;
+        request.put_u8((uint8_t) op);
+        return call(request);
+    }
+
+    uint32_t login(const char *model) {
+        Message request;
+        request.put_u8((uint8_t) BrokerOp::LOGIN);
+        request.put_string(model);
+        auto response = call(request);
+        REQUIRE(response.get_u8() == 0);
+        return response.get_u32();
+    }
+};
+
+string socket_path() {
+    return "/tmp/nitrokey-broker-test-" + to_string(getpid()) + ".sock";
+}
+
+TEST_CASE("Identical reads waiting at the same time are executed once", "[broker]") {
+    NK_set_debug(false);
+    Broker broker(socket_path());
+    thread server(&Broker::run, &broker);
+    {
+        Client first(socket_path());
+        REQUIRE(first.login("sim") == 1);
+        NK_set_simulation(50, 0);
+
+        vector<string> results(8);
+        vector<thread> threads;
+        for (size_t i = 0; i < results.size(); i++) {
+            threads.emplace_back([&, i]() {
+                Client client(socket_path());
+                client.login("sim");
+                auto response = client.call(BrokerOp::SERIAL_NUMBER);
+                REQUIRE(response.get_u8() == 0);
+                results[i] = response.get_string();
+            });
+        }
+        for (auto &t : threads) t.join();
+
+        for (auto &serial : results) REQUIRE(serial == results[0]);
+        auto stats = broker.get_stats();
+        REQUIRE(stats.requests == 1 + 8 * 2);
+        REQUIRE(stats.coalesced > 0);
+        REQUIRE(stats.executed + stats.coalesced == stats.requests);
+        NK_set_simulation(0, 0);
+    }
+    broker.stop();
+    server.join();
+}
+
+TEST_CASE("Requests fail with not connected status without a device", "[broker]") {
+    Broker broker(socket_path());
+    thread server(&Broker::run, &broker);
+    {
+        Client client(socket_path());
+        REQUIRE(client.login("unknown") == 0);
+        auto response = client.call(BrokerOp::GET_USER_RETRY_COUNT);
+        REQUIRE(response.get_u8() == status_not_connected);
+
+        // slot number missing
+        response = client.call(BrokerOp::GET_TOTP_SLOT_NAME);
+        REQUIRE(response.get_u8() == status_not_connected);
+    }
+    broker.stop();
+    server.join();
+}
+
+TEST_CASE("Second broker refuses the socket in use", "[broker]") {
+    Broker broker(socket_path());
+    REQUIRE_THROWS(Broker{socket_path()});
+}
+
+TEST_CASE("Socket is accessible to its owner only", "[broker]") {
+    Broker broker(socket_path());
+    struct stat socket_stat;
+    REQUIRE(stat(socket_path().c_str(), &socket_stat) == 0);
+    REQUIRE((socket_stat.st_mode & 0777) == 0600);
+
+    const char *runtime_dir = getenv("XDG_RUNTIME_DIR");
+    const string previous = runtime_dir != nullptr ? runtime_dir : "";
+    setenv("XDG_RUNTIME_DIR", "/run/user/1000", 1);
+    REQUIRE(default_socket_path() == "/run/user/1000/nitrokey-broker.sock");
+    unsetenv("XDG_RUNTIME_DIR");
+    REQUIRE(default_socket_path() == "/run/nitrokey/broker.sock");
+    if (runtime_dir != nullptr) setenv("XDG_RUNTIME_DIR", previous.c_str(), 1);
+}
@@ -0,0 +1,52 @@
+#define CATCH_CONFIG_MAIN  // This tells Catch to provide a main()
+#include "catch.hpp"
+#include <chrono>
+#include <cstdlib>
+#include <iostream>
+#include "device.h"
+#include "misc.h"
+
+using namespace std;
+using namespace nitrokey::misc;
+
+TEST_CASE("Table CRC matches bitwise STM32 CRC", "[CRC]") {
+    uint32_t buffer[64];
+    srand(1234);
+    for (int round = 0; round < 1000; round++) {
+        for (auto &w : buffer) w = (uint32_t) rand() ^ ((uint32_t) rand() << 16);
+        //w/o leading zero and 4-byte crc, as in HIDReport::calculate_CRC
+        const size_t packet_size = HID_REPORT_SIZE - 5;
+        const uint8_t *data = (const uint8_t *) buffer;
+        REQUIRE(stm_crc32(data, packet_size) == stm_crc32_bitwise(data, packet_size));
+        for (size_t words = 0; words <= 64; words++) {
+            REQUIRE(stm_crc32(data, words * 4) == stm_crc32_bitwise(data, words * 4));
+        }
+    }
+}
+
+TEST_CASE("CRC of zeroed packet", "[CRC]") {
+    uint8_t packet[HID_REPORT_SIZE - 5] = {};
+    REQUIRE(stm_crc32(packet, sizeof packet) == stm_crc32_bitwise(packet, sizeof packet));
+    REQUIRE(stm_crc32(packet, 0) == 0xffffffff);
+}
+
+template <typename F>
+double measure_ns_per_call(F f, const uint8_t *data, size_t size, int iterations) {
+    volatile uint32_t sink = 0;
+    auto start = chrono::steady_clock::now();
+    for (int i = 0; i < iterations; i++) sink = sink + f(data, size);
+    auto elapsed = chrono::steady_clock::now() - start;
+    return chrono::duration<double, nano>(elapsed).count() / iterations;
+}
+
+//hidden by default, run with: ./test_crc [.benchmark]
+TEST_CASE("CRC microbenchmark", "[.benchmark]") {
+    uint8_t packet[HID_REPORT_SIZE - 5];
+    for (size_t i = 0; i < sizeof packet; i++) packet[i] = (uint8_t) i;
+    const int iterations = 1000000;
+    auto bitwise = measure_ns_per_call(stm_crc32_bitwise, packet, sizeof packet, iterations);
+    auto table = measure_ns_per_call(stm_crc32, packet, sizeof packet, iterations);
+    cout << "stm_crc32_bitwise:\t" << bitwise << " ns/packet" << endl;
+    cout << "stm_crc32:\t" << table << " ns/packet" << endl;
+    REQUIRE(table < bitwise);
+}
@@ -0,0 +1,70 @@
+#define CATCH_CONFIG_MAIN  // This tells Catch to provide a main()
+#include "catch.hpp"
+#include <string>
+#include <vector>
+#include "DeviceDiscovery.h"
+#include "device_proto.h"
+
+using namespace std;
+using namespace nitrokey;
+
+static hid_device_info make_info(const char *path, unsigned short vid, unsigned short pid,
+                                 const wchar_t *serial, int interface_number, hid_device_info *next) {
+    hid_device_info info = {};
+    info.path = const_cast<char *>(path);
+    info.vendor_id = vid;
+    info.product_id = pid;
+    info.serial_number = const_cast<wchar_t *>(serial);
+    info.interface_number = interface_number;
+    info.next = next;
+    return info;
+}
+
+TEST_CASE("Devices are classified in one enumeration", "[discovery]") {
+    hid_device_info update = make_info("3-1:1.0", STICK20_UPDATE_MODE_VID, STICK20_UPDATE_MODE_PID, nullptr, 0, nullptr);
+    hid_device_info pro = make_info("2-1:1.0", 0x20a0, 0x4108, L"PRO1", 0, &update);
+    hid_device_info keyboard = make_info("1-2:1.0", 0x046d, 0xc31c, L"KB", 0, &pro);
+    hid_device_info storage = make_info("1-1:1.2", 0x20a0, 0x4109, L"STORAGE1", 2, &keyboard);
+
+    auto devices = DeviceDiscovery::from_enumeration(&storage);
+    REQUIRE(devices.size() == 3);
+
+    // Pro first, the others in enumeration order
+    REQUIRE(devices[0].model == DeviceModel::PRO);
+    REQUIRE(devices[0].path == "2-1:1.0");
+    REQUIRE(devices[0].serial == "PRO1");
+    REQUIRE_FALSE(devices[0].update_mode);
+
+    REQUIRE(devices[1].model == DeviceModel::STORAGE);
+    REQUIRE(devices[1].serial == "STORAGE1");
+    REQUIRE(devices[1].interface_number == 2);
+    REQUIRE_FALSE(devices[1].update_mode);
+
+    REQUIRE(devices[2].model == DeviceModel::STORAGE);
+    REQUIRE(devices[2].serial.empty());
+    REQUIRE(devices[2].update_mode);
+
+    REQUIRE(DeviceDiscovery::from_enumeration(&keyboard).size() == 2);
+    REQUIRE(DeviceDiscovery::from_enumeration(nullptr).empty());
+}
+
+TEST_CASE("Device list is cached until invalidated", "[discovery]") {
+    auto &discovery = DeviceDiscovery::instance();
+    // keep the list also where hot-plug events cannot be detected
+    discovery.set_refresh_interval(std::chrono::hours(1));
+    discovery.invalidate();
+    const auto count = discovery.get_enumeration_count();
+
+    auto devices = discovery.get_devices(true);
+    REQUIRE(discovery.get_enumeration_count() == count + 1);
+    for (int i = 0; i < 10; i++) {
+        REQUIRE(discovery.get_devices(true).size() == devices.size());
+    }
+    REQUIRE(discovery.get_devices().size() <= devices.size());
+    REQUIRE(discovery.get_enumeration_count() == count + 1);
+
+    discovery.invalidate();
+    discovery.get_devices();
+    REQUIRE(discovery.get_enumeration_count() == count + 2);
+    discovery.set_refresh_interval(std::chrono::seconds(1));
+}
@@ -0,0 +1,76 @@
+"""
+Tests of the nitrokey Python package (../python, see README, `make python`) against the simulated device,
+so no hardware is needed.
+"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'python'))
+nitrokey = pytest.importorskip('nitrokey')
+from nitrokey import Nitrokey, NitrokeyError, DeviceErrorCode  # noqa: E402
+
+RFC_SECRET = '3132333435363738393031323334353637383930'
+ADMIN = '12345678'
+ADMIN_TEMP = '123123123'
+
+LIBRARY_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'build', 'libnitrokey.so')
+if not os.path.exists(LIBRARY_PATH):
+    LIBRARY_PATH = None
+
+
+@pytest.fixture
+def nk():
+    nk = Nitrokey(LIBRARY_PATH)
+    nk.set_debug(False)
+    assert nk.login('sim')
+    yield nk
+    nk.logout()
+
+
+def test_login(nk):
+    assert nk.status() != ''
+    assert nk.get_admin_retry_count() == 3
+
+
+def test_wrong_pin_raises(nk):
+    with pytest.raises(NitrokeyError) as error:
+        nk.first_authenticate('wrong', ADMIN_TEMP)
+    assert error.value.status == DeviceErrorCode.WRONG_PASSWORD
+    assert nk.get_admin_retry_count() == 2
+
+
+def test_totp_codes_and_slot_names(nk):
+    nk.first_authenticate(ADMIN, ADMIN_TEMP)
+    nk.write_totp_slot(1, 'python_totp', RFC_SECRET, use_8_digits=True, admin_temporary_password=ADMIN_TEMP)
+    nk.set_time(1111111100)
+    codes = nk.get_totp_codes([1, 2])
+    assert codes[0] == (7081804, DeviceErrorCode.STATUS_OK)
+    assert codes[1] == (0, DeviceErrorCode.NOT_PROGRAMMED)
+
+    hotp_names, totp_names = nk.get_all_slot_names()
+    assert hotp_names == ['', '', '']
+    assert totp_names[1] == 'python_totp'
+    assert totp_names[0] == '' and len(totp_names) == 15
+
+
+@pytest.mark.skipif(sys.version_info < (3, 5), reason='asyncio client needs Python 3.5')
+def test_async_timeout():
+    import asyncio
+    from nitrokey.aio import AsyncNitrokey
+
+    loop = asyncio.new_event_loop()
+    try:
+        client = loop.run_until_complete(AsyncNitrokey.connect(model='sim', library_path=LIBRARY_PATH))
+        assert loop.run_until_complete(client.status()) != ''
+        # every response of the simulated device is delayed
+        client._nitrokey.lib.NK_set_simulation(500, 0)
+        with pytest.raises(asyncio.TimeoutError):
+            loop.run_until_complete(client.status(timeout=0.05))
+        client._nitrokey.lib.NK_set_simulation(0, 0)
+        # the timed out command finishes in the background, then the client is usable again
+        assert loop.run_until_complete(client.status(timeout=5)) != ''
+        loop.run_until_complete(client.close())
+    finally:
+        loop.close()
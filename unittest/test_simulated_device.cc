@@ -0,0 +1,472 @@
+#define CATCH_CONFIG_MAIN  // This tells Catch to provide a main()
+#include "catch.hpp"
+#include <chrono>
+#include <cstring>
+#include <iostream>
+#include "NitrokeyManager.h"
+#include "LibraryException.h"
+
+using namespace std;
+using namespace nitrokey;
+
+const char *RFC_SECRET = "3132333435363738393031323334353637383930";
+const char *ADMIN_TEMP = "123123123";
+const char *USER_TEMP = "234234234";
+
+uint8_t command_status(std::function<void()> f) {
+    try {
+        f();
+    }
+    catch (CommandFailedException &e) {
+        return e.last_command_status;
+    }
+    return 0;
+}
+
+TEST_CASE("HOTP and TOTP codes on simulated Pro", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.write_HOTP_slot(0, "hotp", RFC_SECRET, 0, false, false, false, "", ADMIN_TEMP);
+    const uint32_t hotp_codes[] = {755224, 287082, 359152, 969429, 338314};
+    for (auto code : hotp_codes) {
+        REQUIRE(m.get_HOTP_code(0, "") == code);
+    }
+    REQUIRE(string(m.get_hotp_slot_name(0)) == "hotp");
+
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.write_TOTP_slot(1, "totp", RFC_SECRET, 30, true, false, false, "", ADMIN_TEMP);
+    m.set_time(1111111109);
+    REQUIRE(m.get_TOTP_code(1, 0, 0, 30, "") == 7081804);
+
+    REQUIRE(command_status([&](){ m.get_totp_slot_name(2); }) == (uint8_t) CommandStatus::SLOT_NOT_PROGRAMMED);
+}
+
+TEST_CASE("Authorization and PIN retry counters", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+
+    // no temporary password set yet
+    REQUIRE(command_status([&](){
+        m.write_HOTP_slot(0, "hotp", RFC_SECRET, 0, false, false, false, "", ADMIN_TEMP);
+    }) == (uint8_t) CommandStatus::WRONG_PASSWORD);
+
+    REQUIRE(command_status([&](){ m.first_authenticate("wrong", ADMIN_TEMP); })
+            == (uint8_t) CommandStatus::WRONG_PASSWORD);
+    REQUIRE(m.get_admin_retry_count() == 2);
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    REQUIRE(m.get_admin_retry_count() == 3);
+
+    // PIN protected OTP codes need user authorization
+    m.write_config(255, 255, 255, true, false, ADMIN_TEMP);
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.write_HOTP_slot(0, "hotp", RFC_SECRET, 0, false, false, false, "", ADMIN_TEMP);
+    REQUIRE(command_status([&](){ m.get_HOTP_code(0, ""); }) == (uint8_t) CommandStatus::NOT_AUTHORIZED);
+    m.user_authenticate("123456", USER_TEMP);
+    REQUIRE(m.get_HOTP_code(0, USER_TEMP) == 755224);
+
+    char old_pin[] = "123456", new_pin[] = "654321";
+    m.change_user_PIN(old_pin, new_pin);
+    REQUIRE(command_status([&](){ m.user_authenticate("123456", USER_TEMP); })
+            == (uint8_t) CommandStatus::WRONG_PASSWORD);
+    m.user_authenticate("654321", USER_TEMP);
+}
+
+TEST_CASE("Password safe on simulated Storage", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim-storage"));
+    m.set_debug(false);
+
+    REQUIRE(command_status([&](){ m.get_password_safe_slot_status(); })
+            == (uint8_t) CommandStatus::NOT_AUTHORIZED);
+    m.enable_password_safe("123456");
+    m.write_password_safe_slot(3, "name", "login", "password");
+    auto status = m.get_password_safe_slot_status();
+    REQUIRE(status[3] == 1);
+    REQUIRE(status[0] == 0);
+    REQUIRE(string(m.get_password_safe_slot_name(3)) == "name");
+    REQUIRE(string(m.get_password_safe_slot_login(3)) == "login");
+    REQUIRE(string(m.get_password_safe_slot_password(3)) == "password");
+    m.erase_password_safe_slot(3);
+    REQUIRE(command_status([&](){ m.get_password_safe_slot_name(3); })
+            == (uint8_t) CommandStatus::SLOT_NOT_PROGRAMMED);
+
+    // Storage changes PIN with two commands
+    char old_pin[] = "12345678", new_pin[] = "87654321";
+    m.change_admin_PIN(old_pin, new_pin);
+    m.first_authenticate("87654321", ADMIN_TEMP);
+}
+
+TEST_CASE("Reports with wrong CRC are rejected", "[simulator]") {
+    SimulatedDevice device;
+    REQUIRE(device.connect());
+    auto packet = GetStatus::CommandTransaction::OutgoingPacket();
+    packet.initialize();
+    packet.update_CRC();
+    packet.crc ^= 1;
+    REQUIRE(device.send(&packet) == HID_REPORT_SIZE);
+    GetStatus::CommandTransaction::ResponsePacket response;
+    REQUIRE(device.recv(&response) == HID_REPORT_SIZE);
+    REQUIRE(response.last_command_crc == packet.crc);
+    REQUIRE(response.last_command_status == (uint8_t) CommandStatus::WRONG_CRC);
+    REQUIRE(response.isCRCcorrect());
+}
+
+TEST_CASE("Factory reset answers and restores the default PINs", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+    char old_pin[] = "12345678", new_pin[] = "87654321";
+    m.change_admin_PIN(old_pin, new_pin);
+    m.first_authenticate("87654321", ADMIN_TEMP);
+    m.write_HOTP_slot(0, "hotp", RFC_SECRET, 0, false, false, false, "", ADMIN_TEMP);
+
+    m.factory_reset("87654321");
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.user_authenticate("123456", USER_TEMP);
+    REQUIRE(command_status([&](){ m.get_hotp_slot_name(0); }) == (uint8_t) CommandStatus::SLOT_NOT_PROGRAMMED);
+}
+
+TEST_CASE("Latency and busy responses are polled through", "[simulator]") {
+    auto device = make_shared<SimulatedDevice>(DeviceModel::PRO,
+                                               SimulatedDevice::Options{std::chrono::milliseconds(30), 3});
+    REQUIRE(device->connect());
+    auto start = chrono::steady_clock::now();
+    auto response = GetStatus::CommandTransaction::run(*device);
+    auto elapsed = chrono::steady_clock::now() - start;
+    REQUIRE(response.data().firmware_version != 0);
+    REQUIRE(elapsed >= chrono::milliseconds(30));
+    REQUIRE(device->get_polls() > 3);
+    REQUIRE(device->get_received_commands() == 1);
+}
+
+TEST_CASE("Password safe values written into caller's buffers", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+    m.enable_password_safe("123456");
+    m.write_password_safe_slot(0, "name", "login", "12345678901234567890");
+
+    char buffer[PWS_PASSWORD_LENGTH + 1];
+    m.get_password_safe_slot_password(0, buffer, sizeof buffer);
+    REQUIRE(string(buffer) == "12345678901234567890");
+    m.get_password_safe_slot_login(0, buffer, sizeof buffer);
+    REQUIRE(string(buffer) == "login");
+    REQUIRE_THROWS_AS(m.get_password_safe_slot_password(0, buffer, PWS_PASSWORD_LENGTH),
+                      TargetBufferSmallerThanSource);
+}
+
+//hidden by default, run with: ./test_simulated_device [.benchmark]
+TEST_CASE("Simulated command throughput", "[.benchmark]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+    const int commands = 1000;
+    auto start = chrono::steady_clock::now();
+    for (int i = 0; i < commands; i++) {
+        m.get_admin_retry_count();
+    }
+    auto elapsed = chrono::duration<double, milli>(chrono::steady_clock::now() - start).count();
+    cout << commands << " commands in " << elapsed << " ms" << endl;
+}
+
+TEST_CASE("Transaction sequence stops at the first failed step", "[simulator]") {
+    SimulatedDevice device;
+    REQUIRE(device.connect());
+    auto auth = FirstAuthenticate::CommandPayload();
+    strcpy((char *) auth.card_password, "12345678");
+    strcpy((char *) auth.temporary_password, ADMIN_TEMP);
+    FirstAuthenticate::CommandTransaction::run(device, auth);
+
+    auto erase = EraseSlot::CommandPayload();
+    erase.slot_number = 0x10;
+    auto authorize = Authorize::CommandPayload();
+    authorize.crc_to_authorize = EraseSlot::CommandTransaction::getCRC(erase);
+    strcpy((char *) authorize.temporary_password, "wrong");
+
+    TransactionSequence sequence(device);
+    sequence.add<Authorize>(authorize);
+    REQUIRE(command_status([&](){ sequence.run<EraseSlot>(erase); }) == (uint8_t) CommandStatus::WRONG_PASSWORD);
+    REQUIRE(sequence.get_step_statuses() == vector<uint8_t>{(uint8_t) CommandStatus::WRONG_PASSWORD});
+    REQUIRE(device.get_received_commands() == 2);
+
+    strcpy((char *) authorize.temporary_password, ADMIN_TEMP);
+    TransactionSequence authorized(device);
+    authorized.add<Authorize>(authorize);
+    authorized.run<EraseSlot>(erase);
+    REQUIRE(authorized.get_step_statuses() == vector<uint8_t>({0, 0}));
+}
+
+TEST_CASE("Profile is applied and unchanged items are skipped", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+
+    DeviceProfile profile;
+    profile.set_config = true;
+    profile.config = {0, 1, 255, false, false};
+    profile.hotp_slots.push_back({0, "hotp", RFC_SECRET, false, false, false, "", 0, 0, true});
+    profile.totp_slots.push_back({1, "totp", RFC_SECRET, true, false, false, "", 0, 30, false});
+    profile.password_safe_slots.push_back({2, "name", "login", "password"});
+
+    auto results = m.apply_profile(profile, "12345678", "123456", ADMIN_TEMP);
+    REQUIRE(results.size() == 4);
+    for (auto &result : results) {
+        REQUIRE(result.status == 0);
+        REQUIRE(result.written);
+    }
+    REQUIRE(m.read_config() == vector<uint8_t>({0, 1, 255, 0, 0}));
+    REQUIRE(m.get_HOTP_code(0, "") == 755224);
+    REQUIRE(string(m.get_password_safe_slot_login(2)) == "login");
+
+    // TOTP slot is written again, its secret can't be compared
+    profile.password_safe_slots[0].password = "changed";
+    results = m.apply_profile(profile, "12345678", "123456", ADMIN_TEMP);
+    vector<bool> written;
+    for (auto &result : results) {
+        REQUIRE(result.status == 0);
+        written.push_back(result.written);
+    }
+    REQUIRE(written == vector<bool>({false, false, true, true}));
+    REQUIRE(string(m.get_password_safe_slot_password(2)) == "changed");
+
+    // nothing to write for the admin, so the wrong PIN is not even checked
+    profile.totp_slots.clear();
+    results = m.apply_profile(profile, "wrong", "123456", ADMIN_TEMP);
+    REQUIRE(m.get_admin_retry_count() == 3);
+    profile.hotp_slots[0].name = "renamed";
+    results = m.apply_profile(profile, "wrong", "123456", ADMIN_TEMP);
+    REQUIRE(results[1].status == (uint8_t) CommandStatus::WRONG_PASSWORD);
+    REQUIRE_FALSE(results[1].written);
+    REQUIRE(results[2].status == 0);
+}
+
+TEST_CASE("Metrics count polls and busy responses per command", "[simulator]") {
+    auto device = make_shared<SimulatedDevice>(DeviceModel::PRO,
+                                               SimulatedDevice::Options{std::chrono::milliseconds(0), 2});
+    REQUIRE(device->connect());
+    auto &metrics = nitrokey::metrics::Metrics::instance();
+    metrics.reset();
+    GetStatus::CommandTransaction::run(*device);
+    GetStatus::CommandTransaction::run(*device);
+    REQUIRE(command_status([&](){ GetSlotName::CommandTransaction::run(*device, {0x10}); })
+            == (uint8_t) CommandStatus::SLOT_NOT_PROGRAMMED);
+
+    auto snapshot = metrics.snapshot();
+    REQUIRE(snapshot.size() == 2);
+    REQUIRE(snapshot[0].first == CommandID::GET_STATUS);
+    auto &status = snapshot[0].second;
+    REQUIRE(status.commands == 2);
+    REQUIRE(status.busy_responses == 4);
+    REQUIRE(status.polls == 6);
+    REQUIRE(status.failures == 0);
+    REQUIRE(status.command_errors == 0);
+    uint64_t histogram_total = 0;
+    for (auto count : status.latency_histogram) histogram_total += count;
+    REQUIRE(histogram_total == 2);
+    REQUIRE(snapshot[1].second.command_errors == 1);
+
+    metrics.reset();
+    REQUIRE(metrics.snapshot().empty());
+}
+
+TEST_CASE("Per-command deadline bounds waiting for a stuck device", "[simulator]") {
+    auto device = make_shared<SimulatedDevice>(DeviceModel::PRO,
+                                               SimulatedDevice::Options{std::chrono::milliseconds(200), 0});
+    REQUIRE(device->connect());
+    auto timing = device->get_timing();
+    timing.deadline = chrono::milliseconds(50);
+    device->set_command_timing(CommandID::GET_STATUS, timing);
+
+    auto start = chrono::steady_clock::now();
+    REQUIRE_THROWS_AS(GetStatus::CommandTransaction::run(*device), std::runtime_error);
+    auto elapsed = chrono::steady_clock::now() - start;
+    REQUIRE(elapsed >= chrono::milliseconds(50));
+    REQUIRE(elapsed < chrono::milliseconds(150));
+
+    // other commands keep the device's timing
+    REQUIRE(device->get_timing(CommandID::GET_USER_PASSWORD_RETRY_COUNT).deadline == device->get_timing().deadline);
+    device->clear_command_timing();
+    device->set_options({std::chrono::milliseconds(0), 0});
+    REQUIRE(GetStatus::CommandTransaction::run(*device).data().firmware_version != 0);
+}
+
+TEST_CASE("Response on the last allowed poll is accepted", "[simulator]") {
+    auto device = make_shared<SimulatedDevice>(DeviceModel::PRO,
+                                               SimulatedDevice::Options{std::chrono::milliseconds(0), 2});
+    REQUIRE(device->connect());
+    auto timing = device->get_timing();
+    timing.retry_count = 3;
+    device->set_timing(timing);
+    REQUIRE(GetStatus::CommandTransaction::run(*device).data().firmware_version != 0);
+    timing.retry_count = 2;
+    device->set_timing(timing);
+    REQUIRE_THROWS_AS(GetStatus::CommandTransaction::run(*device), std::runtime_error);
+}
+
+TEST_CASE("Recorded session is replayed with the recorded responses", "[simulator]") {
+    const string trace_path = "test_replay.trace";
+    remove(trace_path.c_str());
+    uint32_t recorded_code;
+    {
+        NitrokeyManager m;
+        REQUIRE(m.connect_simulated(DeviceModel::PRO, {std::chrono::milliseconds(30), 1}));
+        m.set_debug(false);
+        m.start_recording(trace_path);
+        m.first_authenticate("12345678", ADMIN_TEMP);
+        m.write_HOTP_slot(1, "recorded", RFC_SECRET, 0, false, false, false, "", ADMIN_TEMP);
+        recorded_code = m.get_HOTP_code(1, "");
+        m.stop_recording();
+    }
+    {
+        // appended after the first session
+        NitrokeyManager m;
+        REQUIRE(m.connect_simulated(DeviceModel::PRO, {std::chrono::milliseconds(0), 0}));
+        m.start_recording(trace_path);
+        m.get_status();
+        m.stop_recording();
+    }
+    DeviceModel model;
+    auto records = read_trace(trace_path, model);
+    REQUIRE(model == DeviceModel::PRO);
+    REQUIRE(records.front().direction == (uint8_t) TraceDirection::SENT);
+    REQUIRE(records.front().command_id == (uint8_t) CommandID::FIRST_AUTHENTICATE);
+    REQUIRE(records.back().command_id == (uint8_t) CommandID::GET_STATUS);
+    REQUIRE(dissect_trace_record(records.back()).find("GET_STATUS") != string::npos);
+
+    NitrokeyManager m;
+    REQUIRE(m.connect_replay(trace_path, 1.0));
+    m.set_debug(false);
+    auto start = chrono::steady_clock::now();
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    // the recorded latency is kept
+    REQUIRE(chrono::steady_clock::now() - start >= chrono::milliseconds(30));
+    m.write_HOTP_slot(1, "recorded", RFC_SECRET, 0, false, false, false, "", ADMIN_TEMP);
+    REQUIRE(m.get_HOTP_code(1, "") == recorded_code);
+    // commands out of the recorded order fail
+    REQUIRE_THROWS_AS(m.get_HOTP_code(1, ""), std::runtime_error);
+    remove(trace_path.c_str());
+}
+
+TEST_CASE("TOTP codes are read once per time step", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.write_TOTP_slot(1, "totp", RFC_SECRET, 30, true, false, false, "", ADMIN_TEMP);
+
+    auto &metrics = nitrokey::metrics::Metrics::instance();
+    auto set_time_commands = [&]() {
+        for (auto &command : metrics.snapshot())
+            if (command.first == CommandID::SET_TIME) return command.second.commands;
+        return (uint64_t) 0;
+    };
+    metrics.reset();
+    uint64_t now = 1111111090;
+    auto &service = m.get_TOTP_service();
+    service.set_clock([&]() { return now; });
+    REQUIRE(service.get_code(1) == 7081804);
+    now = 1111111100;
+    REQUIRE(service.get_code(1) == 7081804);
+    REQUIRE(set_time_commands() == 1);
+    // the next time step is read once it has started, the device time is set only when it differs
+    now = 1111111111;
+    REQUIRE(service.get_code(1) == 14050471);
+    REQUIRE(service.get_code(1) == 14050471);
+    REQUIRE(set_time_commands() == 2);
+    auto statistics = service.get_statistics();
+    REQUIRE(statistics.device_reads == 2);
+    REQUIRE(statistics.hits == 2);
+
+    // a device time within a second of the requested one is kept
+    REQUIRE(m.get_TOTP_code_at(1, 1111111112, "") == 14050471);
+    REQUIRE(set_time_commands() == 2);
+
+    // slot changes drop the codes
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.write_TOTP_slot(1, "totp", "3132333435363738393031323334353637383931", 30, true, false, false, "",
+                      ADMIN_TEMP);
+    REQUIRE(service.get_code(1) != 14050471);
+    REQUIRE(service.get_statistics().device_reads == 3);
+}
+
+TEST_CASE("Memoized PIN protected TOTP codes need the same temporary password", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.write_TOTP_slot(1, "totp", RFC_SECRET, 30, true, false, false, "", ADMIN_TEMP);
+    m.first_authenticate("12345678", ADMIN_TEMP);
+    m.write_config(255, 255, 255, true, false, ADMIN_TEMP);
+    m.user_authenticate("123456", USER_TEMP);
+
+    auto &service = m.get_TOTP_service();
+    service.set_clock([]() { return (uint64_t) 1111111109; });
+    REQUIRE(service.get_code(1, 30, USER_TEMP) == 7081804);
+    REQUIRE(service.get_code(1, 30, USER_TEMP) == 7081804);
+    REQUIRE(service.get_statistics().hits == 1);
+    REQUIRE(command_status([&](){ service.get_code(1, 30, ""); }) == (uint8_t) CommandStatus::NOT_AUTHORIZED);
+    REQUIRE(command_status([&](){ service.get_code(1, 30, "wrong"); }) == (uint8_t) CommandStatus::WRONG_PASSWORD);
+}
+
+TEST_CASE("Password safe slots read and written in bulk", "[simulator]") {
+    NitrokeyManager m;
+    REQUIRE(m.connect("sim"));
+    m.set_debug(false);
+    NitrokeyManager::PasswordSafeSlot slots[PWS_SLOT_COUNT];
+    memset(slots, 'x', sizeof slots);
+    REQUIRE(command_status([&](){ m.get_password_safe_slots(slots); }) == (uint8_t) CommandStatus::NOT_AUTHORIZED);
+    // nothing left from before the failed read
+    for (size_t i = 0; i < sizeof slots; i++) REQUIRE(reinterpret_cast<char *>(slots)[i] == 0);
+
+    m.enable_password_safe("123456");
+    strcpy(slots[2].name, "name2");
+    strcpy(slots[2].login, "login2");
+    strcpy(slots[2].password, "12345678901234567890");
+    strcpy(slots[15].name, "name15");
+    vector<uint8_t> written_status(PWS_SLOT_COUNT, 0);
+    written_status[2] = written_status[15] = 1;
+    auto &metrics = nitrokey::metrics::Metrics::instance();
+    metrics.reset();
+    // an unterminated field is rejected before anything is sent
+    memset(slots[15].password, 'p', sizeof slots[15].password);
+    REQUIRE_THROWS_AS(m.write_password_safe_slots(slots, written_status), TooLongStringException);
+    REQUIRE(metrics.snapshot().empty());
+    slots[15].login[0] = slots[15].password[0] = 0;
+    m.write_password_safe_slots(slots, written_status);
+
+    metrics.reset();
+    NitrokeyManager::PasswordSafeSlot read[PWS_SLOT_COUNT];
+    REQUIRE(m.get_password_safe_slots(read) == written_status);
+    REQUIRE(string(read[2].name) == "name2");
+    REQUIRE(string(read[2].login) == "login2");
+    REQUIRE(string(read[2].password) == "12345678901234567890");
+    REQUIRE(string(read[15].name) == "name15");
+    REQUIRE(string(read[15].login).empty());
+    REQUIRE(read[0].name[0] == 0);
+    // status and three fields of each programmed slot
+    uint64_t commands = 0;
+    for (auto &command : metrics.snapshot()) commands += command.second.commands;
+    REQUIRE(commands == 1 + 2 * 3);
+}
+
+TEST_CASE("Manager released by its own job drops the waiting jobs", "[simulator]") {
+    auto m = make_shared<NitrokeyManager>();
+    REQUIRE(m->connect("sim"));
+    m->set_debug(false);
+    std::promise<void> released;
+    auto released_future = released.get_future();
+    auto first = m->async([owner = m, &released_future]() mutable {
+        released_future.wait();
+        // the last reference, the manager is destroyed on its worker thread
+        owner.reset();
+    });
+    auto second = m->async([]() { return 1; });
+    m.reset();
+    released.set_value();
+    first.get();
+    REQUIRE_THROWS_AS(second.get(), std::future_error);
+}